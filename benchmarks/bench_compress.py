@@ -0,0 +1,125 @@
+"""
+Measure what tile compression saves and costs per frame.
+
+Frames are taken from a night directory, or from a synthetic night written
+to a temporary directory if none is given. Each frame is compressed with
+fits_compress, as by log.py with compression on, then read back: the whole
+image, as make_wcs reads it, and one block of rows, as the calibration
+combine reads it. Every compressed frame is checked to decompress to the
+original pixels.
+
+Reports the compression ratio and the encode and decode times per frame,
+alongside the time to read the uncompressed frame, so the costs can be
+weighed against the disk and upload volume saved.
+
+Usage:
+    bench_compress [<dir>] [--frames=N] [--size=PX] [--rows=N]
+
+Options:
+    --frames=N          # Frames measured [default: 20]
+    --size=PX           # Width and height of synthetic frames [default: 2048]
+    --rows=N            # Rows read in the row-block decode [default: 64]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from docopt import docopt
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import calibration
+import fits_compress
+from night_tree import is_fits
+from synthetic_night import make_night
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def measure(fpath, workdir, rows=64):
+    """
+    Compress one frame into `workdir` and time reading it back.
+
+    Returns a dict of sizes in bytes and times in seconds.
+    """
+    dest = os.path.join(workdir, os.path.basename(fpath) + ".fits.fz")
+    # astropy maps uncompressed data lazily, so copy it to time the read
+    data, read_s = _timed(lambda f: np.array(fits_compress.getdata(f)), fpath)
+    encode_s = fits_compress.convert(fpath, dest)
+    decoded, decode_s = _timed(fits_compress.getdata, dest)
+    if not np.array_equal(data, decoded):
+        raise ValueError(f"{fpath} did not decompress to the original pixels")
+    layout = calibration.frame_layout(dest)
+    start = (layout.shape[0] - rows) // 2
+    _, block_s = _timed(calibration.read_rows, layout, start, start + rows)
+    result = dict(
+        size=os.path.getsize(fpath),
+        compressed=os.path.getsize(dest),
+        read_s=read_s,
+        encode_s=encode_s,
+        decode_s=decode_s,
+        block_s=block_s,
+    )
+    os.remove(dest)
+    return result
+
+
+def report(results):
+    """
+    Print the total ratio and the median and maximum times per frame.
+    """
+    size = sum(r["size"] for r in results)
+    compressed = sum(r["compressed"] for r in results)
+    print(
+        f"{len(results)} frames: {size / 1e6:.1f} MB -> {compressed / 1e6:.1f} MB "
+        f"(ratio {compressed / size:.2f})"
+    )
+    for key, label in (
+        ("read_s", "Read uncompressed"),
+        ("encode_s", "Compress"),
+        ("decode_s", "Decompress"),
+        ("block_s", "Decompress row block"),
+    ):
+        values = [r[key] * 1000 for r in results]
+        print(
+            f"{label:<22} median {statistics.median(values):7.1f} ms, "
+            f"max {max(values):7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    n_frames = int(args["--frames"])
+    with tempfile.TemporaryDirectory() as workdir:
+        if args["<dir>"]:
+            fpaths = sorted(
+                os.path.join(root, fname)
+                for root, dirs, fnames in os.walk(args["<dir>"])
+                for fname in fnames
+                if is_fits(fname) and not fits_compress.is_compressed(fname)
+            )[:n_frames]
+        else:
+            basedir = make_night(
+                os.path.join(workdir, "night"),
+                n_frames=n_frames,
+                size=int(args["--size"]),
+                n_misc=0,
+            )
+            framedir = os.path.join(basedir, os.path.basename(basedir))
+            fpaths = sorted(
+                os.path.join(framedir, fname)
+                for fname in os.listdir(framedir)
+                if is_fits(fname)
+            )
+        if not fpaths:
+            sys.exit("No uncompressed FITS frames found")
+        report([measure(fpath, workdir, rows=int(args["--rows"])) for fpath in fpaths])
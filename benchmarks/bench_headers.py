@@ -0,0 +1,113 @@
+"""
+Compare the raw-card header reader with reading headers through astropy.
+
+Frames are taken from a night directory, or from a synthetic night of small
+SBIG-style frames written to a temporary directory if none is given (only
+the header is read, so the image size does not matter). The catalogued
+keywords of every frame are read both ways, as header_catalog.read_header
+does, and checked to agree, value and type.
+
+Reports the time per frame and the frames per second of each reader, and
+how many frames the raw reader handed back to astropy.
+
+Usage:
+    bench_headers [<dir>] [--frames=N] [--repeat=N]
+
+Options:
+    --frames=N          # Frames read [default: 3000]
+    --repeat=N          # Passes over the frames, keeping the fastest
+                        # [default: 3]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from docopt import docopt
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import fits_blocks
+import fits_compress
+from header_catalog import KEYWORDS, catalog_keywords
+from night_tree import is_fits
+from synthetic_night import make_night
+
+
+def read_astropy(fpath):
+    return catalog_keywords(fits_compress.getheader(fpath))
+
+
+def read_raw(fpath):
+    try:
+        return fits_blocks.read_keywords(fpath, KEYWORDS)
+    except ValueError:
+        return None
+
+
+def time_reader(reader, fpaths, repeat=3):
+    """
+    The fastest of `repeat` passes of `reader` over `fpaths`, in seconds,
+    and the results of the last pass.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [reader(fpath) for fpath in fpaths]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def check(fpaths, expected, found):
+    """
+    Raise ValueError if the raw reader disagrees with astropy on a frame it
+    did not hand back.
+    """
+    for fpath, header, keywords in zip(fpaths, expected, found):
+        if keywords is None:
+            continue
+        if keywords != header or any(
+            type(keywords[key]) is not type(header[key]) for key in header
+        ):
+            raise ValueError(f"{fpath}: read {keywords}, astropy gives {header}")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    n_frames = int(args["--frames"])
+    repeat = int(args["--repeat"])
+    with tempfile.TemporaryDirectory() as workdir:
+        if args["<dir>"]:
+            fpaths = sorted(
+                os.path.join(root, fname)
+                for root, dirs, fnames in os.walk(args["<dir>"])
+                for fname in fnames
+                if is_fits(fname) and not fits_compress.is_compressed(fname)
+            )[:n_frames]
+        else:
+            basedir = make_night(
+                os.path.join(workdir, "night"), n_frames=n_frames, size=16
+            )
+            framedir = os.path.join(basedir, os.path.basename(basedir))
+            fpaths = sorted(
+                os.path.join(framedir, fname)
+                for fname in os.listdir(framedir)
+                if is_fits(fname)
+            )
+        if not fpaths:
+            sys.exit("No uncompressed FITS frames found")
+        astropy_s, expected = time_reader(read_astropy, fpaths, repeat)
+        raw_s, found = time_reader(read_raw, fpaths, repeat)
+        check(fpaths, expected, found)
+
+    n_fallback = sum(1 for keywords in found if keywords is None)
+    print(f"{len(fpaths)} frames, {n_fallback} handed back to astropy")
+    for label, elapsed in (("astropy", astropy_s), ("raw cards", raw_s)):
+        print(
+            f"{label:<10} {elapsed * 1e6 / len(fpaths):7.1f} us per frame, "
+            f"{len(fpaths) / elapsed:8.0f} frames/s"
+        )
+    print(f"Speed-up {astropy_s / raw_s:.1f}x")
@@ -0,0 +1,248 @@
+"""
+Time each stage of processing a synthetic night.
+
+A night is generated with synthetic_night.py and taken through the stages
+one at a time (unzip, rename_maxim, sort_by_target, process_folder, writing
+the log), then through log.py in one go on a fresh copy, and finally a
+target is solved by make_wcs against the offline LocalBackend solver. Each
+measurement is the best of --repeat runs on fresh copies.
+
+Results are appended to a JSON-lines file along with the git revision and
+the options, and compared with the last earlier result for the same options,
+so a regression shows up as a ratio well above 1.
+
+Usage:
+    bench_night [--frames=N] [--size=PX] [--zip] [--repeat=N] [--jobs=N]
+                [--wcs-frames=N] [--solver-delay=S] [--results=FILE]
+                [--workdir=DIR]
+
+Options:
+    --frames=N          # Frames in the night [default: 200]
+    --size=PX           # Width and height of each frame [default: 512]
+    --zip               # Start from a zipped night
+    --repeat=N          # Runs per stage; the fastest is kept [default: 3]
+    --jobs=N -j N       # Worker processes/threads for log.py and make_wcs
+                        # [default: 1]
+    --wcs-frames=N      # Light frames solved in the WCS stage [default: 16]
+    --solver-delay=S    # Seconds the mock solver takes per frame
+                        # [default: 0.05]
+    --results=FILE      # Where results are recorded, by default
+                        # results.jsonl next to this script
+    --workdir=DIR       # Directory for the generated nights, by default a
+                        # temporary directory that is removed afterwards
+"""
+
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from docopt import docopt
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import log
+import make_wcs
+import rename_maxim
+import rename_obs
+import wcs_backends
+import zip_ingest
+from header_catalog import HeaderCatalog
+from synthetic_night import make_night
+
+DATE = "2025-02-26"
+
+
+@contextlib.contextmanager
+def _quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    with _quiet():
+        function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def git_revision():
+    """
+    The short hash of the checked-out commit, marked "+dirty" if the tree
+    has uncommitted changes, or None outside a git checkout.
+    """
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("+dirty" if dirty else "")
+
+
+def time_stages(template, workdir, jobs=1):
+    """
+    Take a copy of the night at `template` through the stages one at a time.
+
+    Returns a dict of seconds per stage.
+    """
+    basedir = os.path.join(workdir, "staged", DATE)
+    shutil.rmtree(os.path.dirname(basedir), ignore_errors=True)
+    shutil.copytree(template, basedir)
+    framedir = os.path.join(basedir, DATE)
+    catalog = HeaderCatalog()
+    timings = {}
+
+    zips = glob.glob(os.path.join(basedir, "*.zip"))
+    timings["unzip"] = sum(
+        _timed(zip_ingest.ingest_zip, fpath, basedir, catalog, jobs=jobs)
+        for fpath in zips
+    )
+    timings["rename_maxim"] = _timed(rename_maxim.main, framedir)
+    timings["sort_by_target"] = _timed(
+        rename_obs.sort_by_target, framedir, catalog=catalog, jobs=jobs
+    )
+
+    def process_folders():
+        for root, dirs, fnames in os.walk(framedir):
+            rename_obs.process_folder(root, catalog=catalog)
+
+    timings["process_folder"] = _timed(process_folders)
+    # On a sorted night log.py has nothing left to move, so this is the cost
+    # of listing the night and writing the log and catalog
+    timings["write_log"] = _timed(log.main, basedir, jobs=jobs, use_cache=False)
+    return timings
+
+
+def time_log(template, workdir, jobs=1):
+    """
+    Seconds for log.py to process a fresh copy of the night at `template`.
+    """
+    basedir = os.path.join(workdir, "log", DATE)
+    shutil.rmtree(os.path.dirname(basedir), ignore_errors=True)
+    shutil.copytree(template, basedir)
+    return _timed(log.main, basedir, jobs=jobs, use_cache=False)
+
+
+def time_wcs(template, workdir, n_frames=16, jobs=1, delay=0.05):
+    """
+    Seconds for make_wcs to solve `n_frames` light frames of the night at
+    `template` against the mock solver.
+    """
+    basedir = os.path.join(workdir, "wcs", DATE)
+    shutil.rmtree(os.path.dirname(basedir), ignore_errors=True)
+    shutil.copytree(template, basedir)
+    with _quiet():
+        log.main(basedir, use_cache=False)
+    framedir = Path(basedir, DATE)
+    target_dir = max(
+        (d for d in framedir.iterdir() if d.is_dir() and d.name not in ("Misc",)),
+        key=lambda d: len(list(d.glob("*.fits"))),
+    )
+    frames = sorted(target_dir.glob("*.fits"))[:n_frames]
+    backend = wcs_backends.LocalBackend(delay=delay)
+    return _timed(
+        make_wcs.solve_all,
+        frames,
+        target_dir.name,
+        jobs=jobs,
+        cache=None,
+        backend=backend,
+    )
+
+
+def previous_result(results_path, options):
+    """
+    The last recorded result with the same options, or None.
+    """
+    previous = None
+    try:
+        with open(results_path) as f:
+            for line in f:
+                result = json.loads(line)
+                if result["options"] == options:
+                    previous = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    options = {
+        "frames": int(args["--frames"]),
+        "size": int(args["--size"]),
+        "zip": args["--zip"],
+        "jobs": int(args["--jobs"]),
+        "wcs_frames": int(args["--wcs-frames"]),
+        "solver_delay": float(args["--solver-delay"]),
+    }
+    repeat = int(args["--repeat"])
+    results_path = args["--results"] or str(Path(__file__).parent / "results.jsonl")
+
+    workdir = args["--workdir"] or tempfile.mkdtemp(prefix="bench_night_")
+    try:
+        print(f"Generating a night of {options['frames']} frames in {workdir}")
+        template = make_night(
+            os.path.join(workdir, "template"),
+            date=DATE,
+            n_frames=options["frames"],
+            size=options["size"],
+            zip=options["zip"],
+        )
+        runs = []
+        for _ in range(repeat):
+            timings = time_stages(template, workdir, options["jobs"])
+            timings["log_total"] = time_log(template, workdir, options["jobs"])
+            timings["wcs"] = time_wcs(
+                template,
+                workdir,
+                options["wcs_frames"],
+                options["jobs"],
+                options["solver_delay"],
+            )
+            runs.append(timings)
+    finally:
+        if not args["--workdir"]:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    stages = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+    result = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "options": options,
+        "stages": stages,
+    }
+    previous = previous_result(results_path, options)
+    with open(results_path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    header = f"{'Stage':<16} {'Time/s':>8}"
+    if previous:
+        header += f"  {'vs ' + str(previous['revision']):>16}"
+    print(header)
+    for stage, elapsed in stages.items():
+        line = f"{stage:<16} {elapsed:>8.3f}"
+        if previous and previous["stages"].get(stage):
+            line += f"  {elapsed / previous['stages'][stage]:>15.2f}x"
+        print(line)
+    print(f"Recorded in {results_path}")
@@ -0,0 +1,104 @@
+"""
+Time how long each script takes to import, in a fresh interpreter.
+
+Each module is imported REPEAT times in a new Python process and the best
+wall time is reported, less the time of starting an empty interpreter. The
+heavy dependencies each import pulls in are listed, so a module-level import
+that slows down every script shows up here.
+
+The target listing, `python rename_obs.py <dir>` on a sorted night, is also
+timed end to end, as it is run often and should not need astropy; a lazy
+import of a heavy module on that path shows up here too.
+
+Usage:
+    import_time [<module>...] [--repeat=N]
+
+Options:
+    --repeat=N -n N     # Imports timed per module [default: 5]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from docopt import docopt
+
+REPO = Path(__file__).resolve().parent.parent
+
+MODULES = ("rename_maxim", "rename_obs", "header_catalog", "log", "make_wcs")
+
+# Dependencies worth knowing about when they are loaded at import time
+HEAVY = (
+    "astropy.io.fits",
+    "astropy.wcs",
+    "astropy.coordinates",
+    "astroquery",
+    "photutils",
+    "requests",
+    "numpy",
+)
+
+
+def _run(code):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return time.perf_counter() - start, output
+
+
+def _heavy_loaded():
+    # Code printing the HEAVY modules loaded, as the last line of output
+    return f"print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+
+
+def time_import(module, repeat=5):
+    """
+    Best wall time, in seconds, of importing `module` in a new interpreter
+    (excluding interpreter startup), and the HEAVY modules it loads.
+    """
+    probe = f"import sys, {module}; {_heavy_loaded()}"
+    baseline = min(_run("pass")[0] for _ in range(repeat))
+    timings = [_run(probe) for _ in range(repeat)]
+    best = min(elapsed for elapsed, _ in timings)
+    return best - baseline, timings[0][1].split()
+
+
+def time_listing(repeat=5):
+    """
+    Best wall time, in seconds, of running `rename_obs.py <dir>` on a small
+    sorted night in a new interpreter (excluding interpreter startup), and
+    the HEAVY modules it loads.
+    """
+    with tempfile.TemporaryDirectory() as basedir:
+        for target in ("M37", "Bias_Frame", "Masters", "Calibrated"):
+            os.mkdir(os.path.join(basedir, target))
+        probe = (
+            "import runpy, sys; "
+            f"sys.argv = ['rename_obs.py', {basedir!r}]; "
+            "runpy.run_path('rename_obs.py', run_name='__main__'); "
+            f"{_heavy_loaded()}"
+        )
+        baseline = min(_run("pass")[0] for _ in range(repeat))
+        timings = [_run(probe) for _ in range(repeat)]
+    best = min(elapsed for elapsed, _ in timings)
+    return best - baseline, timings[0][1].splitlines()[-1].split()
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    repeat = int(args["--repeat"])
+    print(f"{'Module':<16} {'Import/s':>9}  Heavy dependencies loaded")
+    for module in args["<module>"] or MODULES:
+        elapsed, heavy = time_import(module, repeat)
+        print(f"{module:<16} {elapsed:>9.3f}  {' '.join(heavy) or '-'}")
+    if not args["<module>"]:
+        elapsed, heavy = time_listing(repeat)
+        print(f"\n{'Listing':<16} {'Run/s':>9}  Heavy dependencies loaded")
+        print(f"{'rename_obs <dir>':<16} {elapsed:>9.3f}  {' '.join(heavy) or '-'}")
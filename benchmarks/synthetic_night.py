@@ -0,0 +1,182 @@
+"""
+Generate a synthetic observing night for benchmarks.
+
+The night is laid out as the telescope PC leaves it: DATE/DATE/ holding
+MaxIm DL's "CCD Image N.fit" files, or DATE/DATE.zip holding the same files,
+with SBIG-style headers. Frames are a mix of light frames of a few targets
+through several filters, darks matching the light exposure times, biases and
+flats in each filter, plus a few frames without IMAGETYP that log.py sorts
+into Misc. Light frames are star fields with a small drift between
+exposures, so they can also be used to exercise WCS propagation.
+
+Usage:
+    synthetic_night (<topdir>) [--date=DATE] [--frames=N] [--size=PX]
+                    [--misc=N] [--zip] [--seed=N]
+
+Options:
+    --date=DATE         # Night to generate [default: 2025-02-26]
+    --frames=N          # Frames in the night, including Misc [default: 100]
+    --size=PX           # Width and height of each frame [default: 512]
+    --misc=N            # Frames with no IMAGETYP [default: 2]
+    --zip               # Leave the frames zipped, as downloaded
+    --seed=N            # Random seed [default: 1]
+"""
+
+import os
+import zipfile
+import numpy as np
+from astropy.io import fits
+from docopt import docopt
+
+# Light-frame targets: (OBJECT, OBJCTRA, OBJCTDEC)
+TARGETS = (
+    ("M37", "05 52 18", "+32 33 00"),
+    ("NGC 7000", "20 59 17", "+44 31 43"),
+    ("XX Cyg", "20 03 15", "+58 57 17"),
+)
+FILTERS = ("V", "B", "R")
+LIGHT_EXPTIMES = (30.0, 60.0, 10.5)
+
+# Share of each frame type in the night
+MIX = (("Light Frame", 0.6), ("Dark Frame", 0.15), ("Bias Frame", 0.1))
+# (the rest are flats)
+
+BIAS_LEVEL = 1000.0
+READ_NOISE = 10.0
+DARK_CURRENT = 0.5  # counts per second
+FLAT_LEVEL = 20000.0
+N_STARS = 60
+STAR_FWHM = 4.0
+
+
+def frame_types(n_frames, n_misc=2):
+    """
+    The IMAGETYP of each frame of a night, in order of observation; None for
+    the frames destined for Misc.
+    """
+    types = []
+    for imagetyp, share in MIX:
+        types += [imagetyp] * int(round(share * (n_frames - n_misc)))
+    types += ["Flat Field"] * (n_frames - n_misc - len(types))
+    # Calibrations at the start and end of the night, lights in between
+    lights = [t for t in types if t == "Light Frame"]
+    calibrations = [t for t in types if t != "Light Frame"]
+    half = len(calibrations) // 2
+    types = calibrations[:half] + lights + calibrations[half:]
+    for i in range(n_misc):
+        types.insert((i + 1) * len(types) // (n_misc + 1), None)
+    return types
+
+
+def _star_field(rng, stars, shape, shift):
+    # Sky plus Gaussian stars at `stars` positions, moved by `shift`
+    data = np.zeros(shape)
+    sigma = STAR_FWHM / 2.355
+    half = int(4 * sigma) + 1
+    for x, y, flux in stars:
+        x += shift[0]
+        y += shift[1]
+        x0, y0 = int(x), int(y)
+        if not (half <= x0 < shape[1] - half and half <= y0 < shape[0] - half):
+            continue
+        yy, xx = np.mgrid[y0 - half : y0 + half + 1, x0 - half : x0 + half + 1]
+        data[y0 - half : y0 + half + 1, x0 - half : x0 + half + 1] += flux * np.exp(
+            -((xx - x) ** 2 + (yy - y) ** 2) / (2 * sigma**2)
+        )
+    return data
+
+
+def make_night(
+    topdir, date="2025-02-26", n_frames=100, size=512, n_misc=2, zip=False, seed=1
+):
+    """
+    Write a synthetic night to `topdir`/`date`.
+
+    Returns the night directory (the <BASEDIR> log.py is run on).
+    """
+    rng = np.random.default_rng(seed)
+    shape = (size, size)
+    basedir = os.path.join(topdir, date)
+    framedir = os.path.join(basedir, date)
+    os.makedirs(framedir, exist_ok=True)
+
+    # Fixed star positions for each target, so a sequence can be aligned
+    fields = {
+        target: [
+            (rng.uniform(0, size), rng.uniform(0, size), rng.uniform(500, 8000))
+            for _ in range(N_STARS)
+        ]
+        for target, ra, dec in TARGETS
+    }
+    flat_pattern = 1 - 0.2 * (
+        np.hypot(*np.mgrid[-1 : 1 : size * 1j, -1 : 1 : size * 1j]) ** 2 / 2
+    )
+
+    fpaths = []
+    n_lights = 0
+    for i, imagetyp in enumerate(frame_types(n_frames, n_misc)):
+        header = fits.Header()
+        header["INSTRUME"] = "SBIG STX-16803 3 CCD Camera"
+        header["TELESCOP"] = "Meade LX200"
+        header["SWCREATE"] = "MaxIm DL Version 6.40"
+        header["XBINNING"] = 1
+        header["YBINNING"] = 1
+        header["CCD-TEMP"] = -20.0
+        seconds = 20 * 3600 + 90 * i
+        header["DATE-OBS"] = (
+            f"{date}T{seconds // 3600:02d}:{seconds // 60 % 60:02d}:"
+            f"{seconds % 60:02d}.000"
+        )
+        data = BIAS_LEVEL + rng.normal(0, READ_NOISE, shape)
+        if imagetyp == "Light Frame":
+            target, ra, dec = TARGETS[n_lights // 8 % len(TARGETS)]
+            filter_name = FILTERS[n_lights // 4 % len(FILTERS)]
+            exptime = LIGHT_EXPTIMES[n_lights // 8 % len(LIGHT_EXPTIMES)]
+            header["OBJECT"] = target
+            header["OBJCTRA"] = ra
+            header["OBJCTDEC"] = dec
+            drift = (0.7 * (n_lights % 8), -0.4 * (n_lights % 8))
+            data += 200 + DARK_CURRENT * exptime
+            data += _star_field(rng, fields[target], shape, drift) * exptime / 30
+            n_lights += 1
+        elif imagetyp == "Dark Frame":
+            filter_name = ""
+            exptime = LIGHT_EXPTIMES[i % len(LIGHT_EXPTIMES)]
+            data += DARK_CURRENT * exptime
+        elif imagetyp == "Bias Frame":
+            filter_name = ""
+            exptime = 0.0
+        else:
+            filter_name = FILTERS[i % len(FILTERS)]
+            exptime = 1.0
+            data += FLAT_LEVEL * flat_pattern
+        if imagetyp is not None:
+            header["IMAGETYP"] = imagetyp
+            header["OBJECT"] = header.get("OBJECT", "")
+        header["FILTER"] = filter_name
+        header["EXPTIME"] = exptime
+        fpath = os.path.join(framedir, f"CCD Image {i + 1}.fit")
+        data = np.clip(data, 0, 65535).astype(np.uint16)
+        fits.PrimaryHDU(data=data, header=header).writeto(fpath, overwrite=True)
+        fpaths.append(fpath)
+
+    if zip:
+        with zipfile.ZipFile(os.path.join(basedir, f"{date}.zip"), "w") as zf:
+            for fpath in fpaths:
+                zf.write(fpath, arcname=f"{date}/{os.path.basename(fpath)}")
+                os.remove(fpath)
+    return basedir
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    basedir = make_night(
+        args["<topdir>"],
+        date=args["--date"],
+        n_frames=int(args["--frames"]),
+        size=int(args["--size"]),
+        n_misc=int(args["--misc"]),
+        zip=args["--zip"],
+        seed=int(args["--seed"]),
+    )
+    print(f"Wrote synthetic night to {basedir}")
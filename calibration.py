@@ -0,0 +1,568 @@
+"""
+Calibration of a night: master bias, darks per EXPTIME and flats per FILTER,
+and light frames corrected with them.
+
+The bias, dark and flat frames are picked out of the night catalog written by
+log.py, so no headers are read again. Each master is a pixel-by-pixel median,
+or sigma-clipped mean, of its frames. The combine works one block of rows at
+a time. It reads just those rows of every frame from the memory-mapped files,
+and the blocks are shared among `jobs` threads. Only a few blocks are in
+memory at once, so peak memory is set by --memory, not by the number of
+frames.
+
+Darks have the master bias subtracted. Flats have the bias and the master
+dark of the same EXPTIME, if there is one, subtracted. Each flat is scaled to
+a median of 1 before combining, so the master flat is normalised too. The
+masters are written to DATE/DATE/Masters, which log.py leaves alone:
+
+    Master_Bias.fits
+    Master_Dark_<EXPTIME>s.fits
+    Master_Flat_<FILTER>.fits
+
+`lights` then streams the light frames through `jobs` worker processes. Each
+frame has the bias and the dark of its EXPTIME subtracted (or the longest
+dark, scaled) and is divided by the flat of its FILTER. Every worker memory
+maps the masters once, so they are shared through the page cache rather than
+copied to each worker. Calibrated frames keep their names and go to
+DATE/DATE/Calibrated/TARGET, so they can be solved with
+
+    python make_wcs.py DATE/DATE/Calibrated TARGET
+
+Usage:
+    calibration masters (<basedir>) [--method=M] [--sigma=S] [--jobs=N]
+                        [--memory=MB]
+    calibration lights (<basedir>) [<target>...] [--jobs=N]
+
+Options:
+    --method=M          # "median" or "sigma" (sigma-clipped mean)
+                        # [default: median]
+    --sigma=S           # Clipping threshold for --method=sigma
+                        # [default: 3.0]
+    --jobs=N -j N       # Row blocks combined (masters) or frames calibrated
+                        # (lights) at the same time [default: 1]
+    --memory=MB         # Memory for the frame rows being combined, shared
+                        # by the jobs [default: 256]
+"""
+
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from astropy.io import fits
+from docopt import docopt
+
+import fits_blocks
+import fits_compress
+from night_catalog import CATALOG_SUFFIX, frame_paths, read_catalog, select
+from rename_obs import CALIBRATED_DIR, MASTERS_DIR, exptime_label
+
+# Header cards copied from the first frame of a master
+COPIED_CARDS = ("INSTRUME", "TELESCOP", "XBINNING", "YBINNING", "CCD-TEMP", "DATE-OBS")
+# Big-endian dtypes of the FITS BITPIX values
+BITPIX_DTYPES = {8: "u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+# Side of the central patch used to measure the level of a flat
+SCALE_PATCH = 256
+# Temporary arrays per pixel of a block, on top of the block itself
+COMBINE_OVERHEAD = 3
+
+
+class FrameLayout(namedtuple("FrameLayout", "path offset dtype shape bscale bzero")):
+    """
+    Where and how the primary image of a FITS file is stored: the byte
+    offset of the data, its big-endian dtype and shape, and the BSCALE and
+    BZERO that turn stored values into pixel values.
+
+    A tile-compressed frame cannot be memory mapped, and has no offset.
+    """
+
+
+def frame_layout(fpath):
+    """
+    The `FrameLayout` of a frame, from its raw header blocks.
+    """
+    if fits_compress.is_compressed(fpath):
+        header = fits_compress.getheader(fpath)
+        offset = None
+    else:
+        with open(fpath, "rb") as f:
+            raw = fits_blocks.read_header_blocks(f)
+        header = fits.Header.fromstring(raw)
+        offset = len(raw)
+    shape = tuple(header[f"NAXIS{i}"] for i in range(header["NAXIS"], 0, -1))
+    return FrameLayout(
+        str(fpath),
+        offset,
+        np.dtype(BITPIX_DTYPES[header["BITPIX"]]),
+        shape,
+        header.get("BSCALE", 1),
+        header.get("BZERO", 0),
+    )
+
+
+def map_image(layout):
+    """
+    The stored image of a frame as a read-only memory-mapped array. Pages
+    are only read from disk when used, and are shared between processes
+    mapping the same file.
+    """
+    return np.memmap(
+        layout.path,
+        dtype=layout.dtype,
+        mode="r",
+        offset=layout.offset,
+        shape=layout.shape,
+    )
+
+
+def read_rows(layout, start, stop):
+    """
+    Rows start:stop of a frame's image, as float32.
+
+    The file is memory mapped, so only those rows are read from disk. Only
+    the tiles holding the rows of a compressed frame are decompressed.
+    """
+    if layout.offset is None:
+        with fits.open(layout.path, do_not_scale_image_data=True) as hdulist:
+            hdu = fits_compress.image_hdu(hdulist)
+            rows = hdu.section[start:stop].astype(np.float32)
+    else:
+        rows = map_image(layout)[start:stop].astype(np.float32)
+    if layout.bscale != 1:
+        rows *= layout.bscale
+    if layout.bzero:
+        rows += layout.bzero
+    return rows
+
+
+def block_rows(n_frames, n_columns, jobs=1, memory=256):
+    """
+    Rows per block, so that `jobs` blocks of `n_frames` frames being
+    combined fit in `memory` MB.
+    """
+    per_row = n_frames * n_columns * np.dtype(np.float32).itemsize
+    budget = memory * 1024**2 / jobs / (1 + COMBINE_OVERHEAD)
+    return max(1, int(budget // per_row))
+
+
+def _combine_block(stack, method, sigma):
+    if method == "median":
+        return np.median(stack, axis=0)
+    if method == "sigma":
+        from astropy.stats import sigma_clip
+
+        clipped = sigma_clip(stack, sigma=sigma, axis=0, masked=False, copy=False)
+        return np.nanmean(clipped, axis=0)
+    raise ValueError(f"Unknown combine method {method!r}")
+
+
+def combine_frames(
+    fpaths,
+    method="median",
+    sigma=3.0,
+    offset=None,
+    scales=None,
+    jobs=1,
+    memory=256,
+):
+    """
+    Combine frames pixel by pixel, one block of rows at a time.
+
+    Parameters
+    ----------
+    fpaths : list of string
+        The frames, all the same shape.
+
+    method : string
+        "median", or "sigma" for the mean after sigma clipping.
+
+    sigma : float
+        Clipping threshold in standard deviations, for "sigma".
+
+    offset : ndarray, optional
+        Image subtracted from every frame before combining, e.g. a master
+        bias.
+
+    scales : list of float, optional
+        Factor each frame is divided by, after subtracting `offset`.
+
+    jobs : int
+        Blocks combined at the same time, each in its own thread.
+
+    memory : float
+        Memory in MB for the blocks being combined.
+
+    Returns
+    -------
+    ndarray
+        The combined image, as float32.
+    """
+    layouts = [frame_layout(fpath) for fpath in fpaths]
+    shape = layouts[0].shape
+    rows = block_rows(len(fpaths), shape[1], jobs, memory)
+    combined = np.empty(shape, dtype=np.float32)
+
+    def combine_block(start):
+        stop = min(start + rows, shape[0])
+        stack = np.empty((len(fpaths), stop - start, shape[1]), dtype=np.float32)
+        for i, layout in enumerate(layouts):
+            stack[i] = read_rows(layout, start, stop)
+        if offset is not None:
+            stack -= offset[start:stop]
+        if scales is not None:
+            stack /= np.asarray(scales, dtype=np.float32)[:, None, None]
+        combined[start:stop] = _combine_block(stack, method, sigma)
+
+    # NumPy and the reads from the memory maps release the GIL, so threads are enough, and
+    # every block is written straight into the result
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(combine_block, range(0, shape[0], rows)))
+    return combined
+
+
+def flat_level(fpath, offset=None):
+    """
+    Median level of the central patch of a frame, after subtracting
+    `offset`.
+    """
+    layout = frame_layout(fpath)
+    y0 = max(0, (layout.shape[0] - SCALE_PATCH) // 2)
+    x0 = max(0, (layout.shape[1] - SCALE_PATCH) // 2)
+    patch = read_rows(layout, y0, y0 + SCALE_PATCH)[:, x0 : x0 + SCALE_PATCH]
+    if offset is not None:
+        patch = patch - offset[y0 : y0 + SCALE_PATCH, x0 : x0 + SCALE_PATCH]
+    return float(np.median(patch))
+
+
+def _same_shape(fpaths):
+    # The frames with the shape of the first, warning about the others
+    shape = frame_layout(fpaths[0]).shape
+    kept = []
+    for fpath in fpaths:
+        if frame_layout(fpath).shape == shape:
+            kept.append(fpath)
+        else:
+            print(f"\tSkipping {fpath}: not the same size as {fpaths[0]}")
+    return kept
+
+
+def write_master(fpath, data, fpaths, imagetyp, exptime, filter_name, method, **cards):
+    """
+    Write a master frame, with a header describing how it was made.
+
+    Cards in `COPIED_CARDS` are taken from the first frame combined; extra
+    `cards` (e.g. the masters subtracted) are added as given.
+    """
+    first = fits_compress.getheader(fpaths[0])
+    header = fits.Header()
+    for key in COPIED_CARDS:
+        if key in first:
+            header[key] = first[key]
+    header["IMAGETYP"] = imagetyp
+    header["EXPTIME"] = exptime
+    header["FILTER"] = filter_name
+    header["NCOMBINE"] = (len(fpaths), "Number of frames combined")
+    header["COMBINE"] = (method, "Combine method")
+    for key, value in cards.items():
+        header[key] = value
+    fits.PrimaryHDU(data=data, header=header).writeto(fpath, overwrite=True)
+    print(f"Written {imagetyp.lower()} of {len(fpaths)} frames to {fpath}")
+
+
+def masters_dir(basedir):
+    """
+    Where the masters of the night in `basedir` go: DATE/DATE/Masters.
+    """
+    basedir = os.path.normpath(basedir)
+    return os.path.join(basedir, os.path.basename(basedir), MASTERS_DIR)
+
+
+def build_masters(basedir, method="median", sigma=3.0, jobs=1, memory=256):
+    """
+    Build the master bias, darks and flats of the night in `basedir` from
+    its catalog.
+
+    Returns a dict of the masters written: "bias" maps to a path, "dark" to
+    a dict of paths by EXPTIME and "flat" to a dict of paths by FILTER.
+    """
+    basedir = os.path.normpath(basedir)
+    catalog = read_catalog(
+        os.path.join(basedir, os.path.basename(basedir) + CATALOG_SUFFIX)
+    )
+    outdir = masters_dir(basedir)
+    os.makedirs(outdir, exist_ok=True)
+    options = dict(method=method, sigma=sigma, jobs=jobs, memory=memory)
+    masters = {"bias": None, "dark": {}, "flat": {}}
+
+    bias = None
+    fpaths = frame_paths(select(catalog, type="BIAS"))
+    if fpaths:
+        fpaths = _same_shape(fpaths)
+        bias = combine_frames(fpaths, **options)
+        masters["bias"] = os.path.join(outdir, "Master_Bias.fits")
+        write_master(masters["bias"], bias, fpaths, "Master Bias", 0.0, "", method)
+    else:
+        print("No bias frames: darks and flats are not bias subtracted")
+
+    darks = {}
+    darks_table = select(catalog, type="DARK")
+    for exptime in sorted(set(float(t) for t in darks_table["exptime"])):
+        fpaths = _same_shape(
+            frame_paths(select(darks_table, min_exptime=exptime, max_exptime=exptime))
+        )
+        darks[exptime] = combine_frames(fpaths, **options)
+        if bias is not None:
+            darks[exptime] -= bias
+        fpath = os.path.join(outdir, f"Master_Dark_{exptime_label(exptime)}s.fits")
+        write_master(
+            fpath,
+            darks[exptime],
+            fpaths,
+            "Master Dark",
+            exptime,
+            "",
+            method,
+            BIASSUB=(bias is not None, "Master bias subtracted"),
+        )
+        masters["dark"][exptime] = fpath
+
+    flats_table = select(catalog, type="FLAT")
+    for filter_name in sorted(set(flats_table["filter"])):
+        table = select(flats_table, filter=filter_name)
+        fpaths = _same_shape(frame_paths(table))
+        # The dark current of flats is only removed if they share an
+        # exposure time with a master dark; flats are usually short enough
+        # for it not to matter.
+        exptime = float(table["exptime"][0])
+        dark_subtracted = exptime in darks and all(table["exptime"] == exptime)
+        offset = bias
+        if dark_subtracted:
+            offset = darks[exptime] if bias is None else bias + darks[exptime]
+        levels = {fpath: flat_level(fpath, offset) for fpath in fpaths}
+        # A flat with no signal above the bias would blow up when scaled
+        for fpath in fpaths:
+            if levels[fpath] <= 0:
+                print(f"\tSkipping {fpath}: no signal above the bias")
+        fpaths = [fpath for fpath in fpaths if levels[fpath] > 0]
+        if not fpaths:
+            continue
+        scales = [levels[fpath] for fpath in fpaths]
+        flat = combine_frames(fpaths, offset=offset, scales=scales, **options)
+        flat /= np.median(flat)
+        fpath = os.path.join(outdir, f"Master_Flat_{filter_name}.fits")
+        write_master(
+            fpath,
+            flat,
+            fpaths,
+            "Master Flat",
+            exptime,
+            filter_name,
+            method,
+            BIASSUB=(bias is not None, "Master bias subtracted"),
+            DARKSUB=(dark_subtracted, "Master dark subtracted"),
+        )
+        masters["flat"][filter_name] = fpath
+    return masters
+
+
+def find_masters(basedir):
+    """
+    The masters already built for the night in `basedir`, identified by
+    their IMAGETYP, in the form returned by `build_masters`.
+    """
+    masters = {"bias": None, "dark": {}, "flat": {}}
+    outdir = masters_dir(basedir)
+    if not os.path.isdir(outdir):
+        return masters
+    for fname in sorted(os.listdir(outdir)):
+        if not fname.endswith(".fits"):
+            continue
+        fpath = os.path.join(outdir, fname)
+        header = fits.getheader(fpath)
+        if header["IMAGETYP"] == "Master Bias":
+            masters["bias"] = fpath
+        elif header["IMAGETYP"] == "Master Dark":
+            masters["dark"][float(header["EXPTIME"])] = fpath
+        elif header["IMAGETYP"] == "Master Flat":
+            masters["flat"][header["FILTER"]] = fpath
+    return masters
+
+
+def calibrated_dir(basedir):
+    """
+    Where the calibrated light frames of the night in `basedir` go, one
+    subdirectory per target: DATE/DATE/Calibrated.
+    """
+    basedir = os.path.normpath(basedir)
+    return os.path.join(basedir, os.path.basename(basedir), CALIBRATED_DIR)
+
+
+# Paths and memory-mapped images of the masters, set in each calibration
+# worker process by `_map_masters`
+_masters = None
+_master_images = None
+
+
+def _map_masters(masters):
+    # Process pool initializer: map every master once per worker, so only
+    # the paths are sent to the workers and the pixels are shared through
+    # the page cache rather than copied into each process
+    global _masters, _master_images
+
+    def image(fpath):
+        return map_image(frame_layout(fpath))
+
+    _masters = masters
+    _master_images = {
+        "bias": masters["bias"] and image(masters["bias"]),
+        "dark": {exptime: image(f) for exptime, f in masters["dark"].items()},
+        "flat": {name: image(f) for name, f in masters["flat"].items()},
+    }
+
+
+def _matching_dark(exptime):
+    # The master dark for `exptime` and the factor it is scaled by: the dark
+    # of the same exposure time if there is one, otherwise the longest dark
+    # scaled to `exptime` (the masters are bias subtracted, so dark current
+    # scales with time)
+    if exptime in _masters["dark"]:
+        return exptime, 1.0
+    if not _masters["dark"]:
+        return None, None
+    longest = max(_masters["dark"])
+    return longest, exptime / longest
+
+
+def calibrate_frame(fpath, outpath):
+    """
+    Subtract the bias and dark from a light frame and divide it by the flat
+    of its filter, writing the result to `outpath` as float32.
+
+    Runs in a worker process set up by `_map_masters`. The corrections made
+    are recorded in the header as CALSTAT (e.g. "BDF"), with the masters
+    used.
+
+    Returns CALSTAT.
+    """
+    data, header = fits_compress.getdata(fpath, header=True)
+    data = data.astype(np.float32)
+    for images in _master_images["dark"], _master_images["flat"]:
+        for image in images.values():
+            if image.shape != data.shape:
+                raise ValueError(f"{fpath} is not the same size as the masters")
+    calstat = ""
+    if _master_images["bias"] is not None:
+        data -= _master_images["bias"]
+        header["MBIAS"] = (os.path.basename(_masters["bias"]), "Master bias")
+        calstat += "B"
+    exptime, scale = _matching_dark(float(header["EXPTIME"]))
+    if exptime is not None:
+        data -= _master_images["dark"][exptime] * np.float32(scale)
+        header["MDARK"] = (os.path.basename(_masters["dark"][exptime]), "Master dark")
+        header["DARKSCL"] = (round(scale, 6), "Master dark scaled by")
+        calstat += "D"
+    flat = _master_images["flat"].get(header.get("FILTER"))
+    if flat is not None:
+        data /= flat
+        header["MFLAT"] = (
+            os.path.basename(_masters["flat"][header["FILTER"]]),
+            "Master flat",
+        )
+        calstat += "F"
+    header["CALSTAT"] = (calstat, "Calibrations applied")
+    # The raw frame's integer scaling does not apply to the float result
+    for key in ("BZERO", "BSCALE"):
+        header.remove(key, ignore_missing=True)
+    fits.PrimaryHDU(data=data, header=header).writeto(outpath, overwrite=True)
+    return calstat
+
+
+def calibrate_lights(basedir, targets=None, jobs=1, masters=None):
+    """
+    Calibrate the light frames of the night in `basedir`, `jobs` at a time.
+
+    Parameters
+    ----------
+    basedir : string
+        The night directory, with its catalog written by log.py.
+
+    targets : list of string, optional
+        Target subdirectories to calibrate; by default every target.
+
+    jobs : int
+        Worker processes calibrating frames.
+
+    masters : dict, optional
+        The masters to use, as returned by `build_masters`; by default
+        those already in DATE/DATE/Masters.
+
+    Light frames are written with the same name to
+    DATE/DATE/Calibrated/TARGET, ready for `make_wcs DATE/DATE/Calibrated
+    TARGET`.
+
+    Returns
+    -------
+    dict
+        The calibrated path (or None, if it failed) of each light frame.
+    """
+    basedir = os.path.normpath(basedir)
+    if masters is None:
+        masters = find_masters(basedir)
+    if not (masters["bias"] or masters["dark"] or masters["flat"]):
+        print(f"No master frames in {masters_dir(basedir)}: run masters first")
+        return {}
+    catalog = read_catalog(
+        os.path.join(basedir, os.path.basename(basedir) + CATALOG_SUFFIX)
+    )
+    outdir = calibrated_dir(basedir)
+    tasks = {}
+    for fpath in frame_paths(select(catalog, type="LIGHT")):
+        target = os.path.basename(os.path.dirname(fpath))
+        if targets and target not in targets:
+            continue
+        os.makedirs(os.path.join(outdir, target), exist_ok=True)
+        # Calibrated frames are float32, which compresses poorly, so they
+        # are written uncompressed
+        name = os.path.basename(fits_compress.uncompressed_name(fpath))
+        tasks[fpath] = os.path.join(outdir, target, name)
+
+    results = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_map_masters, initargs=(masters,)
+    ) as pool:
+        futures = {
+            pool.submit(calibrate_frame, fpath, outpath): fpath
+            for fpath, outpath in tasks.items()
+        }
+        for future in as_completed(futures):
+            fpath = futures[future]
+            try:
+                calstat = future.result()
+                results[fpath] = tasks[fpath]
+                print(f"[{len(results)}/{len(tasks)}] {fpath} ({calstat or 'none'})")
+            except Exception as e:
+                results[fpath] = None
+                print(f"[{len(results)}/{len(tasks)}] Error calibrating {fpath}: {e}")
+    n_done = sum(1 for outpath in results.values() if outpath)
+    print(
+        f"Calibrated {n_done} of {len(tasks)} light frames into {outdir} "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+    return results
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    if args["masters"]:
+        build_masters(
+            args["<basedir>"],
+            method=args["--method"],
+            sigma=float(args["--sigma"]),
+            jobs=int(args["--jobs"]),
+            memory=float(args["--memory"]),
+        )
+    elif args["lights"]:
+        calibrate_lights(
+            args["<basedir>"], targets=args["<target>"], jobs=int(args["--jobs"])
+        )
@@ -0,0 +1,219 @@
+"""
+Raw 2880-byte block access to FITS files.
+
+A FITS primary header is a run of 80-character cards in 2880-byte blocks,
+ending with the block that holds the END card; the data follow from the next
+block. Working on the blocks directly lets a header be read, or replaced,
+without decoding (or even reading) the image data behind it.
+"""
+
+import os
+import re
+import shutil
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+COPY_BUFSIZE = 1024 * 1024
+
+# Integer and real values, as the FITS standard writes them
+_INTEGER = re.compile(rb"[+-]?[0-9]+")
+_REAL = re.compile(rb"[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([EeDd][+-]?[0-9]+)?")
+
+
+def _is_end_block(block):
+    for i in range(0, BLOCK_SIZE, CARD_SIZE):
+        if block[i : i + 8] == b"END     ":
+            return True
+    return False
+
+
+def read_header_blocks(f):
+    """
+    Read the primary header blocks from the start of an open FITS stream,
+    stopping after the block holding the END card.
+
+    Returns the raw bytes read. Raises ValueError if the stream ends before
+    an END card is found.
+    """
+    blocks = []
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError("No END card found in FITS header")
+        blocks.append(block)
+        if _is_end_block(block):
+            return b"".join(blocks)
+
+
+def _card_value(card):
+    # The typed value of a card with a value indicator, as astropy would
+    # give it, for the common fixed and free formats: strings, logicals,
+    # integers and reals. Anything else raises ValueError.
+    if card[8:10] != b"= ":
+        raise ValueError(f"No value in card {card!r}")
+    field = card[10:].strip()
+    if field.startswith(b"'"):
+        # Quotes inside a string are doubled
+        end = 1
+        while True:
+            end = field.find(b"'", end)
+            if end < 0:
+                raise ValueError(f"Unterminated string in card {card!r}")
+            if field[end + 1 : end + 2] != b"'":
+                break
+            end += 2
+        value = field[1:end].replace(b"''", b"'").decode("ascii").rstrip()
+        # A long string continued on CONTINUE cards
+        if value.endswith("&"):
+            raise ValueError(f"Continued string in card {card!r}")
+        return value
+    field = field.split(b"/")[0].strip()
+    if field == b"T":
+        return True
+    if field == b"F":
+        return False
+    if _INTEGER.fullmatch(field):
+        return int(field)
+    # Reals may have a D exponent; complex and undefined values are left
+    # to astropy
+    if _REAL.fullmatch(field):
+        return float(field.replace(b"D", b"E").replace(b"d", b"e"))
+    raise ValueError(f"Unsupported value in card {card!r}")
+
+
+def read_keywords(fpath, keywords):
+    """
+    Read the values of `keywords` from the primary header of the FITS file
+    `fpath`, parsing the raw cards up to END instead of building an astropy
+    Header.
+
+    Values are typed as astropy types them (str, bool, int or float), with
+    the trailing spaces of strings removed. Raises ValueError for anything
+    this parser does not handle the way astropy would (no SIMPLE card, a
+    keyword given twice or in lower case, a non-ASCII card, a complex or
+    undefined value, a long string continued over CONTINUE cards), so the
+    caller can fall back to astropy.
+
+    Returns a dict of the keywords present.
+    """
+    wanted = {keyword.encode("ascii").ljust(8): keyword for keyword in keywords}
+    with open(fpath, "rb") as f:
+        header_bytes = read_header_blocks(f)
+    if not header_bytes.startswith(b"SIMPLE  = "):
+        raise ValueError(f"{fpath} does not start with a SIMPLE card")
+    values = {}
+    for i in range(0, len(header_bytes), CARD_SIZE):
+        card = header_bytes[i : i + CARD_SIZE]
+        name = card[:8]
+        if name == b"END     ":
+            break
+        if name not in wanted:
+            if name.upper() in wanted:
+                raise ValueError(f"Lower-case keyword in card {card!r}")
+            continue
+        keyword = wanted[name]
+        if keyword in values:
+            raise ValueError(f"{keyword} given twice in {fpath}")
+        if not card.isascii():
+            raise ValueError(f"Non-ASCII card {card!r}")
+        values[keyword] = _card_value(card)
+    return values
+
+
+def data_size(header_bytes):
+    """
+    Size in bytes of the data described by raw header blocks, from their
+    BITPIX, NAXISn, PCOUNT and GCOUNT cards, not counting the padding of the
+    last block.
+    """
+    values = {}
+    for i in range(0, len(header_bytes), CARD_SIZE):
+        card = header_bytes[i : i + CARD_SIZE]
+        keyword = card[:8].rstrip()
+        if keyword in (b"BITPIX", b"PCOUNT", b"GCOUNT") or keyword.startswith(b"NAXIS"):
+            values[keyword.decode("ascii")] = int(card[10:].split(b"/")[0])
+    if not values.get("NAXIS"):
+        return 0
+    size = 1
+    for n in range(1, values["NAXIS"] + 1):
+        size *= values[f"NAXIS{n}"]
+    # PCOUNT is the heap of a binary table, e.g. a tile-compressed image
+    return (
+        abs(values.get("BITPIX", 8))
+        // 8
+        * values.get("GCOUNT", 1)
+        * (size + values.get("PCOUNT", 0))
+    )
+
+
+def is_complete(fpath):
+    """
+    Whether the FITS file `fpath` holds every header it starts, and as much
+    data as each header describes; False for a file still being written.
+
+    A tile-compressed (.fz) file must also have reached its image extension,
+    as its primary HDU is empty.
+    """
+    n_hdus = 0
+    size = os.path.getsize(fpath)
+    with open(fpath, "rb") as f:
+        while f.tell() < size:
+            try:
+                header_bytes = read_header_blocks(f)
+            except ValueError:
+                return False
+            n_hdus += 1
+            nbytes = data_size(header_bytes)
+            if f.tell() + nbytes > size:
+                return False
+            # Data are padded to a whole block, except perhaps at the end
+            f.seek(min(f.tell() + -(-nbytes // BLOCK_SIZE) * BLOCK_SIZE, size))
+    return n_hdus > (1 if str(fpath).endswith(".fz") else 0)
+
+
+def _header_bytes(header, size=None):
+    # The header as raw blocks. With `size`, blank cards are inserted before
+    # END so that it fills exactly `size` bytes (a multiple of BLOCK_SIZE).
+    cards = header.tostring(endcard=False, padding=False)
+    if size is None:
+        size = (len(cards) // BLOCK_SIZE + 1) * BLOCK_SIZE
+    cards = cards.ljust(size - CARD_SIZE) + "END".ljust(CARD_SIZE)
+    return cards.encode("ascii")
+
+
+def copy_with_header(source, dest, header):
+    """
+    Write a copy of the FITS file `source` to `dest`, with its primary header
+    replaced by `header`.
+
+    The data (and any extensions) are copied byte for byte, so the image is
+    read and written once without being decoded or rescaled.
+    """
+    with open(source, "rb") as src:
+        read_header_blocks(src)
+        with open(dest, "wb") as dst:
+            dst.write(_header_bytes(header))
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
+def update_header(fpath, header):
+    """
+    Replace the primary header of the FITS file `fpath` with `header`.
+
+    If the new header fits in the blocks of the old one (FITS headers are
+    padded to 2880 bytes, so a few cards usually do), only the header blocks
+    are rewritten. Otherwise the file is rewritten through a temporary copy.
+
+    Returns True if the header was updated in place.
+    """
+    with open(fpath, "r+b") as f:
+        size = len(read_header_blocks(f))
+        cards = header.tostring(endcard=False, padding=False)
+        if len(cards) + CARD_SIZE <= size:
+            f.seek(0)
+            f.write(_header_bytes(header, size))
+            return True
+    tmp_path = f"{fpath}.tmp"
+    copy_with_header(fpath, tmp_path, header)
+    os.replace(tmp_path, fpath)
+    return False
@@ -0,0 +1,130 @@
+"""
+Lossless tile-compressed FITS frames (.fits.fz).
+
+A compressed frame is laid out as fpack writes it: an empty primary HDU,
+then a tile-compressed image extension holding the frame's header and data.
+Integer images, such as the SBIG's 16-bit frames, are compressed with RICE,
+which is lossless for integers and shrinks a typical raw frame two to three
+times. Float images, such as calibrated frames, use GZIP_2 without
+quantisation, which is lossless too but gains much less. Each row is its own
+tile, so a block of rows can be read without decompressing the whole image.
+
+Whether a frame is compressed is told by its name. `getheader`, `getdata`
+and `write_image` handle both kinds, so code using them works on either.
+astropy is only imported when a file is read or written, so that scripts
+which just look at names (e.g. rename_obs) start without it.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+COMPRESSED_SUFFIX = ".fz"
+
+
+def is_compressed(fpath):
+    """
+    Whether `fpath` names a tile-compressed frame.
+    """
+    return os.fspath(fpath).endswith(COMPRESSED_SUFFIX)
+
+
+def uncompressed_name(fpath):
+    """
+    `fpath` without the compression suffix, e.g. X.fits for X.fits.fz.
+    """
+    fpath = os.fspath(fpath)
+    return fpath[: -len(COMPRESSED_SUFFIX)] if is_compressed(fpath) else fpath
+
+
+def image_hdu(hdulist):
+    """
+    The HDU holding the image: the compressed extension of a .fits.fz file,
+    otherwise the primary HDU.
+    """
+    from astropy.io import fits
+
+    if len(hdulist) > 1 and isinstance(hdulist[1], fits.CompImageHDU):
+        return hdulist[1]
+    return hdulist[0]
+
+
+def getheader(fpath):
+    """
+    The image header of a frame, compressed or not.
+    """
+    from astropy.io import fits
+
+    if not is_compressed(fpath):
+        return fits.getheader(fpath)
+    with fits.open(fpath) as hdulist:
+        return image_hdu(hdulist).header.copy()
+
+
+def getdata(fpath, header=False):
+    """
+    The image of a frame, compressed or not, and its header if `header`.
+    """
+    from astropy.io import fits
+
+    if not is_compressed(fpath):
+        return fits.getdata(fpath, header=header)
+    with fits.open(fpath) as hdulist:
+        hdu = image_hdu(hdulist)
+        data = hdu.data
+        if header:
+            return data, hdu.header.copy()
+        return data
+
+
+def write_image(fpath, data, header=None):
+    """
+    Write a frame, tile-compressed if `fpath` ends in .fz.
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    if not is_compressed(fpath):
+        fits.PrimaryHDU(data=data, header=header).writeto(fpath, overwrite=True)
+        return
+    if np.issubdtype(data.dtype, np.integer):
+        options = dict(compression_type="RICE_1")
+    else:
+        options = dict(compression_type="GZIP_2", quantize_level=0.0)
+    fits.HDUList(
+        [fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header, **options)]
+    ).writeto(fpath, overwrite=True)
+
+
+def convert(source, dest):
+    """
+    Copy a frame to `dest`, compressing or decompressing it as the names
+    call for.
+
+    Returns the time taken in seconds.
+    """
+    start = time.perf_counter()
+    data, header = getdata(source, header=True)
+    write_image(dest, data, header)
+    return time.perf_counter() - start
+
+
+@contextmanager
+def uncompressed(fpath):
+    """
+    Context manager giving the path of an uncompressed copy of a frame, for
+    tools that only read plain FITS files. An uncompressed frame is given as
+    it is; otherwise a temporary copy is written next to it and removed
+    afterwards.
+    """
+    if not is_compressed(fpath):
+        yield fpath
+        return
+    directory, name = os.path.split(uncompressed_name(fpath))
+    tmp_path = os.path.join(directory, f".{os.getpid()}.{name}")
+    try:
+        convert(fpath, tmp_path)
+        yield tmp_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,251 @@
+"""
+Quick image-quality metrics of light frames, to keep poor frames away from
+the WCS solver.
+
+Each frame gets its sky background and noise, the number of stars found and
+their median FWHM and elongation. Everything is computed with whole-array
+NumPy operations, with no Python loop over pixels or stars, so a frame takes
+a fraction of a second, and `measure_frames` spreads the frames over
+`jobs` worker processes:
+
+- sky and noise are the median and the median absolute deviation (scaled to
+  a standard deviation) of every 4th pixel of every 4th row;
+- stars are the local maxima of the 3x3 box-smoothed image that stand
+  `threshold` times the (smoothed) noise above the sky, leaving out those
+  whose half-maximum area is a single pixel or two (hot pixels and cosmic
+  rays);
+- the FWHM of a star is the diameter of the circle with the area of its
+  pixels above half its peak, and its elongation is the ratio of the major
+  and minor axes from the second moments of those pixels. Trailed frames
+  have a large elongation, out-of-focus or poor-seeing frames a large FWHM,
+  and cloudy or empty frames few stars.
+
+log.py --quality writes the metrics to the night log and catalog, and
+make_wcs uses them to skip, or solve last, frames with too few stars or
+stars that are too broad or too elongated.
+
+Usage:
+    frame_quality (<fpath>...) [--jobs=N] [--threshold=SIGMA]
+
+Options:
+    --jobs=N -j N       # Worker processes measuring frames [default: 1]
+    --threshold=SIGMA   # Detection threshold in units of the noise
+                        # [default: 5]
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from docopt import docopt
+
+import fits_compress
+
+# Metrics of a frame, in the order they are logged
+METRICS = ("sky", "noise", "n_stars", "fwhm", "elongation")
+# Every SAMPLE_STEP-th pixel of every SAMPLE_STEP-th row is used for the
+# sky and noise
+SAMPLE_STEP = 4
+# Half-size of the box around each star used for its FWHM and shape
+STAR_RADIUS = 7
+# Stars with fewer pixels above half maximum are taken for hot pixels
+MIN_STAR_AREA = 3
+# Only the brightest stars are measured, to bound the time per frame
+MAX_STARS = 1000
+
+
+def _box_smooth(data):
+    # 3x3 box mean, for pixels 1:-1 of each axis
+    rows, cols = data.shape
+    total = np.zeros((rows - 2, cols - 2), dtype=np.float32)
+    for dy in range(3):
+        for dx in range(3):
+            total += data[dy : rows - 2 + dy, dx : cols - 2 + dx]
+    return total / 9
+
+
+def _local_maxima(image, border):
+    # (y, x) of the pixels of `image` higher than their 8 neighbours, at
+    # least `border` pixels from its edges. Ties go to the first pixel in
+    # reading order, so a flat-topped (saturated) star gives one peak.
+    rows, cols = image.shape
+    centre = image[border : rows - border, border : cols - border]
+    is_peak = np.ones(centre.shape, dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy == dx == 0:
+                continue
+            neighbour = image[
+                border + dy : rows - border + dy, border + dx : cols - border + dx
+            ]
+            if (dy, dx) < (0, 0):
+                is_peak &= centre > neighbour
+            else:
+                is_peak &= centre >= neighbour
+    y, x = np.nonzero(is_peak)
+    return y + border, x + border
+
+
+def _boxes(data, y, x, radius):
+    # A (stars, 2r+1, 2r+1) stack of the boxes of `data` around each (y, x)
+    offsets = np.arange(-radius, radius + 1)
+    return data[
+        y[:, None, None] + offsets[None, :, None],
+        x[:, None, None] + offsets[None, None, :],
+    ]
+
+
+def measure(data, threshold=5.0):
+    """
+    Image-quality metrics of one image.
+
+    Parameters
+    ----------
+    data : 2D array
+        The image.
+
+    threshold : float
+        Detection threshold for stars, in units of the noise.
+
+    Returns
+    -------
+    dict
+        "sky" and "noise" in counts, "n_stars" (counting at most
+        `MAX_STARS`), and the median "fwhm" in pixels and "elongation" of
+        the stars, NaN if there are none.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    sample = data[::SAMPLE_STEP, ::SAMPLE_STEP]
+    sky = float(np.median(sample))
+    noise = float(1.4826 * np.median(np.abs(sample - sky)))
+    metrics = dict(sky=sky, noise=noise, n_stars=0, fwhm=np.nan, elongation=np.nan)
+
+    # Smoothing lowers the noise of the sky three-fold
+    smoothed = _box_smooth(data)
+    y, x = _local_maxima(smoothed, STAR_RADIUS)
+    height = smoothed[y, x] - sky
+    detected = height > threshold * noise / 3
+    y, x, height = y[detected] + 1, x[detected] + 1, height[detected]
+    brightest = np.argsort(height)[::-1][:MAX_STARS]
+    y, x = y[brightest], x[brightest]
+    if len(y) == 0:
+        return metrics
+    # Centre each star on its brightest pixel, which a single hot pixel
+    # need not be the smoothed peak of
+    nearby = _boxes(data, y, x, 1).reshape(len(y), 9).argmax(axis=1)
+    y += nearby // 3 - 1
+    x += nearby % 3 - 1
+
+    boxes = _boxes(data, y, x, STAR_RADIUS) - sky
+    peak = boxes[:, STAR_RADIUS, STAR_RADIUS]
+    above = boxes > peak[:, None, None] / 2
+    area = above.sum(axis=(1, 2))
+    stars = area >= MIN_STAR_AREA
+    if not stars.any():
+        return metrics
+    above, boxes, area = above[stars], boxes[stars], area[stars]
+
+    # Second moments of the pixels above half maximum, weighted by flux
+    weights = np.where(above, boxes, 0)
+    total = weights.sum(axis=(1, 2))
+    offsets = np.arange(-STAR_RADIUS, STAR_RADIUS + 1)
+    dy = offsets[None, :, None]
+    dx = offsets[None, None, :]
+    my = (weights * dy).sum(axis=(1, 2)) / total
+    mx = (weights * dx).sum(axis=(1, 2)) / total
+    myy = (weights * dy**2).sum(axis=(1, 2)) / total - my**2
+    mxx = (weights * dx**2).sum(axis=(1, 2)) / total - mx**2
+    mxy = (weights * dy * dx).sum(axis=(1, 2)) / total - my * mx
+    # Eigenvalues of the moment matrix give the squared axes
+    half_trace = (mxx + myy) / 2
+    spread = np.sqrt(((mxx - myy) / 2) ** 2 + mxy**2)
+    major = half_trace + spread
+    minor = np.maximum(half_trace - spread, 1e-3)
+
+    metrics["n_stars"] = int(stars.sum())
+    metrics["fwhm"] = float(np.median(2 * np.sqrt(area / np.pi)))
+    metrics["elongation"] = float(np.median(np.sqrt(major / minor)))
+    return metrics
+
+
+def frame_quality(fpath, threshold=5.0):
+    """
+    `measure` the image of a FITS frame, compressed or not.
+    """
+    return measure(fits_compress.getdata(fpath), threshold=threshold)
+
+
+def _frame_quality_or_none(fpath, threshold):
+    # frame_quality, reporting a frame that cannot be measured instead of
+    # stopping the other workers
+    try:
+        return frame_quality(fpath, threshold)
+    except Exception as e:
+        print(f"Could not measure the quality of {fpath}: {e}")
+        return None
+
+
+def measure_frames(fpaths, jobs=1, threshold=5.0):
+    """
+    Metrics of many frames, spread across `jobs` worker processes.
+
+    Returns a dict of the metrics of each frame, by path. Frames that
+    cannot be read are left out.
+    """
+    fpaths = [str(fpath) for fpath in fpaths]
+    thresholds = [threshold] * len(fpaths)
+    if jobs > 1 and len(fpaths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_frame_quality_or_none, fpaths, thresholds))
+    else:
+        results = list(map(_frame_quality_or_none, fpaths, thresholds))
+    return {
+        fpath: metrics for fpath, metrics in zip(fpaths, results) if metrics is not None
+    }
+
+
+def failures(metrics, min_stars=0, max_fwhm=None, max_elongation=None):
+    """
+    Why a frame falls short of the thresholds given.
+
+    Returns a list of reasons, e.g. ["3 stars"], empty if the frame passes.
+    """
+    reasons = []
+    if metrics["n_stars"] < min_stars:
+        reasons.append(f"{metrics['n_stars']} stars")
+    if max_fwhm is not None and metrics["fwhm"] > max_fwhm:
+        reasons.append(f"FWHM {metrics['fwhm']:.1f} px")
+    if max_elongation is not None and metrics["elongation"] > max_elongation:
+        reasons.append(f"elongation {metrics['elongation']:.2f}")
+    return reasons
+
+
+def catalog_metrics(table):
+    """
+    The metrics of the measured frames in a night catalog read with
+    `night_catalog.read_catalog`, by absolute path.
+    """
+    from night_catalog import frame_paths
+
+    metrics = {}
+    for fpath, row in zip(frame_paths(table), table):
+        if row["n_stars"] >= 0:
+            metrics[os.path.abspath(fpath)] = {
+                name: row[name].item() for name in METRICS
+            }
+    return metrics
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    results = measure_frames(
+        args["<fpath>"],
+        jobs=int(args["--jobs"]),
+        threshold=float(args["--threshold"]),
+    )
+    print(f"{'File':<40} {'Sky':>8} {'Noise':>7} {'Stars':>5} {'FWHM':>5} {'Elong':>5}")
+    for fpath, metrics in results.items():
+        print(
+            f"{os.path.basename(fpath):<40} {metrics['sky']:>8.1f} "
+            f"{metrics['noise']:>7.1f} {metrics['n_stars']:>5} "
+            f"{metrics['fwhm']:>5.1f} {metrics['elongation']:>5.2f}"
+        )
@@ -0,0 +1,225 @@
+"""
+In-memory catalog of the FITS header keywords used to sort, rename and log
+one night of observations.
+
+Every file is opened once, header only, and the handful of keywords the
+scripts need are kept in a dict keyed by path. They are parsed from the raw
+header cards, so astropy is only needed for unusual or compressed headers.
+`rename_obs` and `log` look headers up here instead of re-opening each file
+at every stage, and tell the catalog when a file is moved so later lookups
+still hit.
+
+A catalog can also be backed by a JSON sidecar in the night directory
+(`CACHE_NAME`), keyed by path, size and modification time, so that re-running
+on a half-processed night only costs a stat call per unchanged file.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import fits_blocks
+import fits_compress
+
+# Header keywords used by rename_obs.sort_by_target, rename_obs.create_fpath
+# and the log writer.
+KEYWORDS = (
+    "IMAGETYP",
+    "OBJECT",
+    "FILTER",
+    "EXPTIME",
+    "DATE-OBS",
+    "OBJCTRA",
+    "OBJCTDEC",
+    "INSTRUME",
+)
+
+# Name of the header cache kept in the top directory of a night
+CACHE_NAME = ".header_cache.json"
+
+
+def read_header(fpath):
+    """
+    Read the catalogued keywords from the image header of a FITS file: the
+    primary header, or the image extension of a tile-compressed .fits.fz
+    file.
+
+    Only the header is read; the pixel data is never loaded. Plain frames
+    are parsed with `fits_blocks.read_keywords`, falling back to astropy.
+
+    Parameters
+    ----------
+    fpath : string or Path
+        The FITS file to read.
+
+    Returns
+    -------
+    dict
+        The keywords in `KEYWORDS` that are present in the header. Missing
+        keywords are left out, so lookups raise KeyError as they would on
+        the astropy Header.
+    """
+    # The cards are parsed straight from the header blocks, which is much
+    # quicker than building an astropy Header; astropy reads the headers of
+    # compressed frames and any header the parser does not handle
+    if not fits_compress.is_compressed(fpath):
+        try:
+            return fits_blocks.read_keywords(fpath, KEYWORDS)
+        except ValueError:
+            pass
+    return catalog_keywords(fits_compress.getheader(fpath))
+
+
+def catalog_keywords(header):
+    """
+    Pick the catalogued keywords out of a full astropy Header.
+    """
+    return {key: header[key] for key in KEYWORDS if key in header}
+
+
+def _file_stamp(fpath):
+    stat = os.stat(fpath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class HeaderCatalog:
+    """
+    Header keywords for every FITS file seen this night, keyed by path.
+
+    Parameters
+    ----------
+    cache_dir : string or Path, optional
+        Night directory holding the on-disk header cache. If given, cached
+        headers are reused for files whose size and mtime have not changed,
+        and `save` writes the catalog back.
+    """
+
+    def __init__(self, cache_dir=None):
+        self._headers = {}
+        self._stamps = {}
+        self._cached = {}
+        self.cache_path = None
+        self.n_cache_hits = 0
+        if cache_dir is not None:
+            self.cache_path = os.path.join(cache_dir, CACHE_NAME)
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        for relpath, (stamp, header) in entries.items():
+            self._cached[self._key(os.path.join(cache_dir, relpath))] = (
+                stamp,
+                header,
+            )
+
+    def save(self):
+        """
+        Write the catalog to the on-disk header cache, if there is one.
+
+        Only files seen this run are written, so entries for files that have
+        since been moved or deleted drop out of the cache.
+        """
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        entries = {
+            os.path.relpath(key, cache_dir): (self._stamps[key], header)
+            for key, header in self._headers.items()
+        }
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, default=str)
+        os.replace(tmp_path, self.cache_path)
+
+    @staticmethod
+    def _key(fpath):
+        return os.path.normpath(os.fspath(fpath))
+
+    def __contains__(self, fpath):
+        return self._key(fpath) in self._headers
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __getitem__(self, fpath):
+        return self.get(fpath)
+
+    def get(self, fpath):
+        """
+        Return the catalogued keywords for `fpath`, reading the header the
+        first time the file is seen.
+        """
+        key = self._key(fpath)
+        if key not in self._headers:
+            self.scan([fpath])
+        return self._headers[key]
+
+    def add(self, fpath, header):
+        """
+        Catalog keywords for `fpath` that were read some other way, e.g.
+        straight from a zip archive before the file was extracted.
+        """
+        key = self._key(fpath)
+        self._stamps[key] = _file_stamp(fpath)
+        self._headers[key] = header
+
+    def scan(self, fpaths, jobs=1):
+        """
+        Read the headers of all `fpaths` not yet in the catalog.
+
+        Parameters
+        ----------
+        fpaths : iterable of string or Path
+            The FITS files to read. Files with a valid entry in the on-disk
+            cache are taken from there instead.
+
+        jobs : int
+            Number of worker processes reading headers. With more than one
+            job, header parsing is spread across cores and slow disk reads
+            overlap.
+
+        Returns
+        -------
+        int
+            The number of headers read from FITS files.
+        """
+        todo = {}
+        for fpath in fpaths:
+            key = self._key(fpath)
+            if key in self._headers or key in todo:
+                continue
+            stamp = _file_stamp(fpath)
+            self._stamps[key] = stamp
+            cached = self._cached.pop(key, None)
+            if cached is not None and cached[0] == stamp:
+                self._headers[key] = cached[1]
+                self.n_cache_hits += 1
+            else:
+                todo[key] = fpath
+        fpaths = list(todo.values())
+        if jobs > 1 and len(fpaths) > 1:
+            chunksize = max(1, len(fpaths) // (4 * jobs))
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                headers = list(pool.map(read_header, fpaths, chunksize=chunksize))
+        else:
+            headers = [read_header(fpath) for fpath in fpaths]
+        for key, header in zip(todo, headers):
+            self._headers[key] = header
+        return len(fpaths)
+
+    def rename(self, old_fpath, new_fpath):
+        """
+        Record that `old_fpath` has been moved to `new_fpath`.
+        """
+        old_key = self._key(old_fpath)
+        header = self._headers.pop(old_key, None)
+        if header is not None:
+            new_key = self._key(new_fpath)
+            self._headers[new_key] = header
+            # A rename keeps size and mtime, so the stamp stays valid
+            self._stamps[new_key] = self._stamps.pop(old_key)
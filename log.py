@@ -5,73 +5,61 @@
 # Oct 2017: tyke version under astroconda using astropy.io.fits
 # Feb 2018: updated to unzip files first
 # Feb 2024: TO DO update using pathlib
+"""
+Usage:
+    log (<basedir>) [--jobs=N] [--no-cache] [--quiet] [--calibrate] [--profile]
+        [--compress] [--quality]
 
-import os, re, sys, glob, zipfile
-import rename_maxim
+Options:
+    --jobs=N -j N       # Worker processes reading FITS headers [default: 1]
+    --no-cache          # Ignore and do not write the night's header cache
+    --quiet -q          # Only report progress, not every directory and file
+    --calibrate         # Build master calibration frames and calibrate the
+                        # light frames after writing the log
+    --profile           # Time each stage and count its file I/O, writing the
+                        # report to <DATE>.profile.json
+    --compress          # Tile-compress the frames as they are sorted and
+                        # renamed, giving lossless .fits.fz files
+    --quality           # Measure the sky, noise, stars and FWHM of every
+                        # light frame, with --jobs processes, and add them
+                        # to the log and catalog
+"""
+
+import os, time
+from docopt import docopt
 import rename_obs
+import fits_compress
+import frame_quality
+import profiling
+from make_wcs import is_solved_output
+import zip_ingest
 from pathlib import Path
-from astropy.io import fits
-
-
-def main(basedir):
-    # dir='/Volumes/Astrophysics/Observations 2015-16/2016-02-10/DarkChiPer/'
-    # basefitsfiles = glob.glob('*.f*t*')
-    # level1fitsfiles = glob.glob('*/*.f*t*')
-    # To do: switch to os.walk to go through subdirectories
+import calibration
+from header_catalog import HeaderCatalog
+from night_catalog import CATALOG_SUFFIX, catalog_row, write_catalog
+from night_tree import NightTree, is_fits
+from rename_journal import RenameJournal
 
-    # basedir = basedir+'/'
+# Directories written by calibration.py, which are not part of the log
+CALIBRATION_DIRS = (calibration.MASTERS_DIR, calibration.CALIBRATED_DIR)
 
-    # First iteration to unzip if needed
-    for fname in os.listdir(basedir):
-        if fname.endswith(".zip"):
-            print("Unzipping %s" % fname)
-            zf = zipfile.ZipFile(basedir + "/" + fname, mode="r")
-            zf.extractall(path=basedir)
-            zf.close
-
-    # 2nd iteration to fix filenames
-    for root, dirs, fnames in os.walk(basedir, topdown=True):
-        subdir = root[len(basedir) :]
-        depth = subdir.count(os.path.sep)
-        print("root = %s, depth = %s" % (root, depth))
-        if depth >= 2:
-            continue
-        root = root + os.path.sep
-        # Find Fits files
-        # print 'ext =',ext
-        for fname in fnames:
-            (head, ext) = os.path.splitext(fname)
-            print("ext = %s" % ext)
-
-            match = re.match(r"\.f.*t.*", ext)
-            if match:
-
-                # Fix filenames with spaces and fix numbering so files sort
-                fname_new = rename_maxim.rename_maxim(head)
-                if fname_new != fname:
-                    print("Renaming to", root + fname_new)
-                    os.rename(root + fname, root + fname_new)
-
-        # TJH Added: Sort fits files into folder depending on their target
-        # Rename .fits files depending on header information
-        bad_paths = rename_obs.sort_by_target(root)
-
-    # 3rd iteration to rename .fits filenames
-    for root, dirs, fnames in os.walk(basedir, topdown=True):
-        rename_obs.process_folder(root)
 
-    # 4th iteration with sorted filenames to make log
+def is_frame(fname):
+    """
+    Whether `fname` is a frame to sort and log: a FITS file, but not a WCS
+    solution written by make_wcs.
+    """
+    return is_fits(fname) and not is_solved_output(fname)
 
-    misc_flag = False
 
-    log_path = os.path.normpath(basedir)
-    logname = os.path.basename(log_path) + ".log"
-    logfullname = log_path + f"/{logname}"
-    print(f"Creating log at {logfullname}")
-    log = open(logfullname, "w")
+def write_log_header(log, basedir, quality=False):
+    """
+    Write the title and column headings of the night log, with headings for
+    the image-quality metrics if `quality`.
+    """
     log.write("Log of FITS files in %s\n" % basedir)
     log.write(
-        "%-20s %-30s %-22s %-8s %-10s %-13s %-7s %-10s\n"
+        "%-20s %-30s %-22s %-8s %-10s %-13s %-7s %-10s"
         % (
             "Subdirectory",
             "File",
@@ -83,132 +71,381 @@ def main(basedir):
             "FILTER",
         )
     )
+    if quality:
+        log.write(" %8s %6s %5s %5s %5s" % ("SKY", "NOISE", "STARS", "FWHM", "ELONG"))
+    log.write("\n")
     log.write(
         "-------------------------------------------------------------------------------------------------\n"
     )
-    for root, dirs, fnames in os.walk(basedir, topdown=True):
-        subdir = root[len(basedir) :]
-        depth = subdir.count(os.path.sep)
-        print("root = %s, depth = %s" % (root, depth))
-        if depth >= 3:
-            continue
-        if "Misc" in root:
-            misc_flag = True
-            continue
-
-        root = root + os.path.sep
-        # Find Fits files
-        # print
-        #  'ext =',ext
-        for fname in sorted(fnames):
-            print("Working on fname", fname)
-            (head, ext) = os.path.splitext(fname)
-            match = re.match(r"\.f.*t.*", ext)
-            if match:
-                hdulist = fits.open(root + fname)
-                # Log images from new SBIG CCD, not Orion autoguider
-                if hdulist[0].header["INSTRUME"][:4] == "SBIG":
-                    if hdulist[0].header["IMAGETYP"] == "Dark Frame":
-                        log.write(
-                            "%-20s %-30s %-22s DARK     N/A         N/A          %-7.1f     N/A\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Bias Frame":
-                        log.write(
-                            "%-20s %-30s %-22s BIAS     N/A         N/A          %-7.1f     N/A\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Flat Field":
-                        log.write(
-                            "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "FLAT":
-                        log.write(
-                            "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Light Frame":
-                        # hdulist.info()
-                        log.write(
-                            "%-20s %-30s %-22s %-8s"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["OBJECT"],
-                            )
-                        )
-                        try:
-                            log.write(
-                                "%-10s %-13s"
-                                % (
-                                    hdulist[0].header["OBJCTRA"],
-                                    hdulist[0].header["OBJCTDEC"],
-                                )
-                            )
-                        except KeyError:
-                            log.write("  N/A         N/A          ")
-                        log.write(
-                            "%-7.1f %10s"
-                            % (
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                        log.write("\n")
-                    else:
-                        print(
-                            "IMAGETYP %s not known for %s"
-                            % (hdulist[0].header["IMAGETYP"], fname)
-                        )
-    if misc_flag:
-        subdir = "/Misc"
-        for fname in Path(basedir).joinpath("Misc").iterdir():
-            hdulist = fits.open(fname)
+
+
+def write_misc_entry(log, subdir, fname, header):
+    """
+    Write the log line of a frame sorted into Misc, whose type is unknown.
+    """
+    log.write(
+        "%-20s %-30s %-22s UNKNOWN     N/A         N/A          %-7.1f     %10s\n"
+        % (
+            subdir,
+            fname,
+            header["DATE-OBS"],
+            header["EXPTIME"],
+            header["FILTER"],
+        )
+    )
+
+
+def write_log_entry(log, subdir, fname, header, metrics=None):
+    """
+    Write one line of the night log for a FITS file, given its catalogued
+    header keywords, and its image-quality metrics if it is a light frame
+    that was measured.
+
+    Returns the frame type logged (LIGHT, DARK, BIAS or FLAT), or None if
+    the frame was not logged.
+    """
+    # Log images from new SBIG CCD, not Orion autoguider
+    if header["INSTRUME"][:4] == "SBIG":
+        if header["IMAGETYP"] == "Dark Frame":
+            log.write(
+                "%-20s %-30s %-22s DARK     N/A         N/A          %-7.1f     N/A\n"
+                % (
+                    subdir,
+                    fname,
+                    header["DATE-OBS"],
+                    header["EXPTIME"],
+                )
+            )
+            return "DARK"
+        elif header["IMAGETYP"] == "Bias Frame":
+            log.write(
+                "%-20s %-30s %-22s BIAS     N/A         N/A          %-7.1f     N/A\n"
+                % (
+                    subdir,
+                    fname,
+                    header["DATE-OBS"],
+                    header["EXPTIME"],
+                )
+            )
+            return "BIAS"
+        elif header["IMAGETYP"] == "Flat Field":
+            log.write(
+                "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
+                % (
+                    subdir,
+                    fname,
+                    header["DATE-OBS"],
+                    header["EXPTIME"],
+                    header["FILTER"],
+                )
+            )
+            return "FLAT"
+        elif header["IMAGETYP"] == "FLAT":
+            log.write(
+                "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
+                % (
+                    subdir,
+                    fname,
+                    header["DATE-OBS"],
+                    header["EXPTIME"],
+                    header["FILTER"],
+                )
+            )
+            return "FLAT"
+        elif header["IMAGETYP"] == "Light Frame":
             log.write(
-                "%-20s %-30s %-22s UNKNOWN     N/A         N/A          %-7.1f     %10s\n"
+                "%-20s %-30s %-22s %-8s"
                 % (
                     subdir,
-                    fname.name,
-                    hdulist[0].header["DATE-OBS"],
-                    hdulist[0].header["EXPTIME"],
-                    hdulist[0].header["FILTER"],
+                    fname,
+                    header["DATE-OBS"],
+                    header["OBJECT"],
+                )
+            )
+            try:
+                log.write(
+                    "%-10s %-13s"
+                    % (
+                        header["OBJCTRA"],
+                        header["OBJCTDEC"],
+                    )
+                )
+            except KeyError:
+                log.write("  N/A         N/A          ")
+            log.write(
+                "%-7.1f %10s"
+                % (
+                    header["EXPTIME"],
+                    header["FILTER"],
+                )
+            )
+            if metrics is not None:
+                log.write(
+                    " %8.1f %6.1f %5d %5.1f %5.2f"
+                    % (
+                        metrics["sky"],
+                        metrics["noise"],
+                        metrics["n_stars"],
+                        metrics["fwhm"],
+                        metrics["elongation"],
+                    )
+                )
+            log.write("\n")
+            return "LIGHT"
+        else:
+            print("IMAGETYP %s not known for %s" % (header["IMAGETYP"], fname))
+
+
+def main(
+    basedir,
+    jobs=1,
+    use_cache=True,
+    quiet=False,
+    calibrate=False,
+    profile=None,
+    compress=False,
+    quality=False,
+    on_sorted=None,
+):
+    # dir='/Volumes/Astrophysics/Observations 2015-16/2016-02-10/DarkChiPer/'
+    # basefitsfiles = glob.glob('*.f*t*')
+    # level1fitsfiles = glob.glob('*/*.f*t*')
+    # To do: switch to os.walk to go through subdirectories
+
+    # basedir = basedir+'/'
+
+    # `on_sorted`, if given, is called with each target (or image type)
+    # directory and the catalog as soon as its frames have been sorted and
+    # renamed, e.g. to start solving them while the rest of the night is
+    # processed.
+
+    # Stages are timed and their I/O counted only if profiling was asked for
+    if profile is None:
+        profile = profiling.Profile(enabled=False)
+
+    # Header keywords for every frame, read once and shared by all stages.
+    # Headers of files unchanged since the last run come from the cache.
+    catalog = HeaderCatalog(cache_dir=basedir if use_cache else None)
+    # Every rename below is journalled, so `rename_obs undo` can reverse it
+    journal = RenameJournal(basedir)
+
+    # First iteration to unzip if needed. FITS frames are written straight
+    # into their sorted subdirectories, with their headers catalogued.
+    with profile.stage("unzip"):
+        for fname in os.listdir(basedir):
+            if fname.endswith(".zip"):
+                print("Unzipping %s" % fname)
+                zip_ingest.ingest_zip(
+                    basedir + "/" + fname, basedir, catalog, jobs=jobs
                 )
+
+    # List the night once, down to the target subdirectories. Everything
+    # below works from this listing, updated as files are moved.
+    with profile.stage("list"):
+        tree = NightTree(basedir, max_depth=2)
+    if not quiet:
+        for root in tree.dirs():
+            print("root = %s, depth = %s" % (root, tree.depth[root]))
+
+    # Read every header once, spread across `jobs` worker processes
+    with profile.stage("read_headers"):
+        fits_list = [
+            f for root in tree.dirs() for f in tree.fits_files(root) if is_frame(f)
+        ]
+        start = time.perf_counter()
+        n_read = catalog.scan(fits_list, jobs=jobs)
+        elapsed = time.perf_counter() - start
+        if n_read:
+            print(
+                f"Read {n_read} headers in {elapsed:.2f} s "
+                f"({n_read / elapsed:.1f} files/s, {jobs} job(s))"
+            )
+        catalog.save()
+
+    # TJH Added: Sort fits files into folder depending on their target.
+    # Frames in the top two levels go to a subdirectory named after their
+    # target (or image type); frames already in one stay there, including
+    # frames in a BASEDIR/TARGET directory named after their own target.
+    with profile.stage("sort_and_rename"):
+        incoming = {}
+        for root in tree.dirs():
+            if tree.depth[root] >= 2:
+                continue
+            for fpath in tree.fits_files(root):
+                if not is_frame(fpath):
+                    continue
+                try:
+                    folder_name = rename_obs.target_folder(catalog.get(fpath))
+                except KeyError:
+                    print(f"{fpath} does not have requisite header info")
+                    folder_name = "Misc"
+                if tree.depth[root] == 1 and os.path.basename(root) == folder_name:
+                    folder = root
+                else:
+                    folder = os.path.join(root, folder_name)
+                incoming.setdefault(folder, []).append(fpath)
+        placed = {fpath for frames in incoming.values() for fpath in frames}
+        # Master and calibrated frames are neither renamed nor logged
+        folders = set(incoming)
+        folders.update(
+            root
+            for root in tree.dirs()
+            if tree.depth[root] >= 2 and os.path.basename(root) not in CALIBRATION_DIRS
+        )
+
+        # Rename .fits files depending on header information, moving each frame
+        # straight from where it was found to its final name. With --compress
+        # the move also compresses the frames not compressed yet.
+        n_compressed = size_before = size_after = 0
+        compress_time = 0.0
+        for folder in sorted(folders):
+            # The frames already in the folder are planned with the new
+            # ones, so the numbering carries on from them
+            frames = incoming.get(folder, [])
+            if folder in tree.files:
+                frames += [
+                    f
+                    for f in tree.fits_files(folder)
+                    if f.endswith((".fits", ".fits.fz"))
+                    and is_frame(f)
+                    and f not in placed
+                ]
+            plan = rename_obs.plan_renames(
+                frames, catalog, dest_dir=folder, compress=compress or None
+            )
+            os.makedirs(folder, exist_ok=True)
+            converted = [
+                (old, new)
+                for old, new in plan
+                if fits_compress.is_compressed(old) != fits_compress.is_compressed(new)
+            ]
+            size_before += sum(os.path.getsize(old) for old, new in converted)
+            start = time.perf_counter()
+            plan = rename_obs.apply_plan(plan, catalog, journal)
+            if converted:
+                compress_time += time.perf_counter() - start
+            n_compressed += len(converted)
+            size_after += sum(os.path.getsize(new) for old, new in converted)
+            tree.move(plan)
+            if not quiet:
+                for old_path, new_path in plan:
+                    print(f"Renaming {old_path} to {new_path}")
+            if on_sorted is not None:
+                on_sorted(folder, catalog)
+        catalog.save()
+        if n_compressed:
+            print(
+                f"Compressed {n_compressed} frames from {size_before / 1e6:.1f} MB "
+                f"to {size_after / 1e6:.1f} MB (ratio {size_after / size_before:.2f}) "
+                f"in {compress_time * 1000 / n_compressed:.0f} ms per frame"
             )
-    log.close()
+
+    # Image-quality metrics of the light frames, measured in parallel
+    metrics = {}
+    if quality:
+        with profile.stage("quality"):
+            lights = []
+            for root in tree.dirs():
+                if os.path.basename(root) in CALIBRATION_DIRS or "Misc" in root:
+                    continue
+                for fpath in tree.fits_files(root):
+                    if not is_frame(fpath):
+                        continue
+                    if catalog.get(fpath).get("IMAGETYP") == "Light Frame":
+                        lights.append(fpath)
+            start = time.perf_counter()
+            metrics = frame_quality.measure_frames(lights, jobs=jobs)
+            elapsed = time.perf_counter() - start
+            if lights:
+                print(
+                    f"Measured the quality of {len(metrics)} light frames in "
+                    f"{elapsed:.2f} s ({elapsed * 1000 / len(lights):.0f} ms per "
+                    f"frame, {jobs} job(s))"
+                )
+
+    # 4th iteration with sorted filenames to make log
+
+    misc_dirs = []
+    # Rows of the machine-readable catalog, written next to the log
+    rows = []
+
+    with profile.stage("write_log"):
+        log_path = os.path.normpath(basedir)
+        logname = os.path.basename(log_path) + ".log"
+        logfullname = log_path + f"/{logname}"
+        print(f"Creating log at {logfullname}")
+        log = open(logfullname, "w")
+        write_log_header(log, basedir, quality=quality)
+        for root in tree.dirs():
+            subdir = root[len(tree.basedir) :]
+            if os.path.basename(root) in CALIBRATION_DIRS:
+                continue
+            if "Misc" in root:
+                misc_dirs.append(root)
+                continue
+
+            # Find Fits files
+            for fname in sorted(tree.files[root]):
+                if not quiet:
+                    print("Working on fname", fname)
+                if is_frame(fname):
+                    fpath = os.path.join(root, fname)
+                    header = catalog.get(fpath)
+                    frame_metrics = metrics.get(fpath)
+                    frame_type = write_log_entry(
+                        log, subdir, fname, header, frame_metrics
+                    )
+                    if frame_type:
+                        rows.append(
+                            catalog_row(
+                                tree.basedir,
+                                subdir,
+                                fpath,
+                                header,
+                                frame_type,
+                                frame_metrics,
+                            )
+                        )
+        for misc_dir in misc_dirs:
+            subdir = "/Misc"
+            for fname in sorted(Path(misc_dir, f) for f in tree.files[misc_dir]):
+                header = catalog.get(fname)
+                write_misc_entry(log, subdir, fname.name, header)
+                rows.append(catalog_row(tree.basedir, subdir, fname, header, "UNKNOWN"))
+        log.close()
+        catalog_name = os.path.splitext(logfullname)[0] + CATALOG_SUFFIX
+        write_catalog(rows, catalog_name)
+        catalog.save()
+    if catalog.n_cache_hits:
+        print(f"Reused {catalog.n_cache_hits} cached headers")
     print("Written log to %s" % logfullname)
-    wcs_dir = glob.glob(basedir + "/*/")[0]
+    print("Written catalog to %s" % catalog_name)
+    wcs_dir = os.path.join(
+        tree.basedir,
+        min(d for d in tree.subdirs[tree.basedir] if not d.startswith(".")),
+    )
     rename_obs.list_wcs_targets(wcs_dir)
+    if calibrate:
+        with profile.stage("calibrate"):
+            masters = calibration.build_masters(basedir, jobs=jobs)
+            calibration.calibrate_lights(basedir, jobs=jobs, masters=masters)
+    if profile.enabled:
+        profile_name = os.path.splitext(logfullname)[0] + ".profile.json"
+        profile.write(profile_name)
+        profile.summary()
+        print("Written profile to %s" % profile_name)
+    return catalog_name
 
 
 if __name__ == "__main__":
-    # print "sys.argv = ", sys.argv
-    if len(sys.argv) > 0:
-        # run on directory given in command line
-        main(sys.argv[1])
-    else:
-        # or default to running on current directory
-        main(os.listdir("."))
+    args = docopt(__doc__)
+    main(
+        args["<basedir>"],
+        jobs=int(args["--jobs"]),
+        use_cache=not args["--no-cache"],
+        quiet=args["--quiet"],
+        calibrate=args["--calibrate"],
+        profile=profiling.Profile() if args["--profile"] else None,
+        compress=args["--compress"],
+        quality=args["--quality"],
+    )
@@ -0,0 +1,132 @@
+"""
+Run log.py on every night of a term, several nights at a time.
+
+Each night directory (a DATE/ directory named YYYY-MM-DD) under <topdir> is
+processed by log.main in its own worker process, so a night that fails is
+reported and the others carry on. The nights' catalogs are then merged into
+one table, <topdir>/<topdir name>.ecsv, with a `night` column, which can be
+queried with night_catalog.py like a single night's catalog.
+
+Usage:
+    log_batch (<topdir>) [--workers=N] [--jobs=N] [--no-cache] [--verbose]
+
+Options:
+    --workers=N -w N    # Nights processed at the same time [default: 4]
+    --jobs=N -j N       # Worker processes reading headers within each night
+                        # [default: 1]
+    --no-cache          # Ignore and do not write the nights' header caches
+    --verbose -v        # Print the full output of log.py for every night
+"""
+
+import contextlib
+import io
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from docopt import docopt
+
+import log
+from night_catalog import CATALOG_SUFFIX, combine_catalogs
+
+
+def find_nights(topdir):
+    """
+    The night directories (named YYYY-MM-DD) directly under `topdir`, in
+    date order.
+    """
+    return sorted(
+        entry.path
+        for entry in os.scandir(topdir)
+        if entry.is_dir() and re.fullmatch(r"\d{4}-\d{2}-\d{2}", entry.name)
+    )
+
+
+def process_night(basedir, jobs=1, use_cache=True):
+    """
+    Run log.main on one night, capturing its output.
+
+    Returns a dict with the night's "catalog" path (None if it failed),
+    "output" printed, "error" traceback (None if it succeeded) and
+    "elapsed" time in seconds.
+    """
+    output = io.StringIO()
+    start = time.perf_counter()
+    catalog_path = None
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            catalog_path = log.main(basedir, jobs=jobs, use_cache=use_cache, quiet=True)
+        except Exception:
+            error = traceback.format_exc()
+    return {
+        "catalog": catalog_path,
+        "output": output.getvalue(),
+        "error": error,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def process_term(topdir, workers=4, jobs=1, use_cache=True, verbose=False):
+    """
+    Process every night under `topdir` with up to `workers` nights at once,
+    then merge their catalogs.
+
+    Returns the path of the combined catalog and the list of nights that
+    failed.
+    """
+    nights = find_nights(topdir)
+    print(f"Found {len(nights)} nights in {topdir}")
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(process_night, night, jobs, use_cache): night
+            for night in nights
+        }
+        for future in as_completed(futures):
+            night = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                # The worker itself died, e.g. ran out of memory
+                result = {
+                    "catalog": None,
+                    "output": "",
+                    "error": traceback.format_exc(),
+                    "elapsed": 0.0,
+                }
+            results[night] = result
+            if verbose:
+                print(result["output"])
+            if result["error"]:
+                print(f"{night}: FAILED after {result['elapsed']:.1f} s")
+                print(result["error"])
+            else:
+                print(f"{night}: done in {result['elapsed']:.1f} s")
+
+    failed = [night for night in nights if results[night]["error"]]
+    catalogs = [results[night]["catalog"] for night in nights if night not in failed]
+    topdir = os.path.normpath(topdir)
+    combined_path = os.path.join(topdir, os.path.basename(topdir) + CATALOG_SUFFIX)
+    combined = combine_catalogs(catalogs, combined_path)
+    print(
+        f"Combined catalog of {len(combined)} frames from {len(catalogs)} nights "
+        f"written to {combined_path}"
+    )
+    if failed:
+        print(f"{len(failed)} nights failed: {', '.join(failed)}")
+    return combined_path, failed
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    combined_path, failed = process_term(
+        args["<topdir>"],
+        workers=int(args["--workers"]),
+        jobs=int(args["--jobs"]),
+        use_cache=not args["--no-cache"],
+        verbose=args["--verbose"],
+    )
+    if failed:
+        exit(1)
@@ -1,34 +1,275 @@
 """
 Usage:
-    make_wcs (<dir> TARGET)
+    make_wcs status (<dir> TARGET) [--output=MODE]
+    make_wcs (<dir> TARGET) [--jobs=N] [--retries=N] [--backend=NAME]
+             [--server=URL] [--api-key=KEY]
+             [--upload=MODE] [--sources=N] [--cache=DIR | --no-cache]
+             [--propagate] [--output=MODE] [--profile]
+             [--quality=MODE] [--min-stars=N] [--max-fwhm=PX]
+             [--max-elongation=E]
+
+Options:
+    --jobs=N -j N       # Frames solved concurrently [default: 1]
+    --retries=N         # Attempts per frame before giving up [default: 10]
+    --upload=MODE       # What is sent to the solver: "auto" (astroquery's
+                        # default), "image" (the whole FITS file) or
+                        # "sources" (locally extracted source list)
+                        # [default: auto]
+    --sources=N         # Brightest sources sent with --upload=sources
+                        # [default: 100]
+    --cache=DIR         # Directory of cached WCS solutions, by default
+                        # .wcs_cache inside <dir>
+    --no-cache          # Always ask the solver, and do not cache solutions
+    --propagate         # Solve one frame per pointing and filter remotely,
+                        # and shift its WCS onto the others locally
+    --output=MODE       # How solutions are written: "copy" (a _wcs.fits copy
+                        # of the frame), "compressed" (a tile-compressed
+                        # _wcs.fits.fz copy), "inplace" (added to the
+                        # frame's own header) or "sidecar" (a header-only
+                        # .wcs file) [default: copy]
+    --backend=NAME      # Solver: "nova" (Astrometry.net, or the --server
+                        # URL) or "local" (offline stand-in returning canned
+                        # solutions) [default: nova]
+    --quality=MODE      # What to do with frames falling short of the
+                        # quality thresholds: "last" (solve them after the
+                        # others), "skip" (do not submit them) or "off" (do
+                        # not measure frames) [default: last]
+    --min-stars=N       # Fewest stars a frame needs [default: 10]
+    --max-fwhm=PX       # Largest median star FWHM, in pixels
+    --max-elongation=E  # Largest median star elongation (major/minor axis),
+                        # e.g. 1.5 to catch trailed frames
+    --profile           # Time the run and every frame's wait for and time in
+                        # the solver, writing the report to
+                        # make_wcs.profile.json in the TARGET directory
+    --server=URL        # Astrometry.net-compatible server to use instead of
+                        # nova.astrometry.net, e.g. a self-hosted one or
+                        # standin_server.py
+    --api-key=KEY       # Astrometry.net API key, by default taken from
+                        # $ASTROMETRY_NET_API_KEY or astroquery's config
 """
 
-import glob
-from astroquery.exceptions import TimeoutError
-from astroquery.astrometry_net import AstrometryNet
 from astropy.io import fits
-from astropy.coordinates import SkyCoord, Angle
-import multiprocessing
-import copy
+from astropy.utils.exceptions import AstropyDeprecationWarning
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import os
 import sys
-from photutils.utils import NoDetectionsWarning
+import threading
+import time
+import numpy as np
 import warnings
 from docopt import docopt
 from pathlib import Path
 
+import fits_blocks
+import fits_compress
+import frame_quality
+import night_catalog
+import profiling
+import wcs_backends
+import wcs_cache
+import wcs_journal
+import wcs_propagate
+
+
+class _ThreadFilteredStdout:
+    # Stand-in for sys.stdout that drops writes from threads inside a
+    # HiddenPrints block and serialises everything else, since concurrent
+    # writes to the same text stream are not safe.
+    def __init__(self, stream):
+        self._stream = stream
+        self._write_lock = threading.Lock()
+
+    def write(self, text):
+        if getattr(HiddenPrints._local, "hidden", False):
+            return len(text)
+        with self._write_lock:
+            return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
 
 class HiddenPrints:
+    """
+    Suppress printing from the current thread. Prints from other threads
+    still appear, so concurrent solves can report progress.
+    """
+
+    _lock = threading.Lock()
+    _local = threading.local()
+    _n_users = 0
+    _original_stdout = None
+
+    @classmethod
+    def _install(cls):
+        with cls._lock:
+            if cls._n_users == 0:
+                cls._original_stdout = sys.stdout
+                sys.stdout = _ThreadFilteredStdout(sys.stdout)
+            cls._n_users += 1
+
+    @classmethod
+    def _uninstall(cls):
+        with cls._lock:
+            cls._n_users -= 1
+            if cls._n_users == 0:
+                sys.stdout = cls._original_stdout
+
+    @classmethod
+    @contextmanager
+    def threadsafe_stdout(cls):
+        """
+        Keep the filtered stdout in place for a whole block, so prints from
+        worker threads are serialised even when no thread is hiding.
+        """
+        cls._install()
+        try:
+            yield
+        finally:
+            cls._uninstall()
+
     def __enter__(self):
-        self._original_stdout = sys.stdout
-        sys.stdout = open(os.devnull, "w")
+        self._install()
+        HiddenPrints._local.hidden = True
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout.close()
-        sys.stdout = self._original_stdout
+        HiddenPrints._local.hidden = False
+        self._uninstall()
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def default_backend():
+    """
+    The nova.astrometry.net client, created on first use.
+    """
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = wcs_backends.nova_backend()
+        return _default_backend
+
+
+# Seconds to wait after an upload before recording its submission ID
+SUBMIT_TIMEOUT = 1
+
+# Set to make concurrent solves stop retrying, e.g. after Ctrl-C
+_stop = threading.Event()
+
+
+def _filter_solver_warnings():
+    warnings.filterwarnings(
+        "ignore", message="'datfix' made the change 'Set MJD-OBS to"
+    )
+    warnings.filterwarnings(
+        "error",
+        message="Sources were found, but none pass the sharpness, roundness",
+    )
+    warnings.filterwarnings("ignore", message="Removing photutils functionality")
+    warnings.filterwarnings("ignore", category=AstropyDeprecationWarning)
+
+
+def solved_path(source_image_name, output="copy"):
+    """
+    Path of the file holding the solution of a frame: its `_wcs.fits` copy
+    (`_wcs.fits.fz` if compressed, or the frame is), its `.wcs` sidecar, or
+    the frame itself if solved in place.
+    """
+    if output == "inplace":
+        return source_image_name
+    name = fits_compress.uncompressed_name(source_image_name)
+    if output == "sidecar":
+        return name.replace(".fits", ".wcs")
+    name = name.replace(".fits", "_wcs.fits")
+    if output == "compressed" or fits_compress.is_compressed(source_image_name):
+        name += fits_compress.COMPRESSED_SUFFIX
+    return name
+
+
+def is_solved_output(fpath):
+    """
+    Whether `fpath` is a `_wcs.fits` (or `_wcs.fits.fz`) file written by
+    make_wcs itself.
+    """
+    return str(fpath).endswith(("_wcs.fits", "_wcs.fits.fz"))
+
+
+def is_solved(source_image_name, output="copy"):
+    """
+    Whether a frame already has a solution written with `output`.
+    """
+    if output == "inplace":
+        header = fits_compress.getheader(source_image_name)
+        return bool(header.get("WCSSOLVE", False))
+    return os.path.exists(solved_path(source_image_name, output))
 
 
-def solve_wcs(source_image_name, target):
+def target_frames(workingdir):
+    """
+    The frames in a target directory, compressed or not, including any
+    `_wcs.fits` files (which `solve_all` passes over).
+    """
+    workingdir = Path(workingdir)
+    ccd_files = sorted(workingdir.glob("*.fits"))
+    ccd_files += sorted(workingdir.glob("*.fits.fz"))
+    return ccd_files
+
+
+def extract_sources(data, fwhm=5, detect_threshold=30, n_sources=100):
+    """
+    Find the brightest point sources in an image.
+
+    Parameters
+    ----------
+    data : 2D array
+        The image.
+
+    fwhm : float
+        FWHM of the stars in pixels.
+
+    detect_threshold : float
+        Detection threshold in units of the sigma-clipped background noise.
+
+    n_sources : int
+        Number of sources kept, brightest first.
+
+    Returns
+    -------
+    x, y, flux : arrays
+        1-indexed source positions (as Astrometry.net expects) and fluxes,
+        sorted by decreasing flux. Empty if nothing was detected.
+    """
+    from astropy.stats import sigma_clipped_stats
+    from photutils.detection import DAOStarFinder
+
+    mean, median, std = sigma_clipped_stats(data, sigma=3.0, maxiters=5)
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=detect_threshold * std)
+    sources = daofind(data - median)
+    if sources is None:
+        return np.empty(0), np.empty(0), np.empty(0)
+    flux = np.asarray(sources["flux"])
+    brightest = np.argsort(flux)[::-1][:n_sources]
+    x = np.asarray(sources["xcentroid"])[brightest] + 1
+    y = np.asarray(sources["ycentroid"])[brightest] + 1
+    return x, y, flux[brightest]
+
+
+def solve_wcs(
+    source_image_name,
+    target,
+    max_attempts=10,
+    backoff=5.0,
+    max_backoff=300.0,
+    upload="auto",
+    n_sources=100,
+    cache=None,
+    backend=None,
+    journal=None,
+    output="copy",
+):
     """
     Function to use astrometry.net to solve for the World Coordinate System
     of a given image.
@@ -42,68 +283,176 @@ def solve_wcs(source_image_name, target):
     target : string
         The name of the object being WCS corrected
 
+    max_attempts : int
+        Number of times the submission is checked (or resubmitted after a
+        network error) before giving up.
+
+    backoff : float
+        Seconds to wait before the first retry. The wait doubles with each
+        further retry, up to `max_backoff`.
+
+    max_backoff : float
+        Longest wait between retries, in seconds.
+
+    upload : string
+        "auto" lets astroquery decide what to upload, "image" uploads the
+        whole FITS file, and "sources" extracts sources locally and submits
+        only the brightest `n_sources` positions.
+
+    n_sources : int
+        Number of sources submitted with upload="sources".
+
+    cache : WCSCache, optional
+        Cache of earlier solutions. A frame found in the cache is written
+        out without contacting the solver, and new solutions are added.
+
+    backend : solver backend, optional
+        Where frames are solved (see wcs_backends). Defaults to
+        nova.astrometry.net.
+
+    journal : WCSJournal, optional
+        Journal of submissions. The submission ID is recorded as soon as the
+        frame is uploaded, and a frame left in the remote queue by an
+        earlier, interrupted run is monitored again instead of re-uploaded.
+
+    output : string
+        How the solution is written; see `write_solved`.
+
+    Returns
+    -------
+    string or None
+        The path of the file holding the solution, or None if no solution
+        was found.
     """
+    # Only needed when solving, so kept out of the module imports to keep
+    # startup quick for scripts that import make_wcs
+    from astropy.coordinates import Angle
+    from astroquery.exceptions import TimeoutError
+    from photutils.utils import NoDetectionsWarning
+    from requests.exceptions import RequestException
+
+    if backend is None:
+        backend = default_backend()
     try_again = True
     submission_id = None
     n_submissions = 0
     wcs_header = None
 
     # Get the nominal RA / DEC.
-    source_image = fits.open(source_image_name)
-    ra = Angle(source_image[0].header["OBJCTRA"] + " hours")
-    dec = Angle(source_image[0].header["OBJCTDEC"] + " degrees")
+    source_header = fits_compress.getheader(source_image_name)
+    ra = Angle(source_header["OBJCTRA"] + " hours")
+    dec = Angle(source_header["OBJCTDEC"] + " degrees")
+    settings = dict(
+        center_ra=ra.degree,
+        center_dec=dec.degree,
+        radius=0.5,
+        publicly_visible="n",
+        allow_modifications="n",
+        allow_commercial_use="n",
+        scale_units="arcsecperpix",
+        scale_type="ev",
+        scale_est=1,
+        scale_err=25,
+        parity=1,
+        positional_error=2,
+        solve_timeout=120,
+    )
+
+    if cache is not None:
+        cache_key = wcs_cache.frame_key(source_image_name)
+        wcs_header = cache.get(cache_key)
+        if wcs_header is not None:
+            print(f"\tFound {source_image_name} in WCS cache")
+            try_again = False
+            journal = None
+
+    if try_again and journal is not None:
+        entry = journal.get(source_image_name)
+        if entry and entry["state"] == wcs_journal.SUBMITTED:
+            submission_id = entry["submission_id"]
+            print(f"Resuming submission {submission_id} for {source_image_name}")
 
     with warnings.catch_warnings():
-        warnings.filterwarnings(
-            "ignore", message="'datfix' made the change 'Set MJD-OBS to"
-        )
-        warnings.filterwarnings(
-            "error",
-            message="Sources were found, but none pass the sharpness, roundness",
-        )
-        warnings.filterwarnings("ignore", message="Removing photutils functionality")
-        while try_again:
-            if n_submissions == 0:
+        _filter_solver_warnings()
+        needs_upload = try_again and not submission_id
+        if needs_upload and upload == "sources":
+            # Extract once, locally; every attempt then only sends positions
+            data = fits_compress.getdata(source_image_name)
+            start = time.perf_counter()
+            x, y, flux = extract_sources(data, n_sources=n_sources)
+            elapsed = time.perf_counter() - start
+            print(f"\tExtracted {len(x)} sources in {elapsed * 1000:.0f} ms")
+            if len(x) == 0:
+                print(
+                    "                    No Detections in {}".format(source_image_name)
+                )
+                return None
+        elif needs_upload and upload == "image":
+            size = os.path.getsize(source_image_name)
+            print(f"\tUploading {size / 1e6:.1f} MB image")
+        while try_again and not _stop.is_set():
+            if n_submissions == 0 and not submission_id:
                 print("Trying {}".format(source_image_name))
-            else:
+            elif n_submissions > 0:
                 print("    Trying {} again".format(source_image_name))
-            if n_submissions > 9:
+            if n_submissions >= max_attempts - 1:
                 try_again = False
+            if n_submissions > 0:
+                _stop.wait(min(max_backoff, backoff * 2 ** (n_submissions - 1)))
             try:
                 if not submission_id:
                     # astroquery's astrometry.net monitor_submission prints
                     # once every second while monitoring, so we suppress these
                     # print statements with the above class from
                     # https://stackoverflow.com/questions/8391411/how-to-block-calls-to-print.
+                    # When journalling, stop waiting soon after the upload so
+                    # the submission ID can be recorded before the long wait
+                    if journal is not None:
+                        settings["solve_timeout"] = SUBMIT_TIMEOUT
                     with HiddenPrints():
-                        wcs_header = ast.solve_from_image(
-                            source_image_name,
-                            center_ra=ra.degree,
-                            center_dec=dec.degree,
-                            radius=0.5,
-                            fwhm=5,
-                            detect_threshold=30,
-                            publicly_visible="n",
-                            allow_modifications="n",
-                            allow_commercial_use="n",
-                            scale_units="arcsecperpix",
-                            scale_type="ev",
-                            scale_est=1,
-                            scale_err=25,
-                            parity=1,
-                            positional_error=2,
-                            submission_id=submission_id,
-                            solve_timeout=120,
-                        )
+                        if upload == "sources":
+                            wcs_header = backend.solve_from_source_list(
+                                x,
+                                y,
+                                data.shape[1],
+                                data.shape[0],
+                                **settings,
+                            )
+                        else:
+                            # The solver only reads plain FITS files
+                            with fits_compress.uncompressed(
+                                source_image_name
+                            ) as image_name:
+                                wcs_header = backend.solve_from_image(
+                                    image_name,
+                                    force_image_upload=upload == "image",
+                                    fwhm=5,
+                                    detect_threshold=30,
+                                    **settings,
+                                )
                 else:
                     with HiddenPrints():
-                        wcs_header = ast.monitor_submission(
+                        wcs_header = backend.monitor_submission(
                             submission_id, solve_timeout=120
                         )
             except TimeoutError as e:
-                print(f"\tsubmission {n_submissions} timed out. Resubmitting.")
+                if journal is not None and not submission_id:
+                    submission_id = e.args[1]
+                    journal.record(
+                        source_image_name, wcs_journal.SUBMITTED, submission_id
+                    )
+                    # Recording the submission is not an attempt, so the
+                    # last attempt still goes on to monitor it
+                    try_again = True
+                    continue
+                print(f"\tsubmission {n_submissions} timed out. Checking again.")
                 submission_id = e.args[1]
                 n_submissions += 1
+            except RequestException as e:
+                # Network trouble rather than a failed fit, so retry the
+                # upload (or the monitoring, if it was already submitted)
+                print(f"\tattempt {n_submissions} failed ({e}). Retrying.")
+                n_submissions += 1
             except NoDetectionsWarning:
                 print("                    No Detections in {}".format(source_image_name))
                 try_again = False
@@ -125,18 +474,424 @@ def solve_wcs(source_image_name, target):
                 else:
                     print(f"\tFinished {source_image_name}")
 
+    if journal is not None:
+        if wcs_header:
+            journal.record(source_image_name, wcs_journal.SOLVED, submission_id)
+        elif not _stop.is_set():
+            # An interrupted frame stays "submitted", to be resumed
+            journal.record(source_image_name, wcs_journal.FAILED, submission_id)
     if wcs_header:
-        solved_image_name = source_image_name.replace(".fits", "_wcs.fits")
-        source_image = fits.open(source_image_name)
-        source_image_data = source_image[0].data
-        source_image_head = source_image[0].header
-        source_image.close()
-        solved_image_head = copy.copy(source_image_head)
+        if cache is not None:
+            cache.put(cache_key, wcs_header)
+        return write_solved(source_image_name, wcs_header, output=output)
+    return None
+
+
+def write_solved(source_image_name, wcs_header, extra_cards=(), output="copy"):
+    """
+    Write the WCS solution of a frame.
+
+    Parameters
+    ----------
+    source_image_name : string
+        The frame that was solved.
+
+    wcs_header : Header
+        The WCS cards to add.
+
+    extra_cards : sequence of (keyword, value, comment)
+        Further cards to add, e.g. to record how the WCS was found.
+
+    output : string
+        "copy" writes a `_wcs.fits` copy of the frame with the cards added to
+        its header, streaming the data across unchanged. "compressed" writes
+        a lossless tile-compressed `_wcs.fits.fz` copy instead. "inplace"
+        adds the cards to the frame's own header, rewriting only the header
+        blocks when the new cards fit in its padding. "sidecar" writes just
+        the cards to a header-only `.wcs` file next to the frame, as
+        Astrometry.net does. A compressed frame is always rewritten
+        compressed, as its data cannot be streamed across unchanged.
+
+    Returns
+    -------
+    string
+        The path of the file holding the solution.
+    """
+    solved_image_name = solved_path(source_image_name, output)
+    if output == "sidecar":
+        solved_image_head = fits.Header(wcs_header)
+    else:
+        solved_image_head = fits_compress.getheader(source_image_name)
         solved_image_head.extend(wcs_header)
-        hdu = fits.PrimaryHDU(data=source_image_data, header=solved_image_head)
-        hdu.header["WCSSolve"] = True  # Add a new line of info in the HEADER.
-        hdu.writeto(solved_image_name, overwrite=True)
-        print(f"\t\tWrote to {solved_image_name}")
+    solved_image_head["WCSSolve"] = True  # Add a new line of info in the HEADER.
+    for card in extra_cards:
+        solved_image_head.append(card)
+    if output == "sidecar":
+        fits.PrimaryHDU(header=solved_image_head).writeto(
+            solved_image_name, overwrite=True
+        )
+    elif fits_compress.is_compressed(solved_image_name):
+        start = time.perf_counter()
+        fits_compress.write_image(
+            solved_image_name,
+            fits_compress.getdata(source_image_name),
+            solved_image_head,
+        )
+        elapsed = time.perf_counter() - start
+        print(f"\t\tCompressed in {elapsed * 1000:.0f} ms")
+    elif output == "inplace":
+        fits_blocks.update_header(source_image_name, solved_image_head)
+    else:
+        fits_blocks.copy_with_header(
+            source_image_name, solved_image_name, solved_image_head
+        )
+    print(f"\t\tWrote to {solved_image_name}")
+    return solved_image_name
+
+
+def propagate_wcs(
+    ref_image_name, ref_solved_name, source_image_name, ref_data=None, output="copy"
+):
+    """
+    Give a frame the WCS of a solved reference frame at the same pointing,
+    shifted by the offset measured between the two images.
+
+    Parameters
+    ----------
+    ref_image_name : string
+        The reference frame.
+
+    ref_solved_name : string
+        The file holding the solution of the reference frame.
+
+    source_image_name : string
+        The frame to give a WCS.
+
+    ref_data : 2D array, optional
+        The reference image, if already loaded.
+
+    output : string
+        How the solution is written; see `write_solved`.
+
+    Returns
+    -------
+    string or None
+        The path of the file holding the solution, or None if the frames did
+        not match well enough to trust the shift.
+    """
+    if ref_data is None:
+        ref_data = fits_compress.getdata(ref_image_name)
+    data = fits_compress.getdata(source_image_name)
+    if data.shape != ref_data.shape:
+        return None
+    start = time.perf_counter()
+    dx, dy, significance = wcs_propagate.measure_shift(ref_data, data)
+    elapsed = time.perf_counter() - start
+    if significance < wcs_propagate.MIN_SIGNIFICANCE:
+        print(
+            f"\tPoor match between {source_image_name} and {ref_image_name} "
+            f"(peak {significance:.1f} sigma), solving remotely"
+        )
+        return None
+    print(
+        f"\tShifted WCS of {ref_image_name} by ({dx:.2f}, {dy:.2f}) px "
+        f"for {source_image_name} in {elapsed * 1000:.0f} ms"
+    )
+    wcs_header = wcs_propagate.shifted_wcs_header(
+        fits_compress.getheader(ref_solved_name), dx, dy
+    )
+    return write_solved(
+        source_image_name,
+        wcs_header,
+        extra_cards=[
+            ("WCSREF", os.path.basename(ref_image_name), "WCS shifted from"),
+            ("WCSDX", round(dx, 3), "[pix] x shift from WCSREF"),
+            ("WCSDY", round(dy, 3), "[pix] y shift from WCSREF"),
+        ],
+        output=output,
+    )
+
+
+def _timed_solve(profile, submitted, source_image_name, target, **kwargs):
+    # solve_wcs, recording how long the frame waited for a free worker and
+    # how long it then took to solve
+    start = time.perf_counter()
+    solved = None
+    try:
+        solved = solve_wcs(source_image_name, target, **kwargs)
+        return solved
+    finally:
+        profile.record_frame(
+            file=source_image_name,
+            method="solver",
+            queued_s=start - submitted,
+            solve_s=time.perf_counter() - start,
+            solved=bool(solved),
+        )
+
+
+def order_by_quality(
+    fpaths,
+    mode="last",
+    metrics=None,
+    jobs=1,
+    min_stars=10,
+    max_fwhm=None,
+    max_elongation=None,
+):
+    """
+    Sort out the frames that fall short of the quality thresholds, so they
+    are solved last or not at all.
+
+    Parameters
+    ----------
+    fpaths : list of string
+        The frames, in the order they would be solved.
+
+    mode : string
+        "last" puts the poor frames after the others; "skip" leaves them
+        out.
+
+    metrics : dict, optional
+        Metrics already measured, e.g. read from the night catalog by
+        `frame_quality.catalog_metrics`, by absolute path. Other frames are
+        measured with `jobs` worker processes.
+
+    min_stars, max_fwhm, max_elongation
+        The thresholds; see `frame_quality.failures`.
+
+    Returns
+    -------
+    list of string
+        The frames to solve, in order.
+    """
+    metrics = dict(metrics or {})
+    unmeasured = [f for f in fpaths if os.path.abspath(f) not in metrics]
+    if unmeasured:
+        start = time.perf_counter()
+        for fpath, frame_metrics in frame_quality.measure_frames(
+            unmeasured, jobs=jobs
+        ).items():
+            metrics[os.path.abspath(fpath)] = frame_metrics
+        elapsed = time.perf_counter() - start
+        print(
+            f"Measured the quality of {len(unmeasured)} frames in {elapsed:.2f} s "
+            f"({elapsed * 1000 / len(unmeasured):.0f} ms per frame)"
+        )
+    good = []
+    poor = []
+    for fpath in fpaths:
+        frame_metrics = metrics.get(os.path.abspath(fpath))
+        if frame_metrics is None:
+            # Could not be measured, so leave it to the solver
+            good.append(fpath)
+            continue
+        reasons = frame_quality.failures(
+            frame_metrics,
+            min_stars=min_stars,
+            max_fwhm=max_fwhm,
+            max_elongation=max_elongation,
+        )
+        if reasons:
+            action = "solving last" if mode == "last" else "skipping"
+            print(f"Poor frame {fpath} ({', '.join(reasons)}): {action}")
+            poor.append(fpath)
+        else:
+            good.append(fpath)
+    if poor:
+        print(f"{len(poor)} of {len(fpaths)} frames fall short of the thresholds")
+    return good + poor if mode == "last" else good
+
+
+def solve_all(
+    ccd_files,
+    target,
+    jobs=1,
+    propagate=False,
+    output="copy",
+    profile=None,
+    quality="off",
+    quality_metrics=None,
+    min_stars=10,
+    max_fwhm=None,
+    max_elongation=None,
+    **kwargs,
+):
+    """
+    Solve the WCS of many frames, with up to `jobs` submissions in flight at
+    once, printing a running summary as each frame finishes.
+
+    Parameters
+    ----------
+    ccd_files : list of string or Path
+        The frames to solve.
+
+    target : string
+        The name of the object being WCS corrected
+
+    jobs : int
+        Maximum number of frames being solved at the same time.
+
+    propagate : bool
+        If True, only the first frame of each pointing (OBJCTRA, OBJCTDEC and
+        FILTER) is sent to the solver. The others get its WCS shifted by the
+        offset measured locally between the images, falling back to a
+        remote solve when the images do not match well.
+
+    output : string
+        How solutions are written; see `write_solved`.
+
+    profile : Profile, optional
+        Records the time of each stage and each frame's queue and solve
+        latency.
+
+    quality : string
+        "last" or "skip" to measure the frames first and solve those that
+        fall short of the quality thresholds last, or not at all; see
+        `order_by_quality`. "off" solves every frame in order.
+
+    quality_metrics : dict, optional
+        Metrics of frames already measured, by absolute path.
+
+    min_stars, max_fwhm, max_elongation
+        The quality thresholds; see `frame_quality.failures`.
+
+    **kwargs
+        Passed on to `solve_wcs`.
+
+    Frames that already have a solution written with `output` are skipped,
+    as are the `_wcs.fits` files themselves.
+
+    Returns
+    -------
+    dict
+        The solved image path (or None) for each frame, including poor
+        frames skipped with quality="skip".
+    """
+    if profile is None:
+        profile = profiling.Profile(enabled=False)
+    results = {}
+    n_solved = 0
+    n_propagated = 0
+    # The cache may be shared with other targets, so only this call's
+    # lookups are reported
+    cache = kwargs.get("cache")
+    if cache is not None:
+        hits_before, misses_before = cache.n_hits, cache.n_misses
+    todo = []
+    with profile.stage("check_solved"):
+        for file in ccd_files:
+            file = str(file)
+            if is_solved_output(file):
+                continue
+            if is_solved(file, output):
+                print(f"Skipping {file}: already solved")
+                results[file] = solved_path(file, output)
+            else:
+                todo.append(file)
+    n_skipped = len(results)
+    poor = []
+    if quality != "off" and todo:
+        with profile.stage("quality"):
+            ordered = order_by_quality(
+                todo,
+                mode=quality,
+                metrics=quality_metrics,
+                jobs=jobs,
+                min_stars=min_stars,
+                max_fwhm=max_fwhm,
+                max_elongation=max_elongation,
+            )
+        kept = set(ordered)
+        poor = [file for file in todo if file not in kept]
+        todo = ordered
+    with profile.stage("group"):
+        if propagate:
+            groups = wcs_propagate.group_by_pointing(todo)
+        else:
+            groups = [[file] for file in todo]
+    start = time.perf_counter()
+    # warnings.catch_warnings is not thread-safe, so the filters are also set
+    # once around the whole pool; the per-thread copies then all agree.
+    with (
+        profile.stage("solve"),
+        warnings.catch_warnings(),
+        HiddenPrints.threadsafe_stdout(),
+        ThreadPoolExecutor(max_workers=jobs) as pool,
+    ):
+        _filter_solver_warnings()
+
+        def submit(file):
+            return pool.submit(
+                _timed_solve,
+                profile,
+                time.perf_counter(),
+                file,
+                target,
+                output=output,
+                **kwargs,
+            )
+
+        # Each future solves the first frame of a group; the rest of the
+        # group is then propagated from it, or resubmitted on its own.
+        pending = {submit(group[0]): group for group in groups}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    group = pending.pop(future)
+                    ref = group[0]
+                    try:
+                        results[ref] = future.result()
+                    except Exception as e:
+                        print(f"\tError solving {ref}: {e}")
+                        results[ref] = None
+                    if results[ref]:
+                        n_solved += 1
+                    ref_data = fits_compress.getdata(ref) if results[ref] else None
+                    for file in group[1:]:
+                        solved = None
+                        if results[ref]:
+                            propagate_start = time.perf_counter()
+                            solved = propagate_wcs(
+                                ref, results[ref], file, ref_data, output=output
+                            )
+                            profile.record_frame(
+                                file=file,
+                                method="propagated",
+                                solve_s=time.perf_counter() - propagate_start,
+                                solved=bool(solved),
+                            )
+                        if solved:
+                            results[file] = solved
+                            n_solved += 1
+                            n_propagated += 1
+                        else:
+                            pending[submit(file)] = [file]
+                n_done = len(results) - n_skipped
+                print(
+                    f"[{n_done}/{len(todo)}] solved {n_solved} "
+                    f"({n_propagated} locally), "
+                    f"failed {n_done - n_solved}, "
+                    f"{min(jobs, len(pending))} in flight, "
+                    f"{time.perf_counter() - start:.0f} s elapsed"
+                )
+        except KeyboardInterrupt:
+            print("Interrupted: waiting for solves in flight to finish")
+            _stop.set()
+            pool.shutdown(cancel_futures=True)
+            exit()
+    if cache is not None:
+        print(
+            f"WCS cache: {cache.n_hits - hits_before} hits, "
+            f"{cache.n_misses - misses_before} misses"
+        )
+    if n_skipped:
+        print(f"{n_skipped} frames were already solved")
+    if poor:
+        print(f"{len(poor)} poor frames were not submitted")
+        results.update(dict.fromkeys(poor))
+    return results
 
 
 if __name__ == "__main__":
@@ -158,22 +913,71 @@ if __name__ == "__main__":
     #     os.makedirs(workingdir, exist_ok=True)
 
     # ccd_files = glob.glob(workingdir + "*.fits")
-    ccd_files = workingdir.glob("*.fits")
+    ccd_files = target_frames(workingdir)
+    journal = wcs_journal.WCSJournal(workingdir)
 
-    # # Set the second number to your desired parallelisation count.
-    # # Having multiple connections open to astrometry.net may not work
-    # # anymore -- setting n_pool = 1 seems to be fine, though.
+    if args["status"]:
+        frames = [str(f) for f in ccd_files if not is_solved_output(f)]
+        states = journal.summary(
+            frames, lambda fpath: is_solved(fpath, args["--output"])
+        )
+        for state in ("solved", "pending", "failed", "new"):
+            print(f"{state}: {len(states[state])}")
+        for state in ("pending", "failed"):
+            for fpath in states[state]:
+                entry = journal.get(fpath)
+                print(
+                    f"\t{state} {os.path.basename(fpath)}"
+                    f" (submission {entry['submission_id']}, {entry['time']})"
+                )
+        sys.exit()
+
+    try:
+        backend = wcs_backends.make_backend(
+            args["--backend"], server=args["--server"], api_key=args["--api-key"]
+        )
+    except (RuntimeError, ValueError) as e:
+        sys.exit(str(e))
 
-    # # n_pool = min(multiprocessing.cpu_count(), 2)
-    # # pool = multiprocessing.Pool(n_pool)
-    # # for _ in pool.imap_unordered(solve_wcs, ccd_files, chunksize=len(ccd_files) // n_pool):
-    # #     pass
-    # # pool.close()
-    ast = AstrometryNet()
-    ast.api_key = "dftcsswtydizkjix"
+    cache = None
+    if not args["--no-cache"]:
+        cache_dir = args["--cache"] or Path(basedir).joinpath(wcs_cache.CACHE_NAME)
+        cache = wcs_cache.WCSCache(cache_dir)
 
-    for file in ccd_files:
-        solve_wcs(str(file), target)
+    # Quality metrics measured by log.py --quality are read from the night
+    # catalog, DATE/DATE.ecsv, rather than measured again
+    quality_metrics = None
+    night_dir = Path(basedir).resolve().parent
+    catalog_path = night_dir.joinpath(night_dir.name + night_catalog.CATALOG_SUFFIX)
+    if args["--quality"] != "off" and catalog_path.exists():
+        quality_metrics = frame_quality.catalog_metrics(
+            night_catalog.read_catalog(catalog_path)
+        )
 
-ast = AstrometryNet()
-ast.api_key = "dftcsswtydizkjix"
+    profile = profiling.Profile() if args["--profile"] else None
+    # Having many connections open to astrometry.net at once may get
+    # throttled, so keep --jobs modest when using the public server.
+    solve_all(
+        ccd_files,
+        target,
+        jobs=int(args["--jobs"]),
+        max_attempts=int(args["--retries"]),
+        upload=args["--upload"],
+        n_sources=int(args["--sources"]),
+        cache=cache,
+        propagate=args["--propagate"],
+        backend=backend,
+        journal=journal,
+        output=args["--output"],
+        profile=profile,
+        quality=args["--quality"],
+        quality_metrics=quality_metrics,
+        min_stars=int(args["--min-stars"]),
+        max_fwhm=args["--max-fwhm"] and float(args["--max-fwhm"]),
+        max_elongation=args["--max-elongation"] and float(args["--max-elongation"]),
+    )
+    if profile is not None:
+        profile_name = workingdir.joinpath("make_wcs.profile.json")
+        profile.write(profile_name)
+        profile.summary()
+        print(f"Written profile to {profile_name}")
@@ -0,0 +1,247 @@
+"""
+Machine-readable catalog of a night, written by log.py next to the text log.
+
+The catalog has one row per logged frame, with the logged fields as typed
+columns plus the frame's path (relative to the night directory) and size,
+and the image-quality metrics of light frames measured with log.py --quality
+(NaN, and -1 stars, for frames not measured). It is an ECSV table
+(`<DATE>.ecsv`), which keeps the column types and can be read back with
+astropy's Table.read or, as plain CSV, by anything else.
+
+`select` picks frames out of a catalog without reading any FITS headers:
+
+    lights = select(read_catalog("DATE/DATE.ecsv"), type="LIGHT",
+                    object="M37", filter="V", min_exptime=30)
+
+Usage:
+    night_catalog (<catalog>) [--type=T] [--object=NAME] [--filter=F]
+                  [--min-exptime=S] [--max-exptime=S] [--min-stars=N]
+                  [--max-fwhm=PX]
+
+Options:
+    --type=T            # LIGHT, DARK, BIAS, FLAT or UNKNOWN
+    --object=NAME       # Target name, as in the OBJECT column
+    --filter=F          # Filter name
+    --min-exptime=S     # Shortest exposure time in seconds
+    --max-exptime=S     # Longest exposure time in seconds
+    --min-stars=N       # Fewest stars found by the quality metrics
+    --max-fwhm=PX       # Largest median FWHM of the stars in pixels
+"""
+
+import os
+import numpy as np
+from docopt import docopt
+
+CATALOG_SUFFIX = ".ecsv"
+
+# Column names and types, in the order written
+COLUMNS = (
+    ("subdir", str),
+    ("file", str),
+    ("path", str),
+    ("size", int),
+    ("type", str),
+    ("date_obs", str),
+    ("object", str),
+    ("ra", str),
+    ("dec", str),
+    ("exptime", float),
+    ("filter", str),
+    ("instrume", str),
+)
+# Image-quality columns (see frame_quality), and their values for frames
+# that were not measured
+QUALITY_COLUMNS = (
+    ("sky", float, np.nan),
+    ("noise", float, np.nan),
+    ("n_stars", int, -1),
+    ("fwhm", float, np.nan),
+    ("elongation", float, np.nan),
+)
+COLUMNS += tuple((name, dtype) for name, dtype, missing in QUALITY_COLUMNS)
+
+
+def catalog_row(basedir, subdir, fpath, header, frame_type, metrics=None):
+    """
+    The catalog row of a logged frame.
+
+    Parameters
+    ----------
+    basedir : string
+        The night directory; the path is stored relative to it.
+
+    subdir, fpath : string
+        The frame's subdirectory as written in the log, and its path.
+
+    header : dict
+        Its catalogued header keywords.
+
+    frame_type : string
+        LIGHT, DARK, BIAS, FLAT or UNKNOWN, as logged.
+
+    metrics : dict, optional
+        Its image-quality metrics, from `frame_quality.measure`.
+    """
+    if metrics is None:
+        metrics = {}
+    quality = tuple(
+        metrics.get(name, missing) for name, dtype, missing in QUALITY_COLUMNS
+    )
+    return (
+        subdir,
+        os.path.basename(fpath),
+        os.path.relpath(fpath, basedir),
+        os.path.getsize(fpath),
+        frame_type,
+        header.get("DATE-OBS", ""),
+        header.get("OBJECT", "") if frame_type == "LIGHT" else "",
+        header.get("OBJCTRA", ""),
+        header.get("OBJCTDEC", ""),
+        float(header.get("EXPTIME", "nan")),
+        header.get("FILTER", ""),
+        header.get("INSTRUME", ""),
+    ) + quality
+
+
+def write_catalog(rows, fpath):
+    """
+    Write catalog rows to `fpath` in one go.
+    """
+    from astropy.table import Table
+
+    names = [name for name, dtype in COLUMNS]
+    dtypes = [dtype for name, dtype in COLUMNS]
+    table = Table(rows=rows or None, names=names, dtype=dtypes)
+    table.write(fpath, format="ascii.ecsv", overwrite=True)
+
+
+def read_catalog(fpath):
+    """
+    Read a night catalog as an astropy Table.
+    """
+    from astropy.table import Table
+
+    table = Table.read(fpath, format="ascii.ecsv")
+    # Catalogs written before the quality columns were added
+    for name, dtype, missing in QUALITY_COLUMNS:
+        if name not in table.colnames:
+            table[name] = np.full(len(table), missing, dtype=dtype)
+    table.meta["basedir"] = os.path.dirname(os.path.abspath(fpath))
+    return table
+
+
+def select(
+    table,
+    type=None,
+    object=None,
+    filter=None,
+    min_exptime=None,
+    max_exptime=None,
+    night=None,
+    min_stars=None,
+    max_fwhm=None,
+):
+    """
+    The rows of a catalog matching every criterion given.
+
+    Parameters
+    ----------
+    table : Table
+        A catalog from `read_catalog`.
+
+    type, object, filter : string, optional
+        Exact values of those columns.
+
+    min_exptime, max_exptime : float, optional
+        Inclusive limits on the exposure time in seconds.
+
+    night : string, optional
+        Night directory, in a catalog merged by `combine_catalogs`.
+
+    min_stars : int, optional
+        Fewest stars found by the quality metrics; frames not measured are
+        left out.
+
+    max_fwhm : float, optional
+        Largest median FWHM of the stars, in pixels.
+
+    Returns
+    -------
+    Table
+        The matching rows.
+    """
+    keep = np.ones(len(table), dtype=bool)
+    criteria = (
+        ("type", type),
+        ("object", object),
+        ("filter", filter),
+        ("night", night),
+    )
+    for column, value in criteria:
+        if value is not None:
+            keep &= table[column] == value
+    if min_exptime is not None:
+        keep &= table["exptime"] >= min_exptime
+    if max_exptime is not None:
+        keep &= table["exptime"] <= max_exptime
+    if min_stars is not None:
+        keep &= table["n_stars"] >= min_stars
+    if max_fwhm is not None:
+        keep &= table["fwhm"] <= max_fwhm
+    return table[keep]
+
+
+def combine_catalogs(catalog_paths, fpath):
+    """
+    Merge the catalogs of several nights into one table at `fpath`.
+
+    A `night` column, holding the name of each night directory, is added in
+    front, and paths are made relative to the directory of `fpath`.
+
+    Returns the combined Table.
+    """
+    from astropy.table import Table, vstack
+
+    outdir = os.path.dirname(os.path.abspath(fpath))
+    tables = []
+    for catalog_path in catalog_paths:
+        table = read_catalog(catalog_path)
+        night = os.path.basename(table.meta["basedir"])
+        table["path"] = [os.path.relpath(path, outdir) for path in frame_paths(table)]
+        table.add_column([night] * len(table), name="night", index=0)
+        del table.meta["basedir"]
+        tables.append(table)
+    if tables:
+        combined = vstack(tables)
+    else:
+        combined = Table(
+            names=["night"] + [name for name, dtype in COLUMNS],
+            dtype=[str] + [dtype for name, dtype in COLUMNS],
+        )
+    combined.write(fpath, format="ascii.ecsv", overwrite=True)
+    combined.meta["basedir"] = outdir
+    return combined
+
+
+def frame_paths(table):
+    """
+    Full paths of the frames in a catalog read with `read_catalog`.
+    """
+    return [os.path.join(table.meta["basedir"], path) for path in table["path"]]
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    table = read_catalog(args["<catalog>"])
+    matches = select(
+        table,
+        type=args["--type"],
+        object=args["--object"],
+        filter=args["--filter"],
+        min_exptime=args["--min-exptime"] and float(args["--min-exptime"]),
+        max_exptime=args["--max-exptime"] and float(args["--max-exptime"]),
+        min_stars=args["--min-stars"] and int(args["--min-stars"]),
+        max_fwhm=args["--max-fwhm"] and float(args["--max-fwhm"]),
+    )
+    for fpath in frame_paths(matches):
+        print(fpath)
@@ -0,0 +1,113 @@
+"""
+In-memory listing of a night directory, read in one pass.
+
+`NightTree` lists the night with one `os.scandir` call per directory, down to
+a fixed depth; deeper directories are never opened. log.py then plans every
+sort and rename against this listing, tells the tree about each file it
+moves, and writes the log from the updated listing, so the directories are
+not listed again after the files are moved.
+"""
+
+import os
+import re
+
+
+def is_fits(fname):
+    """
+    Whether `fname` has a FITS-like extension (.fits, .fit, .fts, ...),
+    possibly tile compressed (.fits.fz).
+    """
+    if fname.endswith(".fz"):
+        fname = fname[: -len(".fz")]
+    return re.match(r"\.f.*t.*", os.path.splitext(fname)[1]) is not None
+
+
+class NightTree:
+    """
+    Files and subdirectories of `basedir`, down to `max_depth` levels below
+    it.
+
+    Parameters
+    ----------
+    basedir : string
+        The top directory of the night.
+
+    max_depth : int
+        Deepest level listed; `basedir` itself is depth 0.
+
+    Attributes
+    ----------
+    files, subdirs : dict of set
+        File and subdirectory names in each listed directory, keyed by path.
+
+    depth : dict of int
+        Depth of each listed directory.
+    """
+
+    def __init__(self, basedir, max_depth):
+        self.basedir = os.path.normpath(basedir)
+        self.max_depth = max_depth
+        self.files = {}
+        self.subdirs = {}
+        self.depth = {}
+        self.n_listed = 0
+        self._list(self.basedir, 0)
+
+    def _list(self, dirpath, depth):
+        self.files[dirpath] = set()
+        self.subdirs[dirpath] = set()
+        self.depth[dirpath] = depth
+        self.n_listed += 1
+        children = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self.subdirs[dirpath].add(entry.name)
+                    children.append(entry.path)
+                else:
+                    self.files[dirpath].add(entry.name)
+        if depth < self.max_depth:
+            for child in children:
+                self._list(child, depth + 1)
+
+    def dirs(self):
+        """
+        The listed directories, top-down, with subdirectories in name order.
+        """
+        ordered = []
+        stack = [self.basedir]
+        while stack:
+            dirpath = stack.pop()
+            ordered.append(dirpath)
+            if self.depth[dirpath] < self.max_depth:
+                for name in sorted(self.subdirs[dirpath], reverse=True):
+                    stack.append(os.path.join(dirpath, name))
+        return ordered
+
+    def fits_files(self, dirpath):
+        """
+        Paths of the FITS files in `dirpath`, in name order.
+        """
+        return [
+            os.path.join(dirpath, fname)
+            for fname in sorted(self.files[dirpath])
+            if is_fits(fname)
+        ]
+
+    def move(self, plan):
+        """
+        Record that a batch of files has been moved, given as (old path,
+        new path) pairs, adding any directory that was just created.
+        """
+        for old, new in plan:
+            old_dir, old_name = os.path.split(str(old))
+            self.files[old_dir].discard(old_name)
+        for old, new in plan:
+            new_dir, new_name = os.path.split(str(new))
+            if new_dir not in self.files:
+                parent, name = os.path.split(new_dir)
+                self.subdirs[parent].add(name)
+                self.files[new_dir] = set()
+                self.subdirs[new_dir] = set()
+                self.depth[new_dir] = self.depth[parent] + 1
+            self.files[new_dir].add(new_name)
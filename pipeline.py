@@ -0,0 +1,238 @@
+"""
+Sort, rename and log a night and solve the WCS of its targets in one run.
+
+The night is processed by log.py as usual. Each target directory is handed
+to make_wcs as soon as its frames have been sorted and renamed, and is
+solved in the background while log.py moves on to the other targets, the
+log and the catalog. Remote solves therefore overlap with the local work,
+and the run takes about as long as the longer of the two, not their sum.
+Targets are solved one after another, each with up to --wcs-jobs frames in
+the solver at once.
+
+Which frames are sent to the solver is decided from their headers (see
+`rename_obs.wcs_skip_reason`), so the targets no longer have to be picked by
+hand. Only light frames with a pointing are solved. Flats taken as light
+frames (OBJECT containing "flat") and solar system targets (the Moon and
+planets) are skipped.
+
+Usage:
+    pipeline (<basedir>) [--jobs=N] [--wcs-jobs=N] [--retries=N]
+             [--backend=NAME] [--server=URL] [--api-key=KEY]
+             [--upload=MODE] [--output=MODE] [--propagate] [--no-cache]
+             [--quality=MODE] [--min-stars=N] [--compress] [--quiet]
+
+Options:
+    --jobs=N -j N       # Worker processes reading FITS headers [default: 1]
+    --wcs-jobs=N        # Frames solved concurrently [default: 1]
+    --retries=N         # Attempts per frame before giving up [default: 10]
+    --backend=NAME      # Solver: "nova" or "local" (see make_wcs)
+                        # [default: nova]
+    --server=URL        # Astrometry.net-compatible server to use instead of
+                        # nova.astrometry.net
+    --api-key=KEY       # Astrometry.net API key, by default taken from
+                        # $ASTROMETRY_NET_API_KEY or astroquery's config
+    --upload=MODE       # "auto", "image" or "sources" (see make_wcs)
+                        # [default: auto]
+    --output=MODE       # "copy", "compressed", "inplace" or "sidecar" (see
+                        # make_wcs) [default: copy]
+    --propagate         # Solve one frame per pointing and filter remotely,
+                        # and shift its WCS onto the others locally
+    --no-cache          # Always ask the solver, and do not cache solutions
+    --quality=MODE      # "last", "skip" or "off" (see make_wcs)
+                        # [default: last]
+    --min-stars=N       # Fewest stars a frame needs [default: 10]
+    --compress          # Tile-compress the frames as they are sorted
+    --quiet -q          # Only report progress, not every directory and file
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from docopt import docopt
+
+import log
+import make_wcs
+import rename_obs
+import wcs_backends
+import wcs_cache
+import wcs_journal
+
+
+class WCSStage:
+    """
+    Solves target directories in a background thread, in the order they
+    are handed over.
+
+    Parameters
+    ----------
+    **solve_options
+        Passed on to `make_wcs.solve_all` for every target.
+    """
+
+    def __init__(self, **solve_options):
+        self.solve_options = solve_options
+        self.start = time.perf_counter()
+        # One target at a time, so no more than `jobs` frames are ever in
+        # the solver at once
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+        self.timings = {}
+
+    def submit(self, folder, catalog):
+        """
+        Queue the frames of `folder` that pass the header rules; given to
+        `log.main` as its `on_sorted` callback.
+        """
+        target = os.path.basename(folder)
+        frames = []
+        reasons = set()
+        for fpath in make_wcs.target_frames(folder):
+            if make_wcs.is_solved_output(fpath):
+                continue
+            reason = rename_obs.wcs_skip_reason(catalog.get(fpath))
+            if reason:
+                reasons.add(reason)
+            else:
+                frames.append(fpath)
+        if not frames:
+            if reasons:
+                print(f"Not solving {target}: {', '.join(sorted(reasons))}")
+            return
+        print(f"Queueing {len(frames)} frames of {target} for WCS solving")
+        self.futures[target] = self._pool.submit(self._solve, folder, frames)
+
+    def _solve(self, folder, frames):
+        target = os.path.basename(folder)
+        start = time.perf_counter()
+        results = make_wcs.solve_all(
+            frames,
+            target,
+            journal=wcs_journal.WCSJournal(folder),
+            **self.solve_options,
+        )
+        self.timings[target] = (start - self.start, time.perf_counter() - self.start)
+        return results
+
+    def wait(self):
+        """
+        Wait for every queued target to be solved.
+
+        Returns a dict of the results of `make_wcs.solve_all` per target
+        (None for a target that failed).
+        """
+        results = {}
+        for target, future in self.futures.items():
+            try:
+                results[target] = future.result()
+            except Exception as e:
+                print(f"Error solving {target}: {e}")
+                results[target] = None
+        self._pool.shutdown()
+        return results
+
+    def stop(self):
+        """
+        Cancel the targets not yet started and let the solves in flight
+        finish.
+        """
+        make_wcs._stop.set()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def main(basedir, header_jobs=1, quiet=False, compress=False, **solve_options):
+    """
+    Process the night in `basedir`, solving targets as they are sorted.
+
+    Parameters
+    ----------
+    basedir : string
+        The night directory, DATE.
+
+    header_jobs : int
+        Worker processes reading FITS headers, as `jobs` for `log.main`.
+
+    quiet, compress
+        As for `log.main`.
+
+    **solve_options
+        Passed on to `make_wcs.solve_all`, e.g. jobs, backend and cache.
+
+    Returns
+    -------
+    dict
+        The results of `make_wcs.solve_all` per target.
+    """
+    wcs = WCSStage(**solve_options)
+    try:
+        log.main(
+            basedir,
+            jobs=header_jobs,
+            quiet=quiet,
+            compress=compress,
+            on_sorted=wcs.submit,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted: waiting for solves in flight to finish")
+        wcs.stop()
+        raise
+    log_done = time.perf_counter() - wcs.start
+    if wcs.futures:
+        print(
+            f"Log written after {log_done:.1f} s, waiting for "
+            f"{sum(1 for f in wcs.futures.values() if not f.done())} "
+            f"of {len(wcs.futures)} targets to be solved"
+        )
+    try:
+        results = wcs.wait()
+    except KeyboardInterrupt:
+        print("Interrupted: waiting for solves in flight to finish")
+        wcs.stop()
+        raise
+    total = time.perf_counter() - wcs.start
+    solve_time = sum(end - start for start, end in wcs.timings.values())
+    for target, target_results in results.items():
+        if target_results is not None:
+            n_solved = sum(1 for solved in target_results.values() if solved)
+            start, end = wcs.timings[target]
+            print(
+                f"{target}: {n_solved} of {len(target_results)} frames solved "
+                f"({start:.1f}-{end:.1f} s)"
+            )
+    print(
+        f"Finished in {total:.1f} s: sorting and logging took {log_done:.1f} s "
+        f"and solving {solve_time:.1f} s, {log_done + solve_time:.1f} s one "
+        f"after the other"
+    )
+    return results
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    try:
+        backend = wcs_backends.make_backend(
+            args["--backend"], server=args["--server"], api_key=args["--api-key"]
+        )
+    except (RuntimeError, ValueError) as e:
+        sys.exit(str(e))
+    basedir = os.path.normpath(args["<basedir>"])
+    cache = None
+    if not args["--no-cache"]:
+        cache = wcs_cache.WCSCache(
+            os.path.join(basedir, os.path.basename(basedir), wcs_cache.CACHE_NAME)
+        )
+    main(
+        basedir,
+        header_jobs=int(args["--jobs"]),
+        quiet=args["--quiet"],
+        compress=args["--compress"],
+        backend=backend,
+        cache=cache,
+        jobs=int(args["--wcs-jobs"]),
+        max_attempts=int(args["--retries"]),
+        upload=args["--upload"],
+        output=args["--output"],
+        propagate=args["--propagate"],
+        quality=args["--quality"],
+        min_stars=int(args["--min-stars"]),
+    )
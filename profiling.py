@@ -0,0 +1,184 @@
+"""
+Stage-by-stage profile of a log.py or make_wcs.py run, for --profile.
+
+A `Profile` times named stages of a run. Within each stage it also counts
+the files opened, the renames, and the directory listings, using a Python
+audit hook, and the bytes read and written, from /proc/self/io where the OS
+provides it. make_wcs also records the queueing and solving time of every
+frame. At the end of the run the profile is written as JSON, and `summary`
+prints a short table.
+
+Only the main process is measured. Headers read by `--jobs` worker
+processes are not counted in the file and byte totals, and the first stage
+to use a lazily imported module (e.g. astropy) includes the time and reads
+of importing it.
+"""
+
+import json
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Audit events counted, by the counter they add to
+AUDIT_EVENTS = {
+    "open": "files_opened",
+    "os.rename": "renames",
+    "os.listdir": "listings",
+    "os.scandir": "listings",
+}
+COUNTERS = ("files_opened", "renames", "listings", "bytes_read", "bytes_written")
+# Opens of Python modules by the import system are not counted as files
+MODULE_SUFFIXES = (".py", ".pyc", ".so", ".pyd")
+
+# The profile being recorded, if any, and whether the hook is installed
+_active = None
+_hook_installed = False
+_local = threading.local()
+
+
+def _audit_hook(event, args):
+    profile = _active
+    if profile is None or event not in AUDIT_EVENTS:
+        return
+    if getattr(_local, "reading_io", False):
+        return
+    if event == "open" and str(args[0]).endswith(MODULE_SUFFIXES):
+        return
+    with profile._lock:
+        profile._counts[AUDIT_EVENTS[event]] += 1
+
+
+def _read_io():
+    # Bytes read and written by this process so far, or None where
+    # /proc/self/io is not available. The open of /proc/self/io itself
+    # is kept out of the counts.
+    _local.reading_io = True
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+    finally:
+        _local.reading_io = False
+
+
+class Profile:
+    """
+    Wall time and I/O per stage of a run.
+
+    Parameters
+    ----------
+    enabled : bool
+        A disabled profile records nothing, so code can always call
+        `stage` and `record_frame` whether or not --profile was given.
+    """
+
+    def __init__(self, enabled=True):
+        global _active, _hook_installed
+        self.enabled = enabled
+        self.stages = []
+        self.frames = []
+        self._counts = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        if enabled:
+            if not _hook_installed:
+                # Audit hooks cannot be removed, so one hook serves every
+                # profile and does nothing when none is active
+                sys.addaudithook(_audit_hook)
+                _hook_installed = True
+            _active = self
+
+    def _snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        io = _read_io()
+        if io is None:
+            counts["bytes_read"] = counts["bytes_written"] = None
+        else:
+            counts["bytes_read"], counts["bytes_written"] = io
+        return counts
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing one stage of the run.
+        """
+        if not self.enabled:
+            yield
+            return
+        before = self._snapshot()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            after = self._snapshot()
+            record = {"stage": name, "wall_s": elapsed}
+            for counter in COUNTERS:
+                if before[counter] is None or after[counter] is None:
+                    record[counter] = None
+                else:
+                    record[counter] = after[counter] - before[counter]
+            self.stages.append(record)
+
+    def record_frame(self, **fields):
+        """
+        Record the timings of one frame, e.g. its queue and solve latency.
+        """
+        if self.enabled:
+            with self._lock:
+                self.frames.append(fields)
+
+    def report(self):
+        """
+        The profile as a JSON-serialisable dict.
+        """
+        return {
+            "command": sys.argv,
+            "wall_s": time.perf_counter() - self._start,
+            "stages": self.stages,
+            "frames": self.frames,
+        }
+
+    def write(self, fpath):
+        """
+        Write the profile to `fpath` as JSON.
+        """
+        with open(fpath, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self):
+        """
+        Print a table of the stages and, if frames were recorded, their
+        latencies.
+        """
+        print(
+            f"{'Stage':<18} {'Wall/s':>8} {'Opened':>7} {'Read/MB':>8} "
+            f"{'Written/MB':>10} {'Renames':>7} {'Listings':>8}"
+        )
+        for record in self.stages:
+            read = record["bytes_read"]
+            written = record["bytes_written"]
+            print(
+                f"{record['stage']:<18} {record['wall_s']:>8.3f} "
+                f"{record['files_opened']:>7} "
+                f"{'-' if read is None else f'{read / 1e6:.1f}':>8} "
+                f"{'-' if written is None else f'{written / 1e6:.1f}':>10} "
+                f"{record['renames']:>7} {record['listings']:>8}"
+            )
+        methods = sorted({frame.get("method", "") for frame in self.frames})
+        for method in methods:
+            frames = [f for f in self.frames if f.get("method", "") == method]
+            for latency in ("queued_s", "solve_s"):
+                values = [f[latency] for f in frames if f.get(latency) is not None]
+                if values:
+                    print(
+                        f"{latency[:-2].capitalize()} time per frame"
+                        f"{f' ({method})' if method else ''}: median "
+                        f"{statistics.median(values):.2f} s, "
+                        f"max {max(values):.2f} s ({len(values)} frames)"
+                    )
@@ -0,0 +1,104 @@
+"""
+On-disk journal of the renames made while sorting a night.
+
+Each batch of renames applied by `rename_obs.apply_plan` is appended to
+`JOURNAL_NAME` in the night directory before any file is moved, one JSON line
+per rename, tagged with the run and the batch it belongs to. `rename_obs
+undo` reads the batches of the latest run back and reverses them, newest
+first, so a bad run can be rolled back to the names the files had before it.
+Each batch is removed from the journal only once it has been moved back, so
+an undo that stops partway can be run again to finish.
+"""
+
+import json
+import os
+import time
+import uuid
+
+JOURNAL_NAME = ".rename_journal.jsonl"
+
+
+class RenameJournal:
+    """
+    Append-only record of the renames made in a night directory.
+
+    Paths are stored relative to the directory, so the journal still applies
+    if the night is moved elsewhere.
+
+    Parameters
+    ----------
+    basedir : string or Path
+        The night directory; the journal is kept inside it.
+    """
+
+    def __init__(self, basedir):
+        self.basedir = str(basedir)
+        self.path = os.path.join(self.basedir, JOURNAL_NAME)
+        # The process ID and a random suffix keep runs started in the same
+        # second apart
+        self.run = (
+            f"{time.strftime('%Y-%m-%dT%H:%M:%S')}-{os.getpid()}-"
+            f"{uuid.uuid4().hex[:8]}"
+        )
+        self._n_batches = 0
+
+    def record(self, plan):
+        """
+        Append a batch of (old path, new path) renames to the journal.
+        """
+        lines = []
+        for old, new in plan:
+            entry = {
+                "run": self.run,
+                "batch": self._n_batches,
+                "old": os.path.relpath(old, self.basedir),
+                "new": os.path.relpath(new, self.basedir),
+            }
+            lines.append(json.dumps(entry) + "\n")
+        self._n_batches += 1
+        with open(self.path, "a") as f:
+            f.writelines(lines)
+
+    def _entries(self):
+        try:
+            with open(self.path) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def last_run(self):
+        """
+        The batches of the latest run, in the order they were applied, as
+        (batch number, list of (old path, new path)) pairs.
+        """
+        entries = self._entries()
+        if not entries:
+            return []
+        last_run = entries[-1]["run"]
+        batches = {}
+        for entry in entries:
+            if entry["run"] == last_run:
+                batches.setdefault(entry["batch"], []).append(
+                    (
+                        os.path.join(self.basedir, entry["old"]),
+                        os.path.join(self.basedir, entry["new"]),
+                    )
+                )
+        return [(batch, batches[batch]) for batch in sorted(batches)]
+
+    def remove_batch(self, batch):
+        """
+        Remove one batch of the latest run from the journal, once it has
+        been undone.
+        """
+        entries = self._entries()
+        if not entries:
+            return
+        last_run = entries[-1]["run"]
+        kept = [
+            entry
+            for entry in entries
+            if entry["run"] != last_run or entry["batch"] != batch
+        ]
+        with open(self.path, "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in kept)
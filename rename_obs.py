@@ -6,54 +6,264 @@ file name. It then renames that fits file to the new file name
 
 Usage:
     rename_obs (<dir>) [--force]
+    rename_obs rename (<dir>) [--force] [--dry-run] [--compress]
+    rename_obs undo (<dir>)
 
 Options:
     --force -f          # Do not prompt rename
+    --dry-run -n        # Print the renames without making them
+    --compress          # Tile-compress the frames as they are renamed,
+                        # giving .fits.fz files
+
+"rename" renames the frames in each subdirectory of <dir> after their
+target, filter and exposure time. "undo" reverses the renames of the last
+run of "rename" or log.py on <dir>, decompressing frames that were
+compressed on the way.
 """
 
 from docopt import docopt
 from glob import glob
-from astropy.io import fits
 from pathlib import Path
 import os
+import re
+
+import fits_compress
+from header_catalog import HeaderCatalog
+from rename_journal import RenameJournal
+
+# Subdirectories of DATE/DATE the calibration masters and calibrated lights
+# are written to (by calibration), which are not targets
+MASTERS_DIR = "Masters"
+CALIBRATED_DIR = "Calibrated"
 
-import make_wcs
+# OBJECT names of solar system targets, which cannot be solved against star
+# catalogues, optionally followed by a number (e.g. "Jupiter 2")
+SOLAR_SYSTEM = re.compile(
+    r"(sun|moon|mercury|venus|mars|jupiter|saturn|uranus|neptune|pluto)[\s_\-\d]*",
+    re.IGNORECASE,
+)
 
 
-def create_fpath(fname, force=True):
+def exptime_label(exp_time):
+    """
+    EXPTIME as written in file names: whole seconds without a decimal
+    point, otherwise to the millisecond.
+    """
+    if exp_time % 1.0 == 0:
+        return str(int(exp_time))
+    return f"{exp_time:.3f}"
+
+
+def frame_stem(fname, catalog=None, dest_dir=None):
+    """
+    The new name of a frame without its number and suffix,
+    TARGET_FILTER_EXPs, where TARGET is the name of `dest_dir` (by default
+    the directory the frame is in).
+    """
+    if catalog is None:
+        catalog = HeaderCatalog()
     fname = Path(fname)
-    obj_name = fname.parts[-2]
-    with fits.open(fname) as f:
-        header_info = f[0].header
+    dest_dir = fname.parent if dest_dir is None else Path(dest_dir)
+    header_info = catalog.get(fname)
     filter_name = header_info["FILTER"]
-    exp_time = header_info["EXPTIME"]
-    if exp_time % 1.0 == 0:
-        exp_time = int(exp_time)
-    else:
-        exp_time = f"{exp_time:.3f}"
-    new_fname = f"{obj_name}_{filter_name}_{exp_time}s_00.fits"
+    exp_time = exptime_label(header_info["EXPTIME"])
+    return f"{dest_dir.name}_{filter_name}_{exp_time}s"
+
+
+def create_fpath(
+    fname, force=True, catalog=None, count=0, dest_dir=None, compress=None
+):
+    """
+    New path of a frame, TARGET_FILTER_EXPs_NN.fits, with a .fz suffix if
+    `compress` is True. By default a frame keeps its compression.
+    """
+    if catalog is None:
+        catalog = HeaderCatalog()
+    fname = Path(fname)
+    # The directory the frame is in, or is being moved to
+    dest_dir = fname.parent if dest_dir is None else Path(dest_dir)
+    new_fname = f"{frame_stem(fname, catalog, dest_dir)}_{count:02d}.fits"
+    if compress is None:
+        compress = fits_compress.is_compressed(fname)
+    if compress:
+        new_fname += fits_compress.COMPRESSED_SUFFIX
     old_fname = fname.name
     if not force:
         print(f"\t{old_fname} -> {new_fname}")
-    new_fpath = Path.joinpath(fname.parent, new_fname)
+    new_fpath = Path.joinpath(dest_dir, new_fname)
     return new_fpath
 
 
-def sort_by_target(fits_dir):
-    fits_list = glob(fits_dir + "/*.fits")
+def target_folder(header_info):
+    """
+    Name of the subdirectory a frame is sorted into: the OBJECT for light
+    frames, otherwise the IMAGETYP. Raises KeyError if either is missing.
+    """
+    image_type = header_info["IMAGETYP"]
+    target_ID = header_info["OBJECT"]
+    if image_type == "Light Frame":
+        return target_ID
+    return image_type.replace(" ", "_")
+
+
+def wcs_skip_reason(header_info):
+    """
+    Why a frame should not be sent for a WCS solution, judged from its
+    header: it is not a light frame, it is a flat taken as a light frame
+    (OBJECT containing "flat"), its target is in the solar system, or it has
+    no pointing (OBJCTRA/OBJCTDEC) to guide the solver.
+
+    Returns the reason, or None if the frame can be solved.
+    """
+    if header_info.get("IMAGETYP") != "Light Frame":
+        return "not a light frame"
+    target = str(header_info.get("OBJECT", "")).strip()
+    if not target:
+        return "no OBJECT"
+    if "flat" in target.lower():
+        return "flat field"
+    if SOLAR_SYSTEM.fullmatch(target):
+        return "solar system target"
+    if "OBJCTRA" not in header_info or "OBJCTDEC" not in header_info:
+        return "no OBJCTRA/OBJCTDEC"
+    return None
+
+
+def plan_renames(fits_list, catalog=None, dest_dir=None, compress=None):
+    """
+    Plan new names of the form TARGET_FILTER_EXPs_NN.fits for frames in one
+    directory, or for frames being moved into `dest_dir`. With `compress`
+    True (False) every frame is given a .fits.fz (.fits) name, to be
+    compressed (decompressed) by `apply_plan`; by default each keeps its
+    compression.
+
+    Frames are numbered in order of DATE-OBS (then path) with a counter per
+    name, so the plan depends only on the headers, not on the order the
+    files are listed in, and re-planning a renamed directory changes nothing.
+
+    Returns a list of (old path, new path) pairs.
+    """
+    if catalog is None:
+        catalog = HeaderCatalog()
+    frames = sorted(
+        (Path(f) for f in fits_list),
+        key=lambda f: (catalog.get(f).get("DATE-OBS", ""), str(f)),
+    )
+    counters = {}
+    plan = []
+    for fpath in frames:
+        # Compressed and uncompressed frames share one counter per name
+        name = frame_stem(fpath, catalog, dest_dir)
+        count = counters.get(name, 0)
+        counters[name] = count + 1
+        new_fpath = create_fpath(
+            fpath, catalog=catalog, count=count, dest_dir=dest_dir, compress=compress
+        )
+        plan.append((fpath, new_fpath))
+    return plan
+
+
+def apply_plan(plan, catalog=None, journal=None):
+    """
+    Make a batch of (old path, new path) renames.
+
+    A frame whose new name is still held by another frame in the batch is
+    first moved to a temporary name, so swaps and chains of renames work
+    whatever their order. The batch is written to `journal` (a
+    RenameJournal), if given, before anything is moved.
+
+    A frame moving between a .fits and a .fits.fz name is compressed or
+    decompressed on the way, so undoing the batch restores the original
+    files.
+
+    Raises FileExistsError, before anything is moved, if a new name is
+    held by a file that is not moved in the batch, as the rename would
+    silently replace it.
+    """
+    plan = [(Path(old), Path(new)) for old, new in plan if Path(old) != Path(new)]
+    sources = {old for old, new in plan}
+    for old, new in plan:
+        if new not in sources and os.path.lexists(new):
+            raise FileExistsError(f"Not renaming {old}: {new} already exists")
+    if journal is not None and plan:
+        journal.record(plan)
+    staged = []
+    for old, new in plan:
+        if new in sources:
+            # The temporary name keeps the suffix, so that the move to the
+            # new name still knows whether to compress
+            tmp = old.with_name(f".renaming.{old.name}")
+            os.rename(old, tmp)
+            staged.append((old, tmp, new))
+        else:
+            _move(old, new, catalog)
+    if catalog is not None:
+        for old, tmp, new in staged:
+            catalog.rename(old, tmp)
+    for old, tmp, new in staged:
+        _move(tmp, new, catalog)
+    return plan
+
+
+def _move(old, new, catalog=None):
+    # Rename a frame, compressing or decompressing it if only one of the
+    # names ends in .fz
+    if fits_compress.is_compressed(old) == fits_compress.is_compressed(new):
+        os.rename(old, new)
+        if catalog is not None:
+            catalog.rename(old, new)
+        return
+    fits_compress.convert(old, new)
+    os.remove(old)
+    if catalog is not None:
+        catalog.rename(old, new)
+        if new in catalog:
+            # Its size has changed, so the cache stamp must be renewed
+            catalog.add(new, catalog.get(new))
+
+
+def undo_last_run(basedir):
+    """
+    Reverse the renames of the latest run journalled in `basedir`.
+
+    Each batch is taken off the journal once it has been moved back. Files
+    that are no longer at their new name (and not back at their old one
+    either) are skipped and reported.
+
+    Returns the number of files moved back.
+    """
+    journal = RenameJournal(basedir)
+    n_undone = 0
+    skipped = []
+    for batch, plan in reversed(journal.last_run()):
+        undo_plan = []
+        for old, new in plan:
+            if os.path.exists(new):
+                undo_plan.append((new, old))
+            elif not os.path.exists(old):
+                skipped.append(new)
+        n_undone += len(apply_plan(undo_plan))
+        journal.remove_batch(batch)
+    if skipped:
+        print(f"Skipped {len(skipped)} files no longer where they were moved to:")
+        for new in skipped:
+            print(f"\t{new}")
+    return n_undone
+
+
+def sort_by_target(fits_dir, catalog=None, jobs=1, journal=None):
+    if catalog is None:
+        catalog = HeaderCatalog()
+    fits_list = glob(fits_dir + "/*.fits") + glob(fits_dir + "/*.fits.fz")
     if len(fits_list) == 0:
         print(f"No .fits files found in {fits_dir}")
         return -1
+    catalog.scan(fits_list, jobs=jobs)
+    plan = []
     for file in fits_list:
-        with fits.open(file) as f:
-            header_info = f[0].header
+        header_info = catalog.get(file)
         try:
-            image_type = header_info["IMAGETYP"]
-            target_ID = header_info["OBJECT"]
-            if image_type == "Light Frame":
-                folder_name = target_ID
-            else:
-                folder_name = image_type.replace(" ", "_")
+            folder_name = target_folder(header_info)
         except KeyError:
             print(f"{file} does not have requisite header info")
             folder_name = "Misc"
@@ -62,7 +272,8 @@ def sort_by_target(fits_dir):
         new_fpath = fpath.parent.joinpath(folder_name, fpath.name)
         # print(f"Renaming {file} to {new_fpath}")
         new_fpath.parent.mkdir(exist_ok=True)
-        os.rename(fpath, new_fpath)
+        plan.append((fpath, new_fpath))
+    apply_plan(plan, catalog, journal)
     failed_paths = []
     if Path(fits_dir).joinpath("Misc.").exists():
         for file in Path(fits_dir).joinpath("Misc.").iterdir():
@@ -76,57 +287,72 @@ def list_wcs_targets(fits_dir):
     print("Listing WCS Targets")
     fits_dir = Path(fits_dir)
     for target in fits_dir.glob("*/"):
-        print("\t", target.name)
+        # Hidden directories, such as the WCS cache, and the calibration
+        # outputs are not targets
+        if not target.name.startswith(".") and target.name not in (
+            CALIBRATED_DIR,
+            MASTERS_DIR,
+        ):
+            print("\t", target.name)
     print("\n")
     print("To obtain WCS solutions for a target, run:")
     print(f"python make_wcs.py {fits_dir} TARGET")
     return 0
 
 
-def process_folder(fits_dir, force=True):
-    fits_list = glob(fits_dir + "/*.fits")
+def process_folder(
+    fits_dir, force=True, catalog=None, dry_run=False, journal=None, compress=None
+):
+    if catalog is None:
+        catalog = HeaderCatalog()
+    fits_list = glob(fits_dir + "/*.fits") + glob(fits_dir + "/*.fits.fz")
     if len(fits_list) == 0:
         print(f"No .fits files found in {fits_dir}")
         return -1
 
-    if not force:
+    if not force or dry_run:
         print(Path(fits_list[0]).parent)
-    target = str(Path(fits_list[0]).parts[-2])
 
-    # Create new path name
-    new_fpaths = []
-    # Attempt to obtain WCS Solution for files in directory
-    # Rename files in directory based on header
-    for file in fits_list:
-        new_fpath = create_fpath(file, force)
-        new_fpaths.append(new_fpath)
-    old_to_new = zip(fits_list, new_fpaths)
+    # Plan every new name up front, then rename in one batch
+    catalog.scan(fits_list)
+    plan = plan_renames(fits_list, catalog, compress=compress)
+    if not force or dry_run:
+        for old_path, new_path in plan:
+            if old_path != new_path:
+                print(f"\t{old_path.name} -> {new_path.name}")
+    if dry_run:
+        return plan
     if force:
         go_ahead = "Y"
     else:
         go_ahead = input("Look okay? (Y/N) ")
 
     if go_ahead.capitalize() == "Y":
-        for old_path, new_path in old_to_new:
-            complete = False
-            count = 0
-            while complete == False:
-                if new_path.exists():
-                    count += 1
-                    new_path = new_path.with_name(
-                        new_path.name.replace(f"_{count-1:02d}.", f"_{count:02d}.")
-                    )
-                else:
-                    os.rename(old_path, new_path)
-                    complete = True
+        apply_plan(plan, catalog, journal)
     else:
         print("Cancelled by user. No changes made.")
+    return plan
 
 
 if __name__ == "__main__":
     args = docopt(__doc__)
     fits_dir = args["<dir>"]
     force = args["--force"]
-    list_wcs_targets(fits_dir)
+    if args["undo"]:
+        print(f"Moved {undo_last_run(fits_dir)} files back")
+    elif args["rename"]:
+        catalog = HeaderCatalog()
+        journal = RenameJournal(fits_dir)
+        for root, dirs, fnames in os.walk(fits_dir, topdown=True):
+            process_folder(
+                root,
+                force,
+                catalog=catalog,
+                dry_run=args["--dry-run"],
+                journal=journal,
+                compress=True if args["--compress"] else None,
+            )
+    else:
+        list_wcs_targets(fits_dir)
     # sort_by_target(fits_dir)
     # process_folder(fits_dir, force)
@@ -0,0 +1,124 @@
+"""
+A local stand-in for the nova.astrometry.net HTTP API.
+
+Serves canned solutions from wcs_backends.LocalBackend over the same API that
+astroquery's AstrometryNet client talks to, so make_wcs can be run end to end
+(uploads, monitoring, retries) without network access:
+
+    python standin_server.py --port=8080 --delay=5
+    python make_wcs.py DATE/DATE TARGET --server=http://localhost:8080 --api-key=x
+
+Usage:
+    standin_server [--port=N] [--delay=S] [--failure-rate=F]
+
+Options:
+    --port=N            # Port to listen on [default: 8080]
+    --delay=S           # Seconds each job spends solving [default: 2]
+    --failure-rate=F    # Fraction of jobs that fail [default: 0]
+"""
+
+import json
+from email import message_from_bytes
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from astropy.io import fits
+from docopt import docopt
+
+from wcs_backends import LocalBackend
+
+
+def _read_request(handler):
+    # Returns the decoded request-json settings, and the uploaded file (if
+    # any) of a form-encoded or multipart POST.
+    body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+    content_type = handler.headers.get("Content-Type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=HTTP
+        )
+        fields = {}
+        for part in message.iter_parts():
+            fields[part.get_param("name", header="content-disposition")] = (
+                part.get_payload(decode=True)
+            )
+        return json.loads(fields["request-json"]), fields.get("file")
+    fields = parse_qs(body.decode())
+    return json.loads(fields["request-json"][0]), None
+
+
+def _upload_header(data):
+    # Primary header of an uploaded FITS file, up to its END card
+    for i in range(0, len(data), 80):
+        if data[i : i + 8] == b"END     ":
+            return fits.Header.fromstring(data[: i + 80].decode("ascii"))
+    raise ValueError("No END card in uploaded file")
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    backend = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, text, content_type="application/json"):
+        data = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        settings, upload = _read_request(self)
+        endpoint = self.path.rstrip("/").split("/")[-1]
+        if endpoint == "login":
+            self._send(json.dumps({"status": "success", "session": "standin"}))
+            return
+        if endpoint == "upload":
+            header = _upload_header(upload)
+            shape = (header["NAXIS1"], header["NAXIS2"])
+        else:
+            shape = (settings["image_width"], settings["image_height"])
+        submission_id = self.backend.submit(settings, *shape)
+        self._send(json.dumps({"status": "success", "subid": submission_id}))
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        try:
+            if parts[:2] == ["api", "submissions"]:
+                self._send(json.dumps({"jobs": [int(parts[2])]}))
+            elif parts[:2] == ["api", "jobs"]:
+                status = self.backend.status(int(parts[2]))
+                self._send(json.dumps({"status": status}))
+            elif parts[0] == "wcs_file":
+                self._send(self.backend.wcs(int(parts[1])).tostring(), "text/plain")
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError, IndexError):
+            self.send_error(404)
+
+
+def serve(port=8080, backend=None):
+    """
+    Serve `backend` (a LocalBackend) on localhost:`port` until interrupted.
+    """
+    StandinHandler.backend = backend or LocalBackend()
+    server = ThreadingHTTPServer(("localhost", port), StandinHandler)
+    print(f"Stand-in Astrometry.net server on http://localhost:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    serve(
+        port=int(args["--port"]),
+        backend=LocalBackend(
+            delay=float(args["--delay"]),
+            failure_rate=float(args["--failure-rate"]),
+        ),
+    )
@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+# The scripts are top-level modules in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def _write_frame(fpath, imagetyp, date_obs, obj="", filter_name="", exptime=0.0):
+    header = fits.Header()
+    header["INSTRUME"] = "SBIG STX-16803 3 CCD Camera"
+    header["IMAGETYP"] = imagetyp
+    header["OBJECT"] = obj
+    header["FILTER"] = filter_name
+    header["EXPTIME"] = exptime
+    header["DATE-OBS"] = date_obs
+    if imagetyp == "Light Frame":
+        header["OBJCTRA"] = "05 52 18"
+        header["OBJCTDEC"] = "+32 33 00"
+    data = np.zeros((8, 8), dtype=np.uint16)
+    fits.PrimaryHDU(data=data, header=header).writeto(fpath)
+
+
+@pytest.fixture
+def write_frame():
+    """
+    Write a small SBIG-style frame with the header keywords log.py uses.
+    """
+    return _write_frame
@@ -0,0 +1,53 @@
+"""
+Tests of sorting and renaming a night with log.py.
+"""
+
+import os
+
+import log
+
+
+def sorted_files(basedir):
+    return sorted(
+        os.path.relpath(os.path.join(root, fname), basedir)
+        for root, dirs, fnames in os.walk(basedir)
+        for fname in fnames
+        if fname.endswith(".fits")
+    )
+
+
+def light(write_frame, fpath, minute):
+    write_frame(
+        fpath,
+        "Light Frame",
+        f"2025-02-26T21:{minute:02d}:00",
+        obj="M37",
+        filter_name="B",
+        exptime=30.0,
+    )
+
+
+def test_new_frames_numbered_after_sorted_ones(tmp_path, write_frame):
+    basedir = tmp_path / "2025-02-26"
+    target = basedir / "M37"
+    target.mkdir(parents=True)
+    light(write_frame, target / "M37_B_30s_00.fits", 0)
+    light(write_frame, target / "M37_B_30s_01.fits", 1)
+    # A frame added later, with another in the incoming directory
+    light(write_frame, basedir / "CCD_Image_3.fits", 2)
+    (basedir / "2025-02-26").mkdir()
+    light(write_frame, basedir / "2025-02-26" / "CCD_Image_4.fits", 3)
+
+    log.main(str(basedir), quiet=True)
+    assert sorted_files(basedir) == [
+        os.path.join("2025-02-26", "M37", "M37_B_30s_00.fits"),
+        os.path.join("M37", "M37_B_30s_00.fits"),
+        os.path.join("M37", "M37_B_30s_01.fits"),
+        os.path.join("M37", "M37_B_30s_02.fits"),
+    ]
+    assert (target / "M37_B_30s_00.fits").stat().st_size > 0
+
+    # Running again moves nothing
+    before = sorted_files(basedir)
+    log.main(str(basedir), quiet=True, use_cache=False)
+    assert sorted_files(basedir) == before
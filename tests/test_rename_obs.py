@@ -0,0 +1,142 @@
+"""
+Tests of the journalled renames made by rename_obs.apply_plan and reversed by
+rename_obs undo.
+"""
+
+import json
+
+import pytest
+
+import rename_obs
+from rename_journal import JOURNAL_NAME, RenameJournal
+
+
+def make_files(directory, names):
+    # Small files whose contents are their original names
+    paths = []
+    for name in names:
+        path = directory / name
+        path.write_text(name)
+        paths.append(path)
+    return paths
+
+
+def contents(directory):
+    return {
+        path.name: path.read_text()
+        for path in directory.iterdir()
+        if path.name != JOURNAL_NAME
+    }
+
+
+def test_swap(tmp_path):
+    a, b = make_files(tmp_path, ["a.fits", "b.fits"])
+    rename_obs.apply_plan([(a, b), (b, a)], journal=RenameJournal(tmp_path))
+    assert contents(tmp_path) == {"a.fits": "b.fits", "b.fits": "a.fits"}
+
+    assert rename_obs.undo_last_run(tmp_path) == 2
+    assert contents(tmp_path) == {"a.fits": "a.fits", "b.fits": "b.fits"}
+
+
+def test_chain(tmp_path):
+    a, b, c = make_files(tmp_path, ["a.fits", "b.fits", "c.fits"])
+    d = tmp_path / "d.fits"
+    # In an order where each new name is still held when it is moved to
+    rename_obs.apply_plan([(a, b), (b, c), (c, d)], journal=RenameJournal(tmp_path))
+    assert contents(tmp_path) == {
+        "b.fits": "a.fits",
+        "c.fits": "b.fits",
+        "d.fits": "c.fits",
+    }
+
+    assert rename_obs.undo_last_run(tmp_path) == 3
+    assert contents(tmp_path) == {
+        "a.fits": "a.fits",
+        "b.fits": "b.fits",
+        "c.fits": "c.fits",
+    }
+
+
+def test_undo_reverses_batches_newest_first(tmp_path):
+    (a,) = make_files(tmp_path, ["a.fits"])
+    sub = tmp_path / "M37"
+    sub.mkdir()
+    journal = RenameJournal(tmp_path)
+    rename_obs.apply_plan([(a, sub / "a.fits")], journal=journal)
+    rename_obs.apply_plan(
+        [(sub / "a.fits", sub / "M37_V_30s_00.fits")], journal=journal
+    )
+
+    assert rename_obs.undo_last_run(tmp_path) == 2
+    assert a.read_text() == "a.fits"
+    assert list(sub.iterdir()) == []
+    assert not (tmp_path / JOURNAL_NAME).read_text()
+
+
+def test_undo_only_last_run(tmp_path):
+    a, b = make_files(tmp_path, ["a.fits", "b.fits"])
+    first, second = RenameJournal(tmp_path), RenameJournal(tmp_path)
+    # Runs started in the same second must still be told apart
+    assert first.run != second.run
+    rename_obs.apply_plan([(a, tmp_path / "c.fits")], journal=first)
+    rename_obs.apply_plan([(b, tmp_path / "d.fits")], journal=second)
+
+    assert rename_obs.undo_last_run(tmp_path) == 1
+    assert contents(tmp_path) == {"c.fits": "a.fits", "b.fits": "b.fits"}
+    assert rename_obs.undo_last_run(tmp_path) == 1
+    assert contents(tmp_path) == {"a.fits": "a.fits", "b.fits": "b.fits"}
+    assert rename_obs.undo_last_run(tmp_path) == 0
+
+
+def test_undo_reports_missing_files(tmp_path, capsys):
+    a, b = make_files(tmp_path, ["a.fits", "b.fits"])
+    rename_obs.apply_plan(
+        [(a, tmp_path / "c.fits"), (b, tmp_path / "d.fits")],
+        journal=RenameJournal(tmp_path),
+    )
+    (tmp_path / "d.fits").unlink()
+
+    assert rename_obs.undo_last_run(tmp_path) == 1
+    assert contents(tmp_path) == {"a.fits": "a.fits"}
+    assert "d.fits" in capsys.readouterr().out
+    assert not (tmp_path / JOURNAL_NAME).read_text()
+
+
+def test_interrupted_undo_can_be_resumed(tmp_path, monkeypatch):
+    a, b = make_files(tmp_path, ["a.fits", "b.fits"])
+    journal = RenameJournal(tmp_path)
+    rename_obs.apply_plan([(a, tmp_path / "c.fits")], journal=journal)
+    rename_obs.apply_plan([(b, tmp_path / "d.fits")], journal=journal)
+
+    # Fail while moving back the first batch, after the second is undone
+    move = rename_obs._move
+
+    def failing_move(old, new, catalog=None):
+        if new.name == "a.fits":
+            raise OSError("disk unplugged")
+        move(old, new, catalog)
+
+    monkeypatch.setattr(rename_obs, "_move", failing_move)
+    with pytest.raises(OSError):
+        rename_obs.undo_last_run(tmp_path)
+    assert contents(tmp_path) == {"c.fits": "a.fits", "b.fits": "b.fits"}
+    entries = [json.loads(line) for line in (tmp_path / JOURNAL_NAME).open()]
+    assert [entry["new"] for entry in entries] == ["c.fits"]
+
+    monkeypatch.setattr(rename_obs, "_move", move)
+    assert rename_obs.undo_last_run(tmp_path) == 1
+    assert contents(tmp_path) == {"a.fits": "a.fits", "b.fits": "b.fits"}
+
+
+def test_existing_file_not_replaced(tmp_path):
+    a, b, c = make_files(tmp_path, ["a.fits", "b.fits", "c.fits"])
+    journal = RenameJournal(tmp_path)
+    # b is moved out of the way, but c is not part of the batch
+    with pytest.raises(FileExistsError):
+        rename_obs.apply_plan([(a, b), (b, c)], journal=journal)
+    assert contents(tmp_path) == {
+        "a.fits": "a.fits",
+        "b.fits": "b.fits",
+        "c.fits": "c.fits",
+    }
+    assert not (tmp_path / JOURNAL_NAME).exists()
@@ -0,0 +1,45 @@
+"""
+Tests of unpacking a zipped night with log.py.
+"""
+
+import os
+import zipfile
+
+import log
+
+
+def sorted_files(basedir):
+    return sorted(
+        os.path.relpath(os.path.join(root, fname), basedir)
+        for root, dirs, fnames in os.walk(basedir)
+        for fname in fnames
+        if fname.endswith(".fits")
+    )
+
+
+def test_flat_zip(tmp_path, write_frame):
+    basedir = tmp_path / "2025-02-26"
+    basedir.mkdir()
+    frames = tmp_path / "frames"
+    frames.mkdir()
+    write_frame(frames / "CCD Image 1.fit", "Bias Frame", "2025-02-26T20:00:00")
+    for i in range(2):
+        write_frame(
+            frames / f"CCD Image {i + 2}.fit",
+            "Light Frame",
+            f"2025-02-26T21:0{i}:00",
+            obj="M37",
+            filter_name="B",
+            exptime=30.0,
+        )
+    # Members at the top of the archive, with no DATE directory
+    with zipfile.ZipFile(basedir / "2025-02-26.zip", "w") as zf:
+        for fpath in sorted(frames.iterdir()):
+            zf.write(fpath, arcname=fpath.name)
+
+    log.main(str(basedir), quiet=True)
+    assert sorted_files(basedir) == [
+        os.path.join("Bias_Frame", "Bias_Frame__0s_00.fits"),
+        os.path.join("M37", "M37_B_30s_00.fits"),
+        os.path.join("M37", "M37_B_30s_01.fits"),
+    ]
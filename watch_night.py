@@ -0,0 +1,222 @@
+"""
+Sort and log the frames of a night as they arrive, instead of the next
+morning.
+
+The incoming directory, DATE/DATE, is polled every --interval seconds. Each
+new frame is classified by its header, moved straight to its target (or
+image type) subdirectory under the name log.py would give it, and appended
+to the night log, DATE/DATE.log. A frame is left for a later poll while it
+is still being written: until its header is complete, the file holds as much
+data as the header describes, and it has not changed for --settle seconds.
+
+Only the incoming directory is listed on each poll. Sorted frames leave it,
+and each target directory is listed once, the first time a frame goes there,
+to carry on its numbering, so the work per frame does not grow as the night
+goes on. Renames are journalled as one run, which `rename_obs undo` can
+reverse, and frames without the headers to be named go to Misc with their
+rename_maxim name. With --compress, frames are tile-compressed as they are
+moved, giving .fits.fz files.
+
+The log is written in order of arrival. Running log.py on the night
+afterwards rewrites it in the usual order, with the catalog, without
+renaming anything again.
+
+Usage:
+    watch_night (<basedir>) [--interval=S] [--settle=S] [--once] [--compress]
+
+Options:
+    --interval=S        # Seconds between polls [default: 5]
+    --settle=S          # Seconds a frame must be unchanged before it is
+                        # processed [default: 2]
+    --once              # Process the frames that are complete now and stop
+    --compress          # Tile-compress the frames as they are sorted
+"""
+
+import os
+import re
+import time
+from pathlib import Path
+from docopt import docopt
+
+import fits_blocks
+import rename_maxim
+import rename_obs
+from header_catalog import HeaderCatalog, read_header
+from log import write_log_entry, write_log_header, write_misc_entry
+from night_tree import is_fits
+from rename_journal import RenameJournal
+
+
+class NightWatcher:
+    """
+    Incremental sorting and logging of the frames arriving in a night
+    directory.
+
+    Parameters
+    ----------
+    basedir : string
+        The night directory (DATE); frames arrive in DATE/DATE.
+
+    settle : float
+        Seconds a frame must be left unchanged before it is processed.
+
+    compress : bool
+        Whether frames are tile-compressed as they are sorted.
+    """
+
+    def __init__(self, basedir, settle=2.0, compress=False):
+        self.basedir = os.path.normpath(basedir)
+        self.date = os.path.basename(self.basedir)
+        self.incoming = os.path.join(self.basedir, self.date)
+        self.log_path = os.path.join(self.basedir, self.date + ".log")
+        self.settle = settle
+        self.compress = compress
+        self.catalog = HeaderCatalog()
+        self.journal = RenameJournal(self.basedir)
+        self.n_processed = 0
+        # Next number for each new name, in the target directories seen
+        self._counters = {}
+        self._listed = set()
+        # Frames already reported as waiting or failed
+        self._waiting = set()
+        self._failed = set()
+
+    def ready_frames(self):
+        """
+        Paths of the frames in the incoming directory that are complete and
+        have settled, in order of DATE-OBS.
+        """
+        ready = []
+        now = time.time()
+        if not os.path.isdir(self.incoming):
+            return ready
+        with os.scandir(self.incoming) as entries:
+            for entry in entries:
+                if (
+                    not entry.is_file()
+                    or entry.name.startswith(".")
+                    or not is_fits(entry.name)
+                    or entry.path in self._failed
+                ):
+                    continue
+                if now - entry.stat().st_mtime < self.settle or not (
+                    fits_blocks.is_complete(entry.path)
+                ):
+                    if entry.path not in self._waiting:
+                        print(f"Waiting for {entry.name} to be written")
+                        self._waiting.add(entry.path)
+                    continue
+                self._waiting.discard(entry.path)
+                ready.append(entry.path)
+        for fpath in list(ready):
+            try:
+                self.catalog.add(fpath, read_header(fpath))
+            except Exception as e:
+                print(f"Could not read FITS header of {fpath}: {e}")
+                self._failed.add(fpath)
+                ready.remove(fpath)
+        return sorted(ready, key=lambda f: (self.catalog.get(f).get("DATE-OBS", ""), f))
+
+    def _next_count(self, dest_dir, name):
+        # The number for the next frame called `name` (without its _NN) in
+        # `dest_dir`, which is listed the first time it is used
+        if dest_dir not in self._listed:
+            self._listed.add(dest_dir)
+            with os.scandir(dest_dir) as entries:
+                for entry in entries:
+                    match = re.fullmatch(r"(.*)_(\d+)\.fits(\.fz)?", entry.name)
+                    if match:
+                        key = (dest_dir, match[1])
+                        count = int(match[2]) + 1
+                        self._counters[key] = max(self._counters.get(key, 0), count)
+        key = (dest_dir, name)
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        return count
+
+    def process(self, fpath):
+        """
+        Move one frame to its sorted name and append it to the log.
+
+        Returns the new path.
+        """
+        header = self.catalog.get(fpath)
+        try:
+            folder_name = rename_obs.target_folder(header)
+        except KeyError:
+            print(f"{fpath} does not have requisite header info")
+            folder_name = "Misc"
+        dest_dir = os.path.join(self.incoming, folder_name)
+        os.makedirs(dest_dir, exist_ok=True)
+        try:
+            name = rename_obs.frame_stem(fpath, self.catalog, dest_dir)
+            new_fpath = rename_obs.create_fpath(
+                fpath,
+                catalog=self.catalog,
+                count=self._next_count(dest_dir, name),
+                dest_dir=dest_dir,
+                compress=self.compress or None,
+            )
+        except KeyError:
+            # No FILTER or EXPTIME to name it by
+            new_fpath = Path(dest_dir, rename_maxim.rename_maxim(Path(fpath).stem))
+        rename_obs.apply_plan([(fpath, new_fpath)], self.catalog, self.journal)
+
+        new_log = not os.path.exists(self.log_path)
+        with open(self.log_path, "a") as log:
+            if new_log:
+                write_log_header(log, self.basedir)
+            if folder_name == "Misc":
+                write_misc_entry(log, "/Misc", new_fpath.name, header)
+            else:
+                subdir = f"/{self.date}/{folder_name}"
+                write_log_entry(log, subdir, new_fpath.name, header)
+        return new_fpath
+
+    def poll(self):
+        """
+        Process every frame that is ready. Returns the number processed.
+        """
+        n_processed = 0
+        for fpath in self.ready_frames():
+            start = time.perf_counter()
+            try:
+                new_fpath = self.process(fpath)
+            except Exception as e:
+                print(f"Error processing {fpath}: {e}")
+                self._failed.add(fpath)
+                continue
+            n_processed += 1
+            print(
+                f"{os.path.basename(fpath)} -> "
+                f"{os.path.relpath(new_fpath, self.incoming)} "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+        self.n_processed += n_processed
+        return n_processed
+
+    def watch(self, interval=5.0):
+        """
+        Poll every `interval` seconds until interrupted.
+        """
+        print(f"Watching {self.incoming} for new frames (Ctrl-C to stop)")
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print(f"Stopped after sorting and logging {self.n_processed} frames")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    watcher = NightWatcher(
+        args["<basedir>"],
+        settle=float(args["--settle"]),
+        compress=args["--compress"],
+    )
+    if args["--once"]:
+        watcher.poll()
+        print(f"Sorted and logged {watcher.n_processed} frames")
+    else:
+        watcher.watch(interval=float(args["--interval"]))
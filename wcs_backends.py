@@ -0,0 +1,205 @@
+"""
+Plate-solving backends for make_wcs.
+
+A backend is any object with the three methods make_wcs.solve_wcs uses from
+astroquery's AstrometryNet client:
+
+    solve_from_image(image_file_path, *, force_image_upload, fwhm,
+                     detect_threshold, solve_timeout, **settings)
+    solve_from_source_list(x, y, image_width, image_height, *,
+                           solve_timeout, **settings)
+    monitor_submission(submission_id, *, solve_timeout)
+
+Each returns the solved WCS as a Header, an empty dict if the solve failed,
+or raises astroquery's TimeoutError with the submission ID as its second
+argument if the solve is still running after `solve_timeout`.
+
+`nova_backend` gives the public nova.astrometry.net service or any
+self-hosted nova-compatible server. `LocalBackend` is an offline stand-in
+that answers every submission with a canned solution centred on the
+pointing hint, with optional latency, failures and timeouts, for
+benchmarking throughput, concurrency limits and retry behaviour.
+"""
+
+import itertools
+import os
+import random
+import threading
+import time
+from astropy.io import fits
+
+# Environment variable holding the Astrometry.net API key
+API_KEY_VARIABLE = "ASTROMETRY_NET_API_KEY"
+
+
+def nova_backend(server=None, api_key=None):
+    """
+    Astrometry.net client for nova.astrometry.net, or for a nova-compatible
+    server at `server`.
+
+    The API key is taken from `api_key`, then the ASTROMETRY_NET_API_KEY
+    environment variable, then astroquery's own configuration.
+    """
+    from astroquery.astrometry_net import AstrometryNetClass, conf
+
+    client = AstrometryNetClass()
+    api_key = api_key or os.environ.get(API_KEY_VARIABLE)
+    if api_key:
+        client.api_key = api_key
+    elif not conf.api_key:
+        raise RuntimeError(
+            f"No Astrometry.net API key: pass --api-key or set {API_KEY_VARIABLE}"
+        )
+    if server:
+        server = server.rstrip("/")
+        client.URL = server
+        client.API_URL = server + "/api"
+    return client
+
+
+def canned_wcs(center_ra, center_dec, image_width, image_height, scale=1.0):
+    """
+    A plausible TAN WCS centred on (center_ra, center_dec) degrees, with
+    `scale` arcsec per pixel, for an image of the given size.
+    """
+    from astropy.wcs import WCS
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [center_ra, center_dec]
+    wcs.wcs.crpix = [(image_width + 1) / 2, (image_height + 1) / 2]
+    wcs.wcs.cdelt = [-scale / 3600, scale / 3600]
+    return wcs.to_header()
+
+
+class LocalBackend:
+    """
+    Offline stand-in for Astrometry.net that returns canned solutions.
+
+    Parameters
+    ----------
+    delay : float
+        Seconds each job spends "solving".
+
+    failure_rate : float
+        Fraction of jobs that end in failure.
+
+    timeout_rate : float
+        Fraction of jobs whose first monitoring times out, to exercise the
+        retry path.
+
+    seed : int, optional
+        Seed for choosing which jobs fail or time out.
+    """
+
+    def __init__(self, delay=0.0, failure_rate=0.0, timeout_rate=0.0, seed=None):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.n_submitted = 0
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, settings, image_width, image_height):
+        """
+        Queue a job and return its submission ID.
+        """
+        with self._lock:
+            submission_id = next(self._ids)
+            outcome = "success"
+            if self._random.random() < self.failure_rate:
+                outcome = "failure"
+            stall = self._random.random() < self.timeout_rate
+            self._jobs[submission_id] = {
+                "settings": settings,
+                "shape": (image_width, image_height),
+                "done_at": time.monotonic() + self.delay,
+                "outcome": outcome,
+                "stall": stall,
+            }
+            self.n_submitted += 1
+            self.n_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        return submission_id
+
+    def status(self, submission_id):
+        """
+        "solving", "success" or "failure".
+        """
+        job = self._jobs[submission_id]
+        if time.monotonic() < job["done_at"]:
+            return "solving"
+        return job["outcome"]
+
+    def wcs(self, submission_id):
+        """
+        The canned WCS header for a successful job.
+        """
+        job = self._jobs[submission_id]
+        settings = job["settings"]
+        return canned_wcs(
+            settings.get("center_ra", 0.0),
+            settings.get("center_dec", 0.0),
+            *job["shape"],
+            scale=settings.get("scale_est") or 1.0,
+        )
+
+    def monitor_submission(self, submission_id, *, solve_timeout=120, **kwargs):
+        from astroquery.exceptions import TimeoutError
+
+        job = self._jobs[submission_id]
+        if job["stall"]:
+            job["stall"] = False
+            raise TimeoutError(
+                "Solve timed out without success or failure", submission_id
+            )
+        remaining = job["done_at"] - time.monotonic()
+        if remaining > solve_timeout:
+            time.sleep(solve_timeout)
+            raise TimeoutError(
+                "Solve timed out without success or failure", submission_id
+            )
+        time.sleep(max(0.0, remaining))
+        with self._lock:
+            self.n_in_flight -= 1
+        if job["outcome"] == "failure":
+            return {}
+        return self.wcs(submission_id)
+
+    def solve_from_source_list(
+        self, x, y, image_width, image_height, *, solve_timeout=120, **settings
+    ):
+        settings.pop("verbose", None)
+        submission_id = self.submit(settings, image_width, image_height)
+        return self.monitor_submission(submission_id, solve_timeout=solve_timeout)
+
+    def solve_from_image(
+        self,
+        image_file_path,
+        *,
+        force_image_upload=False,
+        fwhm=None,
+        detect_threshold=None,
+        solve_timeout=120,
+        **settings,
+    ):
+        settings.pop("verbose", None)
+        header = fits.getheader(image_file_path)
+        submission_id = self.submit(settings, header["NAXIS1"], header["NAXIS2"])
+        return self.monitor_submission(submission_id, solve_timeout=solve_timeout)
+
+
+def make_backend(name="nova", server=None, api_key=None, **options):
+    """
+    Create a backend by name: "nova" (see `nova_backend`) or "local" (a
+    `LocalBackend`, created with `options`).
+    """
+    if name == "nova":
+        return nova_backend(server=server, api_key=api_key)
+    if name == "local":
+        return LocalBackend(**options)
+    raise ValueError(f"Unknown solver backend {name!r}")
@@ -0,0 +1,89 @@
+"""
+Content-addressed cache of Astrometry.net WCS solutions.
+
+A solution is stored under a hash of the frame's raw pixel data and its
+pointing hint (OBJCTRA/OBJCTDEC), so a frame that has been solved before is
+recognised even after it has been renamed, moved or copied to another night
+directory, and re-running make_wcs costs no network calls for it.
+"""
+
+import hashlib
+import os
+import threading
+import numpy as np
+from astropy.io import fits
+
+import fits_compress
+
+# Default cache directory, kept inside the directory passed to make_wcs
+CACHE_NAME = ".wcs_cache"
+
+
+def frame_key(fpath):
+    """
+    Hash the image and pointing hint of a FITS frame.
+
+    The stored integers are hashed as they are on disk (no BZERO/BSCALE
+    scaling), so the key is cheap to compute and independent of astropy's
+    scaling rules. They are hashed in FITS (big-endian) byte order, so a
+    frame has the same key whether or not it is tile compressed.
+    """
+    digest = hashlib.sha256()
+    with fits.open(fpath, memmap=True, do_not_scale_image_data=True) as hdulist:
+        hdu = fits_compress.image_hdu(hdulist)
+        for key in ("OBJCTRA", "OBJCTDEC"):
+            digest.update(str(hdu.header.get(key, "")).encode())
+            digest.update(b"\0")
+        data = hdu.data
+        if data is not None:
+            big_endian = data.dtype.newbyteorder(">")
+            digest.update(np.ascontiguousarray(data, dtype=big_endian))
+            del data
+    return digest.hexdigest()
+
+
+class WCSCache:
+    """
+    Directory of solved WCS headers, one text file per frame hash.
+
+    Parameters
+    ----------
+    cache_dir : string or Path
+        Directory holding the cache. Created if it does not exist.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.fspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.n_hits = 0
+        self.n_misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".hdr")
+
+    def get(self, key):
+        """
+        Return the cached WCS header for `key`, or None.
+        """
+        try:
+            with open(self._path(key)) as f:
+                header = fits.Header.fromstring(f.read(), sep="\n")
+        except FileNotFoundError:
+            header = None
+        with self._lock:
+            if header is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        return header
+
+    def put(self, key, header):
+        """
+        Store the WCS header solved for `key`.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(header.tostring(sep="\n"))
+        os.replace(tmp_path, path)
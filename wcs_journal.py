@@ -0,0 +1,95 @@
+"""
+On-disk journal of make_wcs submissions.
+
+Every change in a frame's solve state is appended as one JSON line to
+`JOURNAL_NAME` in the target directory, so an interrupted run leaves behind
+the submission IDs still in the Astrometry.net queue. The next run resumes
+monitoring those submissions instead of uploading the frames again, and
+`make_wcs status` summarises the journal.
+"""
+
+import json
+import os
+import threading
+import time
+
+JOURNAL_NAME = ".wcs_journal.jsonl"
+
+# States a frame can be in
+SUBMITTED = "submitted"
+SOLVED = "solved"
+FAILED = "failed"
+
+
+class WCSJournal:
+    """
+    Append-only record of the submission and state of each frame.
+
+    Parameters
+    ----------
+    target_dir : string or Path
+        Directory of frames being solved; the journal is kept inside it.
+    """
+
+    def __init__(self, target_dir):
+        self.path = os.path.join(target_dir, JOURNAL_NAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line cut short by an interrupted write
+                        continue
+                    self._entries[entry["file"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def get(self, fpath):
+        """
+        The latest journal entry for a frame, or None.
+        """
+        return self._entries.get(os.path.basename(fpath))
+
+    def record(self, fpath, state, submission_id=None):
+        """
+        Append the new state of a frame to the journal.
+        """
+        entry = {
+            "file": os.path.basename(fpath),
+            "state": state,
+            "submission_id": submission_id,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with self._lock:
+            self._entries[entry["file"]] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def summary(self, fpaths, is_solved):
+        """
+        Group frames by state: "solved", "pending" (submitted and not yet
+        finished), "failed" and "new" (never submitted).
+
+        Parameters
+        ----------
+        fpaths : list of string or Path
+            The frames of the target.
+
+        is_solved : callable
+            Returns True for a frame that already has a solution on disk.
+        """
+        states = {"solved": [], "pending": [], "failed": [], "new": []}
+        for fpath in fpaths:
+            entry = self.get(fpath)
+            if is_solved(fpath) or (entry and entry["state"] == SOLVED):
+                states["solved"].append(fpath)
+            elif entry is None:
+                states["new"].append(fpath)
+            elif entry["state"] == SUBMITTED:
+                states["pending"].append(fpath)
+            else:
+                states["failed"].append(fpath)
+        return states
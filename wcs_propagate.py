@@ -0,0 +1,155 @@
+"""
+Carry a solved WCS from a reference frame to other frames of the same
+pointing.
+
+Frames taken in a sequence at the same OBJCTRA/OBJCTDEC and FILTER differ
+mostly by a small translation from guiding drift. The translation is measured
+locally by FFT phase correlation: first on a binned copy of the whole frame,
+then at full resolution on a central patch for sub-pixel accuracy. The
+reference WCS is then shifted by moving CRPIX. The significance of the
+correlation peak tells the caller whether to trust the match or to fall back
+to a remote solve.
+"""
+
+import numpy as np
+
+import fits_compress
+
+# Largest side of the binned image used for the coarse shift
+COARSE_SIZE = 1024
+# Side of the central full-resolution patch used to refine the shift
+PATCH_SIZE = 512
+# Correlation peaks below this many standard deviations of the correlation
+# surface are treated as a poor match
+MIN_SIGNIFICANCE = 8.0
+
+
+def group_by_pointing(fpaths):
+    """
+    Group frames by their OBJCTRA, OBJCTDEC and FILTER header values.
+
+    Returns a list of lists of paths, each in the order given.
+    """
+    groups = {}
+    for fpath in fpaths:
+        header = fits_compress.getheader(fpath)
+        key = (header.get("OBJCTRA"), header.get("OBJCTDEC"), header.get("FILTER"))
+        groups.setdefault(key, []).append(fpath)
+    return list(groups.values())
+
+
+def _bin(data, factor):
+    if factor == 1:
+        return data
+    ny = data.shape[0] // factor * factor
+    nx = data.shape[1] // factor * factor
+    return (
+        data[:ny, :nx]
+        .reshape(ny // factor, factor, nx // factor, factor)
+        .mean(axis=(1, 3))
+    )
+
+
+def _prepare(data):
+    # Remove the sky level and taper the edges so the frame borders do not
+    # dominate the correlation
+    data = data - np.median(data)
+    window = np.outer(np.hanning(data.shape[0]), np.hanning(data.shape[1]))
+    return data * window
+
+
+def _subpixel(left, centre, right):
+    # Vertex of the parabola through three samples around a peak
+    denominator = left - 2 * centre + right
+    if denominator == 0:
+        return 0.0
+    return 0.5 * (left - right) / denominator
+
+
+def phase_correlate(ref, data):
+    """
+    Measure the translation of `data` relative to `ref` by phase correlation.
+
+    Parameters
+    ----------
+    ref, data : 2D arrays of the same shape
+
+    Returns
+    -------
+    dx, dy : float
+        Shift in pixels, such that a star at (x, y) in `ref` is at
+        (x + dx, y + dy) in `data`.
+
+    significance : float
+        Height of the correlation peak above the mean of the correlation
+        surface, in units of its standard deviation.
+    """
+    cross_power = np.fft.rfft2(_prepare(data)) * np.conj(np.fft.rfft2(_prepare(ref)))
+    cross_power /= np.abs(cross_power) + 1e-12
+    surface = np.fft.irfft2(cross_power, s=ref.shape)
+
+    iy, ix = np.unravel_index(np.argmax(surface), surface.shape)
+    ny, nx = surface.shape
+    dy = iy + _subpixel(
+        surface[(iy - 1) % ny, ix], surface[iy, ix], surface[(iy + 1) % ny, ix]
+    )
+    dx = ix + _subpixel(
+        surface[iy, (ix - 1) % nx], surface[iy, ix], surface[iy, (ix + 1) % nx]
+    )
+    # Shifts past half the frame are negative shifts wrapped around
+    if dy > ny / 2:
+        dy -= ny
+    if dx > nx / 2:
+        dx -= nx
+    significance = (surface[iy, ix] - surface.mean()) / surface.std()
+    return dx, dy, significance
+
+
+def measure_shift(ref, data):
+    """
+    Measure the translation of `data` relative to `ref`, coarse-to-fine.
+
+    Returns dx, dy and the significance of the weaker of the two
+    correlation peaks, as for `phase_correlate`.
+    """
+    ref = np.asarray(ref, dtype=np.float32)
+    data = np.asarray(data, dtype=np.float32)
+    factor = max(1, -(-max(ref.shape) // COARSE_SIZE))
+    dx, dy, coarse_significance = phase_correlate(_bin(ref, factor), _bin(data, factor))
+    dx, dy = int(round(dx * factor)), int(round(dy * factor))
+
+    # Central patch of the reference, and the patch of the frame that the
+    # coarse shift says lines up with it
+    half = min(PATCH_SIZE, ref.shape[0] - 2 * abs(dy), ref.shape[1] - 2 * abs(dx)) // 2
+    if half < 16:
+        return float(dx), float(dy), 0.0
+    cy, cx = ref.shape[0] // 2, ref.shape[1] // 2
+    ref_patch = ref[cy - half : cy + half, cx - half : cx + half]
+    data_patch = data[cy + dy - half : cy + dy + half, cx + dx - half : cx + dx + half]
+    fine_dx, fine_dy, fine_significance = phase_correlate(ref_patch, data_patch)
+    return (
+        float(dx + fine_dx),
+        float(dy + fine_dy),
+        float(min(coarse_significance, fine_significance)),
+    )
+
+
+def shifted_wcs_header(solved_header, dx, dy):
+    """
+    The WCS of `solved_header`, moved by (dx, dy) pixels.
+
+    The WCS (including any SIP distortion terms) is taken from the solved
+    reference header and CRPIX is shifted, which is exact for a pure
+    translation between frames.
+    """
+    from astropy.wcs import WCS
+
+    if solved_header.get("NAXIS") == 0:
+        # Header-only .wcs file: let the WCS keywords set the axes, rather
+        # than warning that there is no image for them
+        solved_header = solved_header.copy()
+        del solved_header["NAXIS"]
+    wcs_header = WCS(solved_header).to_header(relax=True)
+    wcs_header["CRPIX1"] += dx
+    wcs_header["CRPIX2"] += dy
+    return wcs_header
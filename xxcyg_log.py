@@ -6,11 +6,13 @@
 # Feb 2018: updated to unzip files first
 # Feb 2024: TO DO update using pathlib
 
-import os, re, sys, glob, zipfile
+import os, re, sys, glob
 import rename_maxim
 import rename_obs
+import zip_ingest
 from pathlib import Path
-from astropy.io import fits
+from header_catalog import HeaderCatalog
+from log import write_log_entry, write_misc_entry
 
 
 def main(basedir):
@@ -21,13 +23,15 @@ def main(basedir):
 
     # basedir = basedir+'/'
 
-    # First iteration to unzip if needed
+    # Header keywords for every frame, read once and shared by all stages
+    catalog = HeaderCatalog()
+
+    # First iteration to unzip if needed. FITS frames are written straight
+    # into their sorted subdirectories, with their headers catalogued.
     for fname in os.listdir(basedir):
         if fname.endswith(".zip"):
             print("Unzipping %s" % fname)
-            zf = zipfile.ZipFile(basedir + "/" + fname, mode="r")
-            zf.extractall(path=basedir)
-            zf.close
+            zip_ingest.ingest_zip(basedir + "/" + fname, basedir, catalog)
 
     # 2nd iteration to fix filenames
     for root, dirs, fnames in os.walk(basedir, topdown=True):
@@ -54,15 +58,15 @@ def main(basedir):
 
         # TJH Added: Sort fits files into folder depending on their target
         # Rename .fits files depending on header information
-        bad_paths = rename_obs.sort_by_target(root)
+        bad_paths = rename_obs.sort_by_target(root, catalog=catalog)
     
     # 3rd iteration to rename .fits filenames
     # for root, dirs, fnames in os.walk(basedir, topdown=True):
-    #     rename_obs.process_folder(root)
+    #     rename_obs.process_folder(root, catalog=catalog)
 
     # 4th iteration with sorted filenames to make log
 
-    misc_flag = False
+    misc_dirs = []
 
     log_path = os.path.normpath(basedir)
     logname = os.path.basename(log_path) + ".log"
@@ -93,7 +97,7 @@ def main(basedir):
         if depth >= 3:
             continue
         if "Misc" in root:
-            misc_flag = True
+            misc_dirs.append(root)
             continue
 
         root = root + os.path.sep
@@ -105,99 +109,11 @@ def main(basedir):
             (head, ext) = os.path.splitext(fname)
             match = re.match(r"\.f.*t.*", ext)
             if match:
-                hdulist = fits.open(root + fname)
-                # Log images from new SBIG CCD, not Orion autoguider
-                if hdulist[0].header["INSTRUME"][:4] == "SBIG":
-                    if hdulist[0].header["IMAGETYP"] == "Dark Frame":
-                        log.write(
-                            "%-20s %-30s %-22s DARK     N/A         N/A          %-7.1f     N/A\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Bias Frame":
-                        log.write(
-                            "%-20s %-30s %-22s BIAS     N/A         N/A          %-7.1f     N/A\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Flat Field":
-                        log.write(
-                            "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "FLAT":
-                        log.write(
-                            "%-20s %-30s %-22s FLAT     N/A         N/A          %-7.1f %10s\n"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                    elif hdulist[0].header["IMAGETYP"] == "Light Frame":
-                        # hdulist.info()
-                        log.write(
-                            "%-20s %-30s %-22s %-8s"
-                            % (
-                                subdir,
-                                fname,
-                                hdulist[0].header["DATE-OBS"],
-                                hdulist[0].header["OBJECT"],
-                            )
-                        )
-                        try:
-                            log.write(
-                                "%-10s %-13s"
-                                % (
-                                    hdulist[0].header["OBJCTRA"],
-                                    hdulist[0].header["OBJCTDEC"],
-                                )
-                            )
-                        except KeyError:
-                            log.write("  N/A         N/A          ")
-                        log.write(
-                            "%-7.1f %10s"
-                            % (
-                                hdulist[0].header["EXPTIME"],
-                                hdulist[0].header["FILTER"],
-                            )
-                        )
-                        log.write("\n")
-                    else:
-                        print(
-                            "IMAGETYP %s not known for %s"
-                            % (hdulist[0].header["IMAGETYP"], fname)
-                        )
-    if misc_flag:
+                write_log_entry(log, subdir, fname, catalog.get(root + fname))
+    for misc_dir in misc_dirs:
         subdir = "/Misc"
-        for fname in Path(basedir).joinpath("Misc").iterdir():
-            hdulist = fits.open(fname)
-            log.write(
-                "%-20s %-30s %-22s UNKNOWN     N/A         N/A          %-7.1f     %10s\n"
-                % (
-                    subdir,
-                    fname.name,
-                    hdulist[0].header["DATE-OBS"],
-                    hdulist[0].header["EXPTIME"],
-                    hdulist[0].header["FILTER"],
-                )
-            )
+        for fname in sorted(Path(misc_dir).iterdir()):
+            write_misc_entry(log, subdir, fname.name, catalog.get(fname))
     log.close()
     print("Written log to %s" % logfullname)
     wcs_dir = glob.glob(basedir)[0]
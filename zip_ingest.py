@@ -0,0 +1,131 @@
+"""
+Unpack zipped observations straight into their sorted subdirectories.
+
+Rather than extracting a whole archive and then moving every file, each FITS
+member is streamed once: its 2880-byte header blocks are read first to decide
+where the frame belongs (as rename_obs.sort_by_target would), and the member
+is then written directly to that path under its rename_maxim name. The header
+keywords read on the way are added to the night's HeaderCatalog. Frames at
+the top of the archive are written to the night directory itself, where
+log.py sorts them into target subdirectories as it would after extractall.
+
+Members that are not FITS files, or that sit deeper in the archive than the
+directories log.py sorts, are extracted in place as ZipFile.extractall would.
+"""
+
+import os
+import re
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+from astropy.io import fits
+
+import rename_maxim
+import rename_obs
+from fits_blocks import COPY_BUFSIZE, read_header_blocks
+from header_catalog import catalog_keywords
+
+
+def _is_sortable(info):
+    # Only FITS files at the depths log.py sorts (BASEDIR and BASEDIR/DATE)
+    # are placed directly; everything else is extracted as-is.
+    if info.is_dir():
+        return False
+    path = PurePosixPath(info.filename)
+    if path.is_absolute() or ".." in path.parts or len(path.parts) > 2:
+        return False
+    return re.match(r"\.f.*t.*", path.suffix) is not None
+
+
+def _ingest_members(zip_path, infos, basedir):
+    ingested = []
+    with zipfile.ZipFile(zip_path, mode="r") as zf:
+        for info in infos:
+            if not _is_sortable(info):
+                zf.extract(info, path=basedir)
+                continue
+            with zf.open(info) as src:
+                try:
+                    header_bytes = read_header_blocks(src)
+                    header = catalog_keywords(
+                        fits.Header.fromstring(header_bytes.decode("ascii"))
+                    )
+                except (ValueError, UnicodeDecodeError):
+                    print(f"Could not read FITS header of {info.filename}")
+                    header = None
+                if header is not None:
+                    member = PurePosixPath(info.filename)
+                    if member.parent.parts:
+                        try:
+                            folder_name = rename_obs.target_folder(header)
+                        except KeyError:
+                            print(
+                                f"{info.filename} does not have requisite "
+                                "header info"
+                            )
+                            folder_name = "Misc"
+                        dest_dir = os.path.join(
+                            basedir, *member.parent.parts, folder_name
+                        )
+                    else:
+                        # Frames at the top of the archive are left in
+                        # BASEDIR, as extractall would, for log.py to sort
+                        # into BASEDIR/TARGET
+                        dest_dir = basedir
+                    os.makedirs(dest_dir, exist_ok=True)
+                    dest = os.path.join(
+                        dest_dir, rename_maxim.rename_maxim(member.stem)
+                    )
+                    with open(dest, "wb") as dst:
+                        dst.write(header_bytes)
+                        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+                    ingested.append((dest, header))
+            if header is None:
+                zf.extract(info, path=basedir)
+    return ingested
+
+
+def ingest_zip(zip_path, basedir, catalog, jobs=1):
+    """
+    Unpack a zip of observations into the night directory, writing each FITS
+    frame once, directly to its sorted path.
+
+    Parameters
+    ----------
+    zip_path : string
+        The zip archive to unpack.
+
+    basedir : string
+        The night directory the archive is unpacked into, as for
+        ZipFile.extractall.
+
+    catalog : HeaderCatalog
+        Catalog that the header keywords of the placed frames are added to.
+
+    jobs : int
+        Number of threads unpacking members in parallel. Each thread works
+        through its own share of the members with its own ZipFile handle.
+
+    Returns
+    -------
+    int
+        The number of FITS frames written and catalogued.
+    """
+    with zipfile.ZipFile(zip_path, mode="r") as zf:
+        infos = zf.infolist()
+    jobs = max(1, min(jobs, len(infos)))
+    chunks = [infos[i::jobs] for i in range(jobs)]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(
+            _ingest_members,
+            [zip_path] * jobs,
+            chunks,
+            [basedir] * jobs,
+        )
+        n_ingested = 0
+        for ingested in results:
+            for dest, header in ingested:
+                catalog.add(dest, header)
+            n_ingested += len(ingested)
+    return n_ingested